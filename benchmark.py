@@ -0,0 +1,210 @@
+'''
+End to end throughput benchmark of the extractor on synthetic reports.
+
+Generates reports with synthetic_reports.py (no PHI needed), runs them
+through process_pdfs serially and with a pool of workers, and reports
+PDFs/sec, pages/sec, time per extraction stage and peak RSS. Each run is
+timed in a fresh process, so its peak RSS is its own and not the largest
+of the runs before it. Results are saved as JSON so runs before and after
+a change can be compared:
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+'''
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz  # PyMuPDF
+
+import extract_stats
+from stage_timing import peak_rss_mb
+from synthetic_reports import write_reports
+
+
+@contextlib.contextmanager
+def quiet():
+    '''
+    Sends stdout to the null device, including the worker processes' output
+    '''
+    sys.stdout.flush()
+    saved = os.dup(1)
+    with open(os.devnull, 'w') as devnull:
+        os.dup2(devnull.fileno(), 1)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            os.dup2(saved, 1)
+            os.close(saved)
+
+
+def time_stages(path, stages):
+    '''
+    Extracts one pdf, adding the time each stage took to stages
+
+    Args:
+        path(str): the pdf
+        stages(dict(str, float)): seconds per stage, added to in place
+    Returns:
+        None
+    '''
+    timings = {}
+    extract_stats.process_pdf(path, timings)
+    for stage, seconds in timings.items():
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+
+def time_batch(paths, workers):
+    '''
+    Extracts every pdf with process_pdfs, without the cache. Run in a
+    fresh process by run_batch
+
+    Args:
+        paths(list(str)): the pdfs
+        workers(int): the number of processes
+    Returns:
+        float: the wall clock seconds taken
+        float: this process's peak RSS in MB
+        float: the largest worker's peak RSS in MB, None without workers
+    '''
+    with quiet():
+        # PyMuPDF sets itself up on the first pdf, that isn't timed
+        extract_stats.process_pdf(paths[0])
+        start = time.perf_counter()
+        for _ in extract_stats.process_pdfs(paths, workers):
+            pass
+        seconds = time.perf_counter() - start
+    return seconds, peak_rss_mb(), peak_rss_mb(children=True) if workers > 1 else None
+
+
+def run_batch(paths, workers):
+    '''
+    time_batch in a new process, so the peak RSS is this run's alone
+
+    Args:
+        paths(list(str)): the pdfs
+        workers(int): the number of processes
+    Returns:
+        tuple(float, float, float): what time_batch returns
+    '''
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as runner:
+        return runner.submit(time_batch, paths, workers).result()
+
+
+def benchmark(count, appendix_pages, workers, folder):
+    '''
+    Runs the benchmark for every page count and worker count
+
+    Args:
+        count(int): reports per page count
+        appendix_pages(list(int)): trailing hypnogram pages, one set of reports each
+        workers(list(int)): the worker counts to run, 1 is serial
+        folder(str): where to write the reports
+    Returns:
+        dict(str, any): the results
+    '''
+    runs = []
+    stages = {}
+    for extra_pages in appendix_pages:
+        paths = write_reports(os.path.join(folder, f'appendix_{extra_pages}'), count, extra_pages)
+        pages = 0
+        for path in paths:
+            with fitz.open(path) as document:
+                pages += document.page_count
+        # one untimed pass so reading the files from disk doesn't count
+        run_batch(paths[:2], 1)
+        for n in workers:
+            seconds, peak_rss, peak_worker_rss = run_batch(paths, n)
+            runs.append({
+                'appendix_pages': extra_pages,
+                'workers': n,
+                'pdfs': len(paths),
+                'pages': pages,
+                'seconds': seconds,
+                'pdfs_per_sec': len(paths) / seconds,
+                'pages_per_sec': pages / seconds,
+                'peak_rss_mb': peak_rss,
+                'peak_worker_rss_mb': peak_worker_rss,
+            })
+            print(f'appendix {extra_pages:>3} pages, {n} worker(s): '
+                  f'{runs[-1]["pdfs_per_sec"]:.1f} pdfs/sec, {runs[-1]["pages_per_sec"]:.1f} pages/sec')
+        stage_times = {}
+        with quiet():
+            for path in paths:
+                time_stages(path, stage_times)
+        stages[str(extra_pages)] = {stage: 1000 * t / len(paths) for stage, t in stage_times.items()}
+
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'extractor_version': extract_stats.EXTRACTOR_VERSION,
+        'python': platform.python_version(),
+        'pymupdf': fitz.VersionBind,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'runs': runs,
+        'stage_ms_per_pdf': stages,
+    }
+
+
+def print_stages(results):
+    for extra_pages, stage_ms in results['stage_ms_per_pdf'].items():
+        print(f'\nms per pdf, appendix {extra_pages} pages:')
+        for stage, ms in sorted(stage_ms.items(), key=lambda item: -item[1]):
+            print(f'  {stage:<20} {ms:8.2f}')
+
+
+def compare(results, baseline):
+    '''
+    Prints the throughput of each run against the matching baseline run
+    '''
+    before = {(r['appendix_pages'], r['workers']): r for r in baseline['runs']}
+    print(f'\nvs extractor version {baseline["extractor_version"]} ({baseline["time"]}):')
+    for run in results['runs']:
+        old = before.get((run['appendix_pages'], run['workers']))
+        if old is not None:
+            print(f'  appendix {run["appendix_pages"]:>3} pages, {run["workers"]} worker(s): '
+                  f'{run["pdfs_per_sec"] / old["pdfs_per_sec"]:.2f}x pdfs/sec')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the extractor on synthetic reports')
+    parser.add_argument('--count', type=int, default=24,
+                        help='reports per page count (default: 24)')
+    parser.add_argument('--appendix-pages', type=int, nargs='+', default=[0, 20],
+                        help='trailing hypnogram pages to add to the reports (default: 0 20)')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4],
+                        help='worker counts to run (default: 1 4)')
+    parser.add_argument('--output', default='benchmark.json',
+                        help='the results file (default: benchmark.json)')
+    parser.add_argument('--compare', help='a results file from an earlier run')
+    parser.add_argument('--keep', help='write the reports here and keep them, instead of a temp folder')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.keep:
+        results = benchmark(args.count, args.appendix_pages, args.workers, args.keep)
+    else:
+        with tempfile.TemporaryDirectory() as folder:
+            results = benchmark(args.count, args.appendix_pages, args.workers, folder)
+    print_stages(results)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'\nSaved results to {args.output}')
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
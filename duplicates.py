@@ -0,0 +1,222 @@
+'''
+Finds the pdfs in a batch that are the same study as one earlier in it,
+before they are extracted: exact copies by the sha256 of their contents,
+and re-exports or copies under another name by the Study No, Hospital No
+and Study Date on their first page. Only the first page is decoded, in
+the worker processes when there are some.
+'''
+import csv
+from itertools import islice
+
+import extract_stats
+from extract_cache import file_sha256
+
+IDENTITY_FIELDS = ('study_number', 'hospital_number', 'study_date')
+
+
+def first_page_identity(path, data=None):
+    '''
+    The Study No, Hospital No and Study Date on the first page of a report,
+    read the way the extractor reads them
+
+    Args:
+        path(str): the pdf
+        data(bytes): its contents if they were already read
+    Returns:
+        tuple(str, str, str): the study number, hospital number and study
+            date, upper case with the whitespace collapsed. None if there
+            is no study date or neither number, too little to match on
+    '''
+    with extract_stats.ReportText(path, data, max_pages=1) as report:
+        if report.page_count == 0:
+            return None
+        row = extract_stats.get_individual_fields(report, extract_stats.Row())
+    values = [' '.join(str(row[name]).split()).upper() for name in IDENTITY_FIELDS]
+    values = ['' if value == '-' else value for value in values]
+    study_number, hospital_number, study_date = values
+    if not study_date or not (study_number or hospital_number):
+        return None
+    return tuple(values)
+
+
+def identity_or_none(path):
+    '''
+    first_page_identity, None if the pdf can't be read. Extracting it
+    reports the problem
+    '''
+    try:
+        return first_page_identity(path)
+    except Exception:
+        return None
+
+
+class DuplicateFinder:
+    '''
+    Filters the duplicates out of a stream of pdf paths, keeping the first
+    pdf of each study. The hash and first page identity of every pdf kept
+    are remembered, a few hundred bytes each. The pdfs are hashed here, but
+    their first pages are only opened in worker processes if there are
+    any, like the extraction, so with isolation a pdf that hangs PyMuPDF is
+    killed here too.
+
+    Args:
+        path(str): a csv file to list each duplicate in, with the pdf it
+            duplicates. None to only count them
+        cache(ExtractionCache): hash the pdfs through this cache, so a pdf
+            it has seen unchanged isn't read again. None to always read them
+        workers(int): the number of processes to read the first pages in,
+            1 to read them in this process
+        isolation(dict): read them in an IsolatedRunner instead, with these
+            keyword arguments (timeout, memory_mb, retries)
+        chunk_size(int): the most pdfs hashed and read ahead of the one
+            being yielded
+    '''
+    def __init__(self, path=None, cache=None, workers=1, isolation=None, chunk_size=256):
+        self.cache = cache
+        self.workers = max(1, workers)
+        self.isolation = isolation
+        self.chunk_size = max(1, chunk_size)
+        self.runner = None
+        self.executor = None
+        self.hashes = {}
+        self.studies = {}
+        self.same_file = 0
+        self.same_study = 0
+        self.file = None
+        if path is not None:
+            self.file = open(path, 'w', newline='')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(['path', 'duplicate_of', 'match'])
+
+    def _same_file(self, path):
+        '''
+        The earlier pdf with the same contents, remembering this one if
+        there isn't one
+        '''
+        if self.cache is not None:
+            digest = self.cache.key(path)[0]
+        else:
+            digest = file_sha256(path)
+        digest = bytes.fromhex(digest)
+        original = self.hashes.get(digest)
+        if original is None:
+            self.hashes[digest] = path
+        return original
+
+    def _same_study(self, path, identity):
+        '''
+        The earlier pdf of the same study, remembering this one if there
+        isn't one
+        '''
+        if identity is None:
+            return None
+        original = self.studies.get(identity)
+        if original is None:
+            self.studies[identity] = path
+        return original
+
+    def identities(self, paths):
+        '''
+        The first page identity of each pdf, read in the workers
+
+        Args:
+            paths(list(str)): the pdfs
+        Returns:
+            list(tuple(str, str, str)): what first_page_identity returns for
+                each, None for a pdf that can't be read or was killed
+        '''
+        if self.isolation is not None:
+            if self.runner is None:
+                from isolated import IsolatedRunner
+
+                self.runner = IsolatedRunner(first_page_identity, self.workers,
+                                             initializer=extract_stats.worker_logging(), **self.isolation)
+            return [value if ok else None for ok, value in self.runner.run(paths)]
+        if self.workers > 1:
+            if self.executor is None:
+                from concurrent.futures import ProcessPoolExecutor
+
+                self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                    initializer=extract_stats.worker_logging())
+            return list(self.executor.map(identity_or_none, paths))
+        return [identity_or_none(path) for path in paths]
+
+    def check(self, path):
+        '''
+        Looks for an earlier pdf of the same study, remembering this one if
+        there isn't one
+
+        Args:
+            path(str): the pdf
+        Returns:
+            tuple(str, str): the earlier pdf and 'same file' or 'same study',
+                or None if this pdf is the first of its study
+        '''
+        original = self._same_file(path)
+        if original is not None:
+            self.same_file += 1
+            return original, 'same file'
+        original = self._same_study(path, self.identities([path])[0])
+        if original is not None:
+            self.same_study += 1
+            return original, 'same study'
+        return None
+
+    def filter(self, paths):
+        '''
+        Yields the paths that aren't duplicates, as they are needed. The
+        pdfs are taken chunk_size at a time, so the workers read the first
+        pages of a chunk together
+
+        Args:
+            paths(iterable(str)): the pdfs, e.g. a generator
+        Returns:
+            generator(str): the first pdf of each study
+        '''
+        paths = iter(paths)
+        while True:
+            chunk = list(islice(paths, self.chunk_size))
+            if not chunk:
+                return
+            found = {}
+            new = []
+            for path in chunk:
+                try:
+                    original = self._same_file(path)
+                except OSError:
+                    # can't be read, let extraction report it
+                    continue
+                if original is not None:
+                    self.same_file += 1
+                    found[path] = (original, 'same file')
+                else:
+                    new.append(path)
+            # in input order, so the first pdf of a study is the one kept
+            for path, identity in zip(new, self.identities(new)):
+                original = self._same_study(path, identity)
+                if original is not None:
+                    self.same_study += 1
+                    found[path] = (original, 'same study')
+            for path in chunk:
+                if path not in found:
+                    yield path
+                elif self.file is not None:
+                    self.writer.writerow([path] + list(found[path]))
+                    self.file.flush()
+
+    def summary(self):
+        '''
+        One line on the duplicates found, for the end of a run
+        '''
+        where = f' (listed in {self.file.name})' if self.file is not None else ''
+        return (f'Skipped {self.same_file + self.same_study} duplicate pdfs: '
+                f'{self.same_file} copies of the same file, {self.same_study} '
+                f'of the same study{where}')
+
+    def close(self):
+        if self.runner is not None:
+            self.runner.close()
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+        if self.file is not None:
+            self.file.close()
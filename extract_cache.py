@@ -0,0 +1,150 @@
+'''
+On-disk cache of extracted rows, so re-runs over a folder only parse the
+pdfs that are new or changed.
+
+Rows are keyed by the sha256 of the pdf's contents, its size and the
+extractor version. The file's path, size and modification time are also
+stored, so a pdf that hasn't been touched since the last run is matched
+without reading it again.
+'''
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+def file_sha256(path):
+    '''
+    Hashes the contents of a file
+
+    Args:
+        path(str): the file to hash
+    Returns:
+        str: the hex digest
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ExtractionCache:
+    '''
+    SQLite store of process_pdf results
+
+    Args:
+        version(str): the extractor version, rows from other versions are ignored
+        cache_dir(str): directory for the database, created if missing
+        rebuild(bool): drop everything already cached
+    '''
+    def __init__(self, version, cache_dir='.cache', rebuild=False):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.version = version
+        self.path = os.path.join(cache_dir, 'extractions.sqlite')
+        self.db = sqlite3.connect(self.path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT)''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS rows (
+            sha256 TEXT, size INTEGER, version TEXT, row TEXT, error INTEGER,
+            PRIMARY KEY (sha256, size, version))''')
+        if rebuild:
+            self.db.execute('DELETE FROM files')
+            self.db.execute('DELETE FROM rows')
+        self.db.commit()
+
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.hashed = 0
+        self.lookup_time = 0.0
+
+    def key(self, path, data=None, read=True):
+        '''
+        Cache key of a pdf, only hashes it if it changed since it was last seen
+
+        Args:
+            path(str): the pdf
+            data(bytes): the pdf's contents if they were already read, hashed
+                instead of reading the file again
+            read(bool): read the file to hash it if needed. If False and it
+                isn't known, None is returned
+        Returns:
+            tuple(str, int): the sha256 and size of the file
+        '''
+        stat = os.stat(path)
+        found = self.db.execute('SELECT size, mtime_ns, sha256 FROM files WHERE path = ?',
+                                (os.path.abspath(path),)).fetchone()
+        if found and found[0] == stat.st_size and found[1] == stat.st_mtime_ns:
+            return found[2], stat.st_size
+        if data is not None:
+            sha256 = hashlib.sha256(data).hexdigest()
+        elif read:
+            sha256 = file_sha256(path)
+        else:
+            return None
+        self.hashed += 1
+        self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                        (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, sha256))
+        self.db.commit()
+        return sha256, stat.st_size
+
+    def get(self, path, data=None, read=True):
+        '''
+        Looks up the cached result of a pdf
+
+        Args:
+            path(str): the pdf
+            data(bytes): the pdf's contents if they were already read
+            read(bool): read the file if it has to be hashed. If False and
+                it isn't known, (None, None) is returned and it isn't
+                counted, look it up again once it has been read
+        Returns:
+            tuple(str, int): the cache key, to store a result under on a miss
+            tuple(list(any), bool): the cached row values and error flag, or None
+        '''
+        start = time.perf_counter()
+        key = self.key(path, data, read)
+        if key is None:
+            self.lookup_time += time.perf_counter() - start
+            return None, None
+        found = self.db.execute('SELECT row, error FROM rows WHERE sha256 = ? AND size = ? AND version = ?',
+                                key + (self.version,)).fetchone()
+        self.lookup_time += time.perf_counter() - start
+        if found is None:
+            self.misses += 1
+            return key, None
+        self.hits += 1
+        return key, (json.loads(found[0]), bool(found[1]))
+
+    def put(self, key, row, error):
+        '''
+        Stores the result of a pdf
+
+        Args:
+            key(tuple(str, int)): the key from get
+            row(list(any)): the extracted row's values, in column order
+            error(bool): whether any table failed to parse
+        Returns:
+            None
+        '''
+        self.db.execute('INSERT OR REPLACE INTO rows VALUES (?, ?, ?, ?, ?)',
+                        key + (self.version, json.dumps(row), int(error)))
+        self.db.commit()
+        self.stored += 1
+
+    def summary(self):
+        '''
+        One line of cache statistics for the end of a run
+        '''
+        total = self.hits + self.misses
+        rate = 100 * self.hits / total if total else 0.0
+        return (f'Cache: {self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate), '
+                f'{self.stored} rows stored, {self.hashed} files hashed, '
+                f'{self.lookup_time:.2f}s in lookups ({self.path})')
+
+    def close(self):
+        self.db.close()
@@ -1,71 +1,121 @@
 # imports
+import time
+_import_start = time.perf_counter()
 import sys
-sys.path.append("bin")
-import tabula # tabula-py
-import pandas as pd
+import logging
 import re
-import numpy as np
 from math import nan
 import math
 import os
+from bisect import bisect_left, bisect_right
+from itertools import compress, islice
 import fitz  # PyMuPDF
+from table_grid import TableGrid, find_phrase
+# pandas, multiprocessing, the output writers and the cache are imported where
+# they are used, so extracting a single pdf only pays for importing PyMuPDF
+
+# Bump this whenever a change alters the extracted values, cached rows from
+# other versions are ignored
+EXTRACTOR_VERSION = '8'
+
+# what the extractors couldn't find or parse, the command line prints it and
+# a program using the library can route it with the logging module
+logger = logging.getLogger('extract_stats')
 
 
 #============================HELPER FUNCTIONS=================================================
 # TODO: MOVE THIS TO ANOTHER FILE
 
-def get_pdf_list():
+def iter_pdf_paths(folder="PDFs"):
+    '''
+    Yields the path of each pdf in a folder as the folder is read, without
+    listing the whole folder first
+
+    Args:
+        folder(str): the folder to look in
+    Returns:
+        generator(str): the pdf paths
+    '''
+    root = os.path.abspath(folder)
+    with os.scandir(root) as entries:
+        for entry in entries:
+            # make sure they're all pdfs
+            if not entry.name.endswith('.pdf'):
+                logger.warning('Expected only pdfs, skipping %s', entry.name)
+            else:
+                yield os.path.join(root, entry.name)
+
+
+def get_pdf_list(folder="PDFs"):
     '''
     Gets a list of all files in the PDFs folder
 
     Args:
-        None
+        folder(str): the folder to look in
     Returns:
         list(str): a list of pdf paths in PDFs folder
 
     '''
-    # get the root directory
-    root = os.path.abspath(os.curdir)
-    # make a list of the files in the pdfs directory
-    file_list = os.listdir("PDFs")
-    out = []
-    out_dict = {'fname': []}
-    # get the file path for each pdf
-    for pdf in file_list:
-        # make sure they're all pdfs
-        if not pdf.endswith('.pdf'):
-            print(f'WARNING: Expected only pdfs. Got {pdf}')
-        else:
-            path = root + "\\PDFs\\" + pdf
-            out.append(path)
-            out_dict["fname"].append(pdf)
+    out = list(iter_pdf_paths(folder))
+    out_dict = {'fname': [os.path.basename(path) for path in out]}
     return out, out_dict
 
 
-def enter_values(keys, values, out_dict, idx):
+class Row:
+    '''
+    The values of one document, one slot per column of OUTPUT_COLUMNS.
+    Indexed by column name like a dict, but stored as a flat list that is
+    allocated once at the schema's size, so filling a field is a list store
+    and the row can be written, cached or sent between processes as is.
+    Columns that were never filled hold nan.
+
+    Args:
+        values (list(any)): the values in column order, None for an empty row
+    '''
+    __slots__ = ('values',)
+
+    def __init__(self, values=None):
+        if values is None:
+            values = [nan] * len(OUTPUT_COLUMNS)
+        elif len(values) != len(OUTPUT_COLUMNS):
+            raise ValueError(f'Expected {len(OUTPUT_COLUMNS)} values, got {len(values)}')
+        self.values = values
+
+    def __getitem__(self, key):
+        return self.values[COLUMN_INDEX[key]]
+
+    def __setitem__(self, key, value):
+        self.values[COLUMN_INDEX[key]] = value
+
+    def update(self, pairs):
+        values = self.values
+        for key, value in pairs:
+            values[COLUMN_INDEX[key]] = value
+
+    def to_dict(self):
+        '''
+        Returns:
+            dict(str, any): the values keyed by column name
+        '''
+        return dict(zip(OUTPUT_COLUMNS, self.values))
+
+
+def enter_values(keys, values, row):
     """
-    Helper function to append values to dict or add 
-    if they dont already exist. Modifies out_dict in
-    place
+    Helper function to add values to the row of one
+    document. Modifies row in place
 
     Args:
         keys (list(str)): A list of keys for the output dictionary
         values (list(any)): A list of values corresponding to the keys
-        out_dict: dictionary to be modified
-        idx: the index of the document
+        row (Row): the values of one document, to be modified
         
 
     Returns:
 
     """
     assert(len(keys) == len(values))
-    nfiles = len(out_dict['fname'])
-    for key, value in zip(keys, values):
-        # if we don't have an entry yet, intialize the row
-        if key not in out_dict:
-            out_dict[key] = [nan] * nfiles
-
-        out_dict[key][idx] = value
+    row.update(zip(keys, values))
 
 
 def values_to_float(values):
@@ -93,7 +143,8 @@ def values_to_float(values):
             else:
                 # otherwise output nan
                 out.append(nan)
-        elif type(v) == np.float64:
+        elif isinstance(v, float):
+            # e.g. numpy.float64
             out.append(float(v))
         else:
             raise TypeError(f"Expected a float or str. Received {type(v)}")
@@ -138,14 +189,23 @@ def split_column(column):
 
     return out
 
+def transpose_names(names, nrows):
+    '''
+    Reads a list of names laid out row by row in nrows rows back out column
+    by column (what the numpy reshape(nrows, -1).T.flatten() idiom did)
+    Args
+        names(list(str)): the names, row by row
+        nrows(int): the number of rows
+    Returns
+        list(str): the names, column by column
+    '''
+    ncols = len(names) // nrows
+    return [names[r * ncols + c] for c in range(ncols) for r in range(nrows)]
+
 def clean_page_nums(text):
     regex = "Page \d* of \d*"
     return re.sub(regex, '', text)
 
-def table_data_help(table, offset, row_width, header_width):
-    values = [item for index, item in enumerate(table[offset:]) if (index % row_width) < row_width - header_width]
-    return values
-
 def optional_field_help(txt, header, values):
     if header in txt:
         val = txt.split(header)
@@ -157,79 +217,506 @@ def optional_field_help(txt, header, values):
         
     return values
 
+# the kinds of token a table line can be
+BLANK, LABEL, NUMBER, RANGE, DASH, X, ZERO_DIVIDE = range(7)
+# what the extractors take as a table value, the tables that also use X or
+# !Zero Divide for a value add them
+VALUE_KINDS = frozenset([NUMBER, RANGE, DASH])
+SPECIAL_TOKENS = {'': BLANK, '-': DASH, 'X': X, '!Zero Divide': ZERO_DIVIDE}
+RANGE_PATTERN = re.compile(r'\d+(?:\.\d+)?-\d+(?:\.\d+)?$')
+# anything starting with a digit counts as a number, e.g. "12.5" or "3 min"
+NUMBER_PATTERN = re.compile(r'\d')
+
+def classify_token(text):
+    '''
+    The kind of token a stripped table line is
+    Args:
+        text(str): the line, stripped
+    Returns:
+        int: one of BLANK, LABEL, NUMBER, RANGE, DASH, X, ZERO_DIVIDE
+    '''
+    kind = SPECIAL_TOKENS.get(text)
+    if kind is not None:
+        return kind
+    if RANGE_PATTERN.match(text):
+        return RANGE
+    if NUMBER_PATTERN.match(text):
+        return NUMBER
+    return LABEL
+
+class TableLines(list):
+    '''
+    The lines of one table section. Still a list of the raw lines for the
+    extractors that work by position, with every line stripped and
+    classified once when the section is cut so the extractors that filter
+    values just select from the token kinds.
+
+    Args:
+        lines(list(str)): the lines of the section
+    '''
+    __slots__ = ('texts', 'kinds')
+
+    def __init__(self, lines):
+        super().__init__(lines)
+        self.texts = [line.strip() for line in self]
+        self.kinds = bytearray(classify_token(t) for t in self.texts)
+
+    def values(self, kinds=VALUE_KINDS):
+        '''
+        Args:
+            kinds(set(int)): the token kinds to keep
+        Returns:
+            list(str): the stripped lines of those kinds, in order
+        '''
+        return [t for t, k in zip(self.texts, self.kinds) if k in kinds]
+
 '''
 Returns a list of all numeric values or '-' values in an input list
 '''
 def get_values_helper(table):
-    values = []
-    for s in table:
-        s = s.strip()
-        if s == '-' or re.match('\d+.?\d*', s):
-            values.append(s)
-    return values
+    if not isinstance(table, TableLines):
+        table = TableLines(table)
+    return table.values()
+
+
+class TableSpec:
+    '''
+    A table that is read by taking its values in order, described as data:
+    which table it is, its rows and columns, which tokens are its values
+    and what to do when there are too few or too many. The field names are
+    worked out once when the spec is made, and the output slot of each one
+    when compile is called on the schema, so reading a table for a pdf is
+    a selection over its token kinds and a list store per value.
+
+    Calling the spec reads its table: spec(table_list, row), like the
+    extract functions.
+
+    Args:
+        table (int): the table's position in get_table_headers
+        rows (list): the rows in reading order. Each is a row key, or a
+            (row key, column keys) pair for a row with its own columns
+        columns (list(str)): the column keys of the rows that don't have
+            their own
+        field (str): the field name of a cell, formatted with row and column
+        kinds (set(int)): the token kinds that are the table's values
+        skip (int): values to drop before the first cell
+        fill (str): pad a table that is missing trailing cells with this.
+            None if too few values is an error
+        exact (bool): whether more values than cells is an error, otherwise
+            the extra values are ignored
+    '''
+    def __init__(self, table, rows, columns=(), field='{row}_{column}', kinds=VALUE_KINDS,
+                 skip=0, fill=None, exact=False):
+        self.table = table
+        self.field_names = []
+        for row_key in rows:
+            row_key, row_columns = row_key if isinstance(row_key, tuple) else (row_key, columns)
+            self.field_names += [field.format(row=row_key, column=c) for c in row_columns]
+        self.size = len(self.field_names)
+        # translate table over TableLines.kinds: 1 for the kinds to keep
+        self.mask = bytes(1 if k in kinds else 0 for k in range(256))
+        self.skip = skip
+        self.fill = fill
+        self.exact = exact
+        self.slots = None
+
+    def compile(self, column_index):
+        '''
+        Looks up the output slot of every field, once the schema is known
+        '''
+        self.slots = [column_index[name] for name in self.field_names]
+
+    def __call__(self, table_list, row):
+        table = table_list[self.table]
+        # one more than needed, to tell a table with extra values
+        stop = self.skip + self.size + 1
+        values = list(islice(compress(table.texts, table.kinds.translate(self.mask)), self.skip, stop))
+        if len(values) > self.size:
+            if self.exact:
+                raise ValueError(f'Expected {self.size} values, got more')
+            del values[self.size:]
+        if len(values) < self.size:
+            if self.fill is None:
+                raise ValueError(f'Expected {self.size} values, got {len(values)}')
+            values += [self.fill] * (self.size - len(values))
+        
+        out = row.values
+        for slot, value in zip(self.slots, values):
+            out[slot] = value
+        return row
+
+
+def heading_pattern(headings):
+    '''
+    Builds one regex that matches any of the headings. The alternation is
+    nested as a trie (headings sharing a prefix share a branch) so the regex
+    engine tries about one branch per character instead of every heading,
+    and always returns the longest heading that matches at a position.
+
+    Args:
+        headings(list(str)): the headings to match, must not be empty strings
+    Returns:
+        str: the regex pattern
+    '''
+    branches = {}
+    ends_here = False
+    for h in headings:
+        if h == '':
+            ends_here = True
+        else:
+            branches.setdefault(h[0], []).append(h[1:])
+    alternatives = [re.escape(c) + heading_pattern(rest) for c, rest in sorted(branches.items())]
+    if not alternatives:
+        return ''
+    pattern = alternatives[0] if len(alternatives) == 1 else '(?:' + '|'.join(alternatives) + ')'
+    # try the longer headings first, fall back to the one that ends here
+    if ends_here:
+        pattern = '(?:' + pattern + ')?'
+    return pattern
 
     
 #===============================INDIVIDUAL FIELD PROCESSING====================================
 # TODO: MOVE THIS TO ANOTHER FILE
-def extract_text_between_headings(pdf_path, start_heading, end_heading):
+class ReportText:
+    '''
+    The decoded text of one pdf, shared by all the field and table
+    extraction functions so each pdf is opened once. Pages are decoded in
+    order as the SectionIndex asks for them, so trailing pages past the
+    last heading the extractors use (hypnograms, graphs) are never decoded.
+    Close it, or use it in a with block, once extraction is done.
+
+    Args:
+        pdf_path(str): the path to the pdf to be read
+        data(bytes): the pdf's contents if they were already read into
+            memory, opened from there instead of from pdf_path
+        max_pages(int): only read this many pages from the start, e.g. 1
+            for the fields on the first page. None for all of them
+    '''
+    def __init__(self, pdf_path, data=None, max_pages=None):
+        self.path = pdf_path
+        if data is None:
+            self.document = fitz.open(pdf_path)
+        else:
+            self.document = fitz.open(stream=data, filetype="pdf")
+        self.page_count = self.document.page_count
+        if max_pages is not None:
+            self.page_count = min(self.page_count, max_pages)
+        # the pages decoded so far, all in one buffer that sections are sliced out of
+        self.pages = []
+        self.page_starts = []
+        self.text = ''
+        self._indexes = {}
+        # the page and TextPage of each decoded page, its words are made
+        # from them when a table on the page is read
+        self._textpages = {}
+        self._words = {}
+        # the ReportVariant, once get_compound_fields has fingerprinted it
+        self.variant = None
+        # seconds spent in each stage of extracting this pdf, see add_time
+        self.timings = {}
+
+    @property
+    def done(self):
+        '''
+        Whether every page has been decoded
+        '''
+        return len(self.pages) == self.page_count
+
+    def decode_next(self):
+        '''
+        Decodes the next page and appends it to the text
+
+        Returns:
+            bool: False if every page was already decoded
+        '''
+        if self.done:
+            return False
+        start = time.perf_counter()
+        page = self.document[len(self.pages)]
+        # one extraction per page, the text and the words both come from it
+        textpage = page.get_textpage(clip=page.cropbox, flags=fitz.TEXTFLAGS_TEXT)
+        page_text = page.get_text("text", textpage=textpage)
+        self._textpages[len(self.pages)] = (page, textpage)
+        self.add_time('decode', start)
+        self.page_starts.append(len(self.text))
+        self.pages.append(page_text)
+        self.text += page_text
+        return True
+
+    def decode_all(self):
+        while self.decode_next():
+            pass
+
+    @property
+    def index(self):
+        '''
+        The SectionIndex of every heading the extractors use, built on first use
+        '''
+        return self.heading_index(get_section_headings())
+
+    def heading_index(self, headings):
+        '''
+        A SectionIndex of a separate set of headings, e.g. ones that only
+        some reports have, so looking for them doesn't hold up the main
+        index. Built on first use and shared by every lookup
+
+        Args:
+            headings(list(str)): the headings, in report order
+        Returns:
+            SectionIndex
+        '''
+        key = tuple(headings)
+        if key not in self._indexes:
+            self._indexes[key] = SectionIndex(self, headings)
+        return self._indexes[key]
+
+    def words(self, page_num):
+        '''
+        The words of a page with their coordinates, from the TextPage the
+        page's text was decoded from, shared by every table on it
+
+        Args:
+            page_num(int): the page
+        Returns:
+            list(tuple): (x0, y0, x1, y1, word, block, line, word number)
+        '''
+        if page_num not in self._words:
+            while len(self.pages) <= page_num and self.decode_next():
+                pass
+            start = time.perf_counter()
+            page, textpage = self._textpages.pop(page_num)
+            self._words[page_num] = page.get_text("words", textpage=textpage)
+            self.add_time('decode', start)
+        return self._words[page_num]
+
+    def add_time(self, stage, start):
+        '''
+        Adds the time since start to a stage of extracting this pdf
+
+        Args:
+            stage(str): the stage
+            start(float): the time.perf_counter() reading when it started
+        '''
+        self.timings[stage] = self.timings.get(stage, 0.0) + time.perf_counter() - start
+
+    def table_grid(self, heading, index=None, label_from_header=False):
+        '''
+        The TableGrid of the table under heading, from its heading down to
+        the next table heading on the page
+
+        Args:
+            heading(str): the table's heading
+            index(SectionIndex): the index the heading is in, the main
+                index if None
+            label_from_header(bool): see TableGrid
+        Returns:
+            TableGrid: the table, or None if the heading wasn't found
+        '''
+        if index is None:
+            index = self.index
+        located = index.locate(heading)
+        if located is None:
+            return None
+        words = self.words(located[0])
+        found = find_phrase(words, heading)
+        if found is None:
+            return None
+        top = found[1]
+        bottom = math.inf
+        for other in get_table_headers() + CPAP_TABLE_HEADINGS:
+            below = find_phrase(words, other, top)
+            if below is not None:
+                bottom = min(bottom, below[0])
+        return TableGrid(words, top, bottom, label_from_header)
+
+    def close(self):
+        self._textpages = {}
+        if not self.document.is_closed:
+            self.document.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SectionIndex:
+    '''
+    Finds the headings of a report in a single pass over the document text
+    and records where each one occurs, so a section is a lookup and a slice
+    of the shared buffer rather than a scan of every page per heading pair.
+
+    The text is scanned as the report decodes it. A lookup only decodes
+    more pages while the heading could still be ahead: the headings are
+    given in the order they appear in a report, so one that hasn't been
+    found by the time a later heading has is taken to be missing.
+
+    Args:
+        report(ReportText): the decoded text of the pdf
+        headings(list(str)): every heading that sections will be cut at, in
+            report order
+    '''
+    def __init__(self, report, headings):
+        self.report = report
+        self.rank = {}
+        for h in headings:
+            if h:
+                self.rank.setdefault(h, len(self.rank))
+        self.positions = {h: [] for h in self.rank}
+        # (offset, rank) of every heading found, in document order
+        self.found = []
+        self.scanned = 0
+        ordered = sorted(self.rank)
+        self.longest = max((len(h) for h in ordered), default=0)
+        # the regex returns the longest heading at a position, any shorter
+        # heading that is a prefix of it also starts there
+        self.prefixes = {h: [p for p in ordered if h.startswith(p)] for h in ordered}
+        self.regex = re.compile(heading_pattern(ordered)) if ordered else None
+
+    def _scan(self):
+        '''
+        Records the headings in the text decoded since the last scan
+        '''
+        text = self.report.text
+        # a heading could run on into the next page, leave the end of the
+        # text for the next scan unless the whole document is decoded
+        limit = len(text) if self.report.done else len(text) - self.longest + 1
+        if self.regex is None or limit <= self.scanned:
+            return
+        match = self.regex.search(text, self.scanned)
+        while match and match.start() < limit:
+            for h in self.prefixes[match.group()]:
+                self.positions[h].append(match.start())
+                self.found.append((match.start(), self.rank[h]))
+            # step one character so headings inside other headings are found too
+            match = self.regex.search(text, match.start() + 1)
+        self.scanned = limit
+
+    def _decode_next(self):
+        if not self.report.decode_next():
+            return False
+        self._scan()
+        return True
+
+    def _passed(self, heading, start):
+        '''
+        Whether a heading that comes after heading in a report has been
+        found at or after start
+        '''
+        rank = self.rank[heading]
+        return any(pos >= start and r > rank for pos, r in self.found)
+
+    def find(self, heading, start=0):
+        '''
+        Offset of the first occurrence of heading at or after start
+
+        Args:
+            heading(str): the heading to look for
+            start(int): offset in the document text to search from
+        Returns:
+            int: the offset, or -1 if the heading does not occur
+        '''
+        # another index may have decoded pages since this one last looked
+        self._scan()
+        if heading not in self.positions:
+            # not one of the indexed headings, record it the slow way
+            self.report.decode_all()
+            self._scan()
+            found = []
+            pos = self.report.text.find(heading)
+            while heading and pos != -1:
+                found.append(pos)
+                pos = self.report.text.find(heading, pos + 1)
+            self.positions[heading] = found
+            self.rank[heading] = -1
+        positions = self.positions[heading]
+        while True:
+            i = bisect_left(positions, start)
+            if i < len(positions):
+                return positions[i]
+            if self._passed(heading, start) or not self._decode_next():
+                return -1
+
+    def _next_heading(self, heading, start):
+        '''
+        Offset of the first heading that comes after heading in a report,
+        at or after start. The end of the document if there is none
+        '''
+        rank = self.rank[heading]
+        later = [self.find(h, start) for h, r in self.rank.items() if r > rank]
+        later = [pos for pos in later if pos != -1]
+        if later:
+            return min(later)
+        self.report.decode_all()
+        return len(self.report.text)
+
+    def locate(self, heading):
+        '''
+        Page number and offset within that page of the first occurrence of heading
+
+        Args:
+            heading(str): the heading to look for
+        Returns:
+            tuple(int, int): (page number, offset in page), or None if missing
+        '''
+        pos = self.find(heading)
+        if pos == -1:
+            return None
+        page_num = bisect_right(self.report.page_starts, pos) - 1
+        return page_num, pos - self.report.page_starts[page_num]
+
+    def between(self, start_heading, end_heading):
+        '''
+        Text between the first occurrence of start_heading and the next
+        end_heading after it. An empty end_heading ends the section at the
+        end of the page. A missing one ends it at the next heading that
+        comes later in a report, or at the end of the document.
+
+        Args:
+            start_heading(str): The string to match before the field of interest
+            end_heading(str): the string to match after the field of interest
+        Returns:
+            str: the text of the field of interest
+        '''
+        start_pos = self.find(start_heading)
+        if start_pos == -1:
+            return ''
+        body_start = start_pos + len(start_heading)
+        if end_heading == '':
+            page_num = bisect_right(self.report.page_starts, start_pos) - 1
+            end_pos = self.report.page_starts[page_num] + len(self.report.pages[page_num])
+        else:
+            end_pos = self.find(end_heading, body_start)
+            if end_pos == -1:
+                end_pos = self._next_heading(end_heading, body_start)
+        return self.report.text[body_start:end_pos].strip()
+
+    def sections(self, headings):
+        '''
+        The text between each consecutive pair of headings
+
+        Args:
+            headings(list(str)): ordered headings, the last one only ends a section
+        Returns:
+            list(str): one section per pair
+        '''
+        return [self.between(headings[i], headings[i+1]) for i in range(len(headings) - 1)]
+
+def extract_text_between_headings(report, start_heading, end_heading):
     ''' 
     Pulls text between start_heading and end_heading, only for the first occurrence.
-    Note this is a pretty slow/inefficient way to do this because we load in the pdf
-    individually for each field. May also need to add in flexibility for variety in field
-    headers.
+    May also need to add in flexibility for variety in field headers.
 
     Args:
-        pdf_path(str): the path to the pdf to be read
+        report(ReportText): the decoded text of the pdf to be read
         start_heading(str): The string to match before the field of interest
         end_heading(str): the string to match after the field of interest
 
     Returns:
         str: the text of the field of interest
     '''
-    # Open the PDF file
-    pdf_document = fitz.open(pdf_path)
-    
-    text = ""
-    found_start = False
-    found_end = False
-
-    # Iterate through each page
-    for page_num in range(len(pdf_document)):
-        page = pdf_document.load_page(page_num)
-        page_text = page.get_text("text")
-        
-        if found_start and not found_end:
-            # Find the end position of the heading only if start heading has been found
-            end_pos = page_text.find(end_heading)
-            if end_pos != -1:
-                # Extract text up to the end heading
-                text += page_text[:end_pos]
-                found_end = True
-                break
-            else:
-                # Collect text from where start heading was found
-                text += page_text
-        else:
-            # Find the start and end positions of the headings
-            start_pos = page_text.find(start_heading)
-            end_pos = page_text.find(end_heading)
-            
-            if start_pos != -1:
-                # If end heading is found on the same page after start heading
-                if end_pos != -1 and end_pos > start_pos:
-                    text += page_text[start_pos + len(start_heading):end_pos]
-                    found_end = True
-                    break
-                else:
-                    # Collect text from the start heading to the end of the page
-                    text += page_text[start_pos + len(start_heading):]
-                    found_start = True
-
-    # If start heading is found but end heading is not found by the end of the document
-    if found_start and not found_end:
-        text += page_text
-    
-    return text.strip()
+    return report.index.between(start_heading, end_heading)
 
 
 def remove_pg_header(text):
@@ -340,8 +827,16 @@ def get_individual_headers_var_names():
 #===============================TABLE PROCESSING FUNCTIONS=====================================
 # TODO: MOVE THIS TO ANOTHER FILE
 # N.B. I realize hardcoding this is messy but hopefully if something goes wrong it will break and alert the user
-def get_table_list(pdf_path):   
-    pdf_headers = [
+def get_table_headers():
+    '''
+    Returns the headings that start each table, in document order. The
+    last heading only ends the final table.
+    Params:
+        None
+    Returns:
+        list(str): The headers to search for
+    '''
+    return [
         "STAGE DISTRIBUTION",
         "AROUSALS",
         "PERIODIC LEG MOVEMENTS",
@@ -359,28 +854,42 @@ def get_table_list(pdf_path):
         "Total Time \n(min) ",
         ""
     ]
+
+
+def get_table_list(report, etco2_heading="TABLE OF ETCO2 VALUES"):
+    '''
+    Cuts the text of each table out of the report
+    Params:
+        report (ReportText): The decoded text of the pdf
+        etco2_heading (str): the spelling of the ETCO2 table's heading in
+            this report, see fingerprint_report
+    Returns:
+        list(TableLines): the lines of each table, in get_table_headers order
+    '''
+    pdf_headers = get_table_headers()
+    pdf_headers[pdf_headers.index("TABLE OF ETCO2 VALUES")] = etco2_heading
+    sections = report.index.sections(pdf_headers)
     
     table_list = []
-    for i in range(len(pdf_headers) - 1):
-        txt = extract_text_between_headings(pdf_path, pdf_headers[i], pdf_headers[i+1])
-        
-        # Hacky fix for variation in pdfs
-        if txt == '' and pdf_headers[i] == "TABLE OF ETCO2 VALUES":
-            txt = extract_text_between_headings(pdf_path, "TABLE OF EtCO2 VALUES", pdf_headers[i+1])
-                
+    for i, txt in enumerate(sections):
+        start = time.perf_counter()
         txt = remove_pg_header(txt)
         txt = clean_page_nums(txt)
+        report.add_time('page_headers', start)
         
-        
-        table_list.append(txt.split('\n'))
+        table_list.append(TableLines(txt.split('\n')))
         
     return table_list 
 
 
-
-def extract_sleep_params(pdf_path, out_dict, idx):
+def get_sleep_params_headers_field_names():
     '''
-    Gets info from the Sleep Parameters sheet, updates the output dictionary.
+    Returns the header names for the Sleep Parameters fields.
+    Params:
+        None
+    Returns:
+        list(str): The headers to search for
+        list(str): The variable names to enter into the spreadsheet
     '''
     pdf_headers = [
     "Time in Bed (TIB):",
@@ -402,125 +911,137 @@ def extract_sleep_params(pdf_path, out_dict, idx):
     'sleep_latency'
     ]
 
+    return pdf_headers, field_names
+
+
+def get_section_headings():
+    '''
+    Returns every heading the extraction functions cut sections at, in the
+    order they appear in a report, so the SectionIndex of a report can find
+    all of them in one pass.
+    Params:
+        None
+    Returns:
+        list(str): The headers to search for
+    '''
+    individual_headers, _ = get_individual_headers_var_names()
+    sleep_params_headers, _ = get_sleep_params_headers_field_names()
+    table_headers = get_table_headers()
+    # the ETCO2 heading casing varies between pdfs, either comes before TcCO2
+    etco2 = table_headers.index("TABLE OF ETCO2 VALUES")
+    table_headers.insert(etco2 + 1, "TABLE OF EtCO2 VALUES")
+    return individual_headers + sleep_params_headers + table_headers
+
+
+def extract_sleep_params(report, row):
+    '''
+    Gets info from the Sleep Parameters sheet, updates the output dictionary.
+    '''
+    pdf_headers, field_names = get_sleep_params_headers_field_names()
+
     exclude = []
     values = []
 
     for i in range(len(pdf_headers) - 1):
         if not (i in exclude):
-            txt = extract_text_between_headings(pdf_path, pdf_headers[i], pdf_headers[i+1])
+            txt = extract_text_between_headings(report, pdf_headers[i], pdf_headers[i+1])
             values.append(txt)
 
     # values = values_to_float(values)
-    enter_values(field_names, values, out_dict, idx)
-    return out_dict
-
-def extract_stage_dist(table_list, out_dict, idx):
-    
-    table = table_list[0]
-    if 'Transitional' in [s.strip() for s in table]:
-        field_names = [
-            'time_stage_transitional', 'percentage_stage_transitional', 'latency_stage_transitional',
-            'time_stage_rem', 'percentage_stage_rem', 'latency_stage_rem',
-            'time_stage_nrem', 'percentage_stage_nrem',
-            'time_stage_wake'
-        ]
-        
-    else:
-        field_names = [
-        # stage distribution
-        'time_stage_n1', 'percentage_stage_n1', 'latency_stage_n1',
-        'time_stage_n2', 'percentage_stage_n2', 'latency_stage_n2',
-        'time_stage_3', 'percentage_stage_3', 'latency_stage_3',
-        'time_stage_4', 'percentage_stage_4', 'latency_stage_4',
-        'time_stage_n3', 'percentage_stage_n3', 'latency_stage_n3',
-        'time_stage_rem', 'percentage_stage_rem', 'latency_stage_rem',
-        'time_stage_nrem', 'percentage_stage_nrem',
-        'time_stage_wake'
-        ]
-    values = get_values_helper(table)
-    enter_values(field_names, values, out_dict, idx)
-    return out_dict
-
-
-def extract_arousals(table_list, out_dict, idx):
-    field_headers = [   
-    # arousals
-    'number_arousals', 'number_arousals_rem', 
-    'number_arousals_nrem', 
-    'index_arousals', 
-    'index_arousals_rem', 
-    'index_arousals_nrem'
-    ]
-
-    field_names = ['total_' + v for v in field_headers] + ['apnea_hypopnea_' + v for v in field_headers] + ['resp_dist_' + v for v in field_headers]
-
-    table = table_list[1]
-    # values = table_data_help(table, 10, 8, 2)
-    
-    values = get_values_helper(table)
-    enter_values(field_names, values, out_dict, idx)
-    return out_dict
-
-
-def extract_leg_mvmts(table_list, out_dict, idx):
-    field_names = [
-    # periodic leg movements
-    'number_periodic_limb_movements', 'index_periodic_limb_movements',
-    'number_periodic_limb_movements_arousal', 'index_periodic_limb_movements_arousal'
-    ]
+    enter_values(field_names, values, row)
+    return row
+
+# N.B. the tables that are read by taking their values in order are
+# described by a TableSpec each. Field names are built once at import, the
+# extract functions and get_output_columns share them
+
+STAGE_DIST_SPEC = TableSpec(0, [
+        ('n1', ['time', 'percentage', 'latency']),
+        ('n2', ['time', 'percentage', 'latency']),
+        ('3', ['time', 'percentage', 'latency']),
+        ('4', ['time', 'percentage', 'latency']),
+        ('n3', ['time', 'percentage', 'latency']),
+        ('rem', ['time', 'percentage', 'latency']),
+        ('nrem', ['time', 'percentage']),
+        ('wake', ['time'])],
+    field='{column}_stage_{row}', exact=True)
+
+# pediatric staging
+STAGE_DIST_TRANSITIONAL_SPEC = TableSpec(0, [
+        ('transitional', ['time', 'percentage', 'latency']),
+        ('rem', ['time', 'percentage', 'latency']),
+        ('nrem', ['time', 'percentage']),
+        ('wake', ['time'])],
+    field='{column}_stage_{row}', exact=True)
+
+def extract_stage_dist(table_list, row, spec=None):
+    if spec is None:
+        if 'Transitional' in table_list[0].texts:
+            spec = STAGE_DIST_TRANSITIONAL_SPEC
+        else:
+            spec = STAGE_DIST_SPEC
+    return spec(table_list, row)
 
-    table = table_list[2]
-    # values = table[4:6] + table[7:9]
-    values = get_values_helper(table)[:4]
-    enter_values(field_names, values, out_dict, idx)
-    return out_dict
 
+AROUSALS_SPEC = TableSpec(1, ['total', 'apnea_hypopnea', 'resp_dist'],
+    ['number_arousals', 'number_arousals_rem', 'number_arousals_nrem',
+     'index_arousals', 'index_arousals_rem', 'index_arousals_nrem'],
+    exact=True)
 
-def extract_resp_analysis(table_list, out_dict, idx):
-    field_names = [    
-    # minutes sleep/body position
-    'time_supine', 'percent_supine', 'time_non_supine', 'percent_non_supine',
-    'time_supine_rem', 'percent_supine_rem', 'time_non_supine_rem', 'percent_non_supine_rem',
-    'time_supine_nrem', 'percent_supine_nrem', 'time_non_supine_nrem', 'percent_non_supine_nrem'
-    ]
-    
-    table = table_list[3]
-    # values = table_data_help(table, 11, 5, 1)
-    # values = values[:12]
-    # values = get_values_helper(table)
-    values = [v.strip() for v in table if v.strip() == '-' or re.match('\d+.?\d*', v.strip()) or v.strip() == '!Zero Divide']
-    values = values[1:13]
-    enter_values(field_names, values, out_dict, idx)
-    return out_dict
+LEG_MVMTS_SPEC = TableSpec(2, ['periodic_limb_movements', 'periodic_limb_movements_arousal'],
+    ['number', 'index'], field='{column}_{row}')
 
-def extract_baseline_ranges(table_list, out_dict, idx):
+# minutes sleep/body position, the first value is the total time
+RESP_ANALYSIS_SPEC = TableSpec(3, ['', '_rem', '_nrem'],
+    ['time_supine', 'percent_supine', 'time_non_supine', 'percent_non_supine'],
+    field='{column}{row}', kinds=VALUE_KINDS | {ZERO_DIVIDE}, skip=1)
 
-    table = table_list[4]
-    
-    if 'Transcutaneous CO2 ' in table or 'TCO2 ' in table:
-        field_headers = ["oxygen_saturation",
+BASELINE_TCCO2_FIELD_HEADERS = ["oxygen_saturation",
                     "respiratory_rate",
                     "tcCO2",
                     "end_tidal_CO2",
                     "heart_rate"
                     ]
 
-    else:
-        field_headers = ["oxygen_saturation",
+BASELINE_FIELD_HEADERS = ["oxygen_saturation",
                     "respiratory_rate",
                     "end_tidal_CO2",
                     "heart_rate"
                     ]
 
+def baseline_field_names(field_headers):
     field_names = ['room_air_rem_' + v for v in field_headers] + ['room_air_nrem_' + v for v in field_headers] + ['cpap_o2_rem_' + v for v in field_headers] + ['cpap_o2_nrem_' + v for v in field_headers]
     
-    field_names = list(np.array(field_names).reshape(4, len(field_headers)).T.flatten())
+    return transpose_names(field_names, 4)
+
+BASELINE_TCCO2_FIELD_NAMES = baseline_field_names(BASELINE_TCCO2_FIELD_HEADERS)
+BASELINE_FIELD_NAMES = baseline_field_names(BASELINE_FIELD_HEADERS)
+
+def has_baseline_tcco2(table):
+    '''
+    Whether a baseline ranges table has a TcCO2 row
+    '''
+    return 'Transcutaneous CO2 ' in table or 'TCO2 ' in table
+
+def extract_baseline_ranges(table_list, row, tcco2=None):
+
+    table = table_list[4]
+    
+    if tcco2 is None:
+        tcco2 = has_baseline_tcco2(table)
+    if tcco2:
+        field_headers = BASELINE_TCCO2_FIELD_HEADERS
+        field_names = BASELINE_TCCO2_FIELD_NAMES
+
+    else:
+        field_headers = BASELINE_FIELD_HEADERS
+        field_names = BASELINE_FIELD_NAMES
     
     # values = table_data_help(table, 8, 5, 1)
     # while len(values) < len(field_names):
     #     values = values + ['-']
     
-    values = [v.strip() for v in table if v.strip() == '-' or re.match('\d+-?\d*', v.strip()) or v.strip() == 'X']
+    values = table.values(VALUE_KINDS | {X})
 
     # Kinda hacky, deals with variations in the baseline ranges table: sometimes has an extra row, sometimes columns are not filled in
     
@@ -529,8 +1050,8 @@ def extract_baseline_ranges(table_list, out_dict, idx):
         values = []
         # 0 
         table_type = 0
-        for i, s in enumerate(table):
-            if i+1 <len(table) and re.match('\d+-?\d*', s.strip()) and table[i + 1].strip() == '':
+        for i in range(len(table) - 1):
+            if table.kinds[i] in (NUMBER, RANGE) and table.kinds[i + 1] == BLANK:
                 table_type = 1
         
         i = 0
@@ -546,12 +1067,11 @@ def extract_baseline_ranges(table_list, out_dict, idx):
                 
             
         
-    enter_values(field_names, values, out_dict, idx)
+    enter_values(field_names, values, row)
         
-    return out_dict
+    return row
 
-def extract_spo2_ranges_sleep(table_list, out_dict, idx):
-    field_names = [# SpO2 RANGES IN SLEEP
+SPO2_RANGES_SLEEP_FIELD_NAMES = [# SpO2 RANGES IN SLEEP
     'time_sleep_spo2_96_100', 'percent_sleep_spo2_96_100', 'time_sleep_gteq_spo2_96_100', 'percent_sleep_gteq_spo2_96_100',
     'time_sleep_spo2_92_96', 'percent_sleep_spo2_92_96', 'time_sleep_gteq_spo2_92_96', 'percent_sleep_gteq_spo2_92_96',
     'time_sleep_spo2_88_92', 'percent_sleep_spo2_88_92', 'time_sleep_gteq_spo2_88_92', 'percent_sleep_gteq_spo2_88_92',
@@ -561,121 +1081,129 @@ def extract_spo2_ranges_sleep(table_list, out_dict, idx):
     'time_sleep_spo2_50_60', 'percent_sleep_spo2_50_60', 'time_sleep_gteq_spo2_50_60', 'percent_sleep_gteq_spo2_50_60',
     'time_sleep_spo2_0_50', 'percent_sleep_spo2_0_50', 'time_sleep_gteq_spo2_0_50', 'percent_sleep_gteq_spo2_0_50',
     # 'time_sleep_spo2_excluded_lt_60_gt_110', 'percent_sleep_spo2_excluded_lt_60_gt_110'
-    ]
-    
-    table = table_list[5]
-    values = table_data_help(table, 11, 5, 1)
-    values = values[:4*8]
-    
-    enter_values(field_names, values, out_dict, idx)
-    return out_dict
+]
 
+SPO2_RANGE_LABELS = ["96-100", "92-96", "88-92", "82-88", "75-82", "60-75", "50-60", "0-50"]
 
-def extract_resp_events(table_list, out_dict, idx):
-    field_headers = [   
-    # respiratory events
-    'min_length',
-    'max_length',
-    'usual_desaturations',
-    'greatest_desaturation'
-    ]
-
-    field_names = [v + '_rem' for v in field_headers] + [v + '_nrem' for v in field_headers]
-    field_names = [v + '_obs' for v in field_names] + [v + '_cent' for v in field_names]
+def grid_values(grid, labels, ncols):
+    '''
+    Reads the rows of a table from its TableGrid
+    Args:
+        grid (TableGrid): the table, or None
+        labels (list(str)): the row labels, in output order
+        ncols (int): the number of value columns the table should have
+    Returns:
+        list(str): the cells of each row in turn, or None if the table isn't
+            laid out that way
+    '''
+    if grid is None or grid.ncols != ncols:
+        return None
+    values = []
+    for label in labels:
+        cells = grid.row(label)
+        if cells is None:
+            return None
+        values += cells
+    return values
 
-    field_names = list(np.array(field_names).reshape(4,4).T.flatten())
-    
-    table = table_list[6]
-    values = [v.strip() for v in table if v.strip() == '-' or re.match('\d+.?\d*', v.strip())]
+def extract_spo2_ranges_sleep(table_list, row, report=None):
+    field_names = SPO2_RANGES_SLEEP_FIELD_NAMES
     
-    while len(values) < 16:
-        values = values + ['-']
-    
-    values = values[:16]
-    
-    enter_values(field_names, values, out_dict, idx)
-    return out_dict
+    if report is None:
+        # the cells can only be read from the page layout
+        return row
+    values = grid_values(report.table_grid("SpO2 RANGES IN SLEEP"), SPO2_RANGE_LABELS, 4)
+    if values is None:
+        raise ValueError('SpO2 RANGES IN SLEEP is not laid out as expected')
     
+    enter_values(field_names, values, row)
+    return row
 
-def extract_desat_table(table_list, out_dict, idx):
-    field_headers = [   
-    # respiratory events
-    'avg_o2_saturation',
-    'total_num_desaturation',
-    'o2_desat_index',
-    'avg_lowest_osat_desat',
-    'nadir_sao2',
-    'time_sat_below_90'
-    ]
 
-    field_names = [v + '_wake' for v in field_headers] + [v + '_nrem' for v in field_headers] + [v + '_rem' for v in field_headers] + [v + '_total' for v in field_headers]  
-    field_names = list(np.array(field_names).reshape(4,6).T.flatten())
-    
-    table = table_list[7]
-    
-    values = [v for v in table if re.match("-", v) or re.match('\d+.?\d*', v.strip())]
-    values = values[:24]
-    
-    enter_values(field_names, values, out_dict, idx)
-    return out_dict
-    
-def extract_etco2_vals(table_list, out_dict, idx):
-    table = table_list[8]
+# respiratory events, tables with fewer columns are padded with '-'
+RESP_EVENTS_SPEC = TableSpec(6, ['min_length', 'max_length', 'usual_desaturations', 'greatest_desaturation'],
+    ['rem_obs', 'nrem_obs', 'rem_cent', 'nrem_cent'], fill='-')
 
-    field_names = [
-        'time_wake_etco2_20_30', 'percent_wake_etco2_20_30', 'time_nrem_etco2_20_30', 'percent_nrem_etco2_20_30', 'time_rem_etco2_20_30', 'percent_rem_etco2_20_30', 'time_total_etco2_20_30', 'percent_total_etco2_20_30',
-        'time_wake_etco2_30_45', 'percent_wake_etco2_30_45', 'time_nrem_etco2_30_45', 'percent_nrem_etco2_30_45', 'time_rem_etco2_30_45', 'percent_rem_etco2_30_45', 'time_total_etco2_30_45', 'percent_total_etco2_30_45',
-        'time_wake_etco2_45_50', 'percent_wake_etco2_45_50', 'time_nrem_etco2_45_50', 'percent_nrem_etco2_45_50', 'time_rem_etco2_45_50', 'percent_rem_etco2_45_50', 'time_total_etco2_45_50', 'percent_total_etco2_45_50',
-        'time_wake_etco2_50_55', 'percent_wake_etco2_50_55', 'time_nrem_etco2_50_55', 'percent_nrem_etco2_50_55', 'time_rem_etco2_50_55', 'percent_rem_etco2_50_55', 'time_total_etco2_50_55', 'percent_total_etco2_50_55',
-        'time_wake_etco2_55_60', 'percent_wake_etco2_55_60', 'time_nrem_etco2_55_60', 'percent_nrem_etco2_55_60', 'time_rem_etco2_55_60', 'percent_rem_etco2_55_60', 'time_total_etco2_55_60', 'percent_total_etco2_55_60',
-        'time_wake_etco2_60_65', 'percent_wake_etco2_60_65', 'time_nrem_etco2_60_65', 'percent_nrem_etco2_60_65', 'time_rem_etco2_60_65', 'percent_rem_etco2_60_65', 'time_total_etco2_60_65', 'percent_total_etco2_60_65'
-        ]
-    
-    values = table[27:]
-    indices_to_remove = {8, 17, 26, 35, 44, 53, 54, 55}
-    values = [item for index, item in enumerate(values) if index not in indices_to_remove]
-    values = values[:56]
+DESAT_SPEC = TableSpec(7, [
+        'avg_o2_saturation',
+        'total_num_desaturation',
+        'o2_desat_index',
+        'avg_lowest_osat_desat',
+        'nadir_sao2',
+        'time_sat_below_90'],
+    ['wake', 'nrem', 'rem', 'total'])
     
-    if values == []:
-        print('   No ETCO2 Values table found \n')
-        return out_dict
+ETCO2_FIELD_NAMES = [
+    'time_wake_etco2_20_30', 'percent_wake_etco2_20_30', 'time_nrem_etco2_20_30', 'percent_nrem_etco2_20_30', 'time_rem_etco2_20_30', 'percent_rem_etco2_20_30', 'time_total_etco2_20_30', 'percent_total_etco2_20_30',
+    'time_wake_etco2_30_45', 'percent_wake_etco2_30_45', 'time_nrem_etco2_30_45', 'percent_nrem_etco2_30_45', 'time_rem_etco2_30_45', 'percent_rem_etco2_30_45', 'time_total_etco2_30_45', 'percent_total_etco2_30_45',
+    'time_wake_etco2_45_50', 'percent_wake_etco2_45_50', 'time_nrem_etco2_45_50', 'percent_nrem_etco2_45_50', 'time_rem_etco2_45_50', 'percent_rem_etco2_45_50', 'time_total_etco2_45_50', 'percent_total_etco2_45_50',
+    'time_wake_etco2_50_55', 'percent_wake_etco2_50_55', 'time_nrem_etco2_50_55', 'percent_nrem_etco2_50_55', 'time_rem_etco2_50_55', 'percent_rem_etco2_50_55', 'time_total_etco2_50_55', 'percent_total_etco2_50_55',
+    'time_wake_etco2_55_60', 'percent_wake_etco2_55_60', 'time_nrem_etco2_55_60', 'percent_nrem_etco2_55_60', 'time_rem_etco2_55_60', 'percent_rem_etco2_55_60', 'time_total_etco2_55_60', 'percent_total_etco2_55_60',
+    'time_wake_etco2_60_65', 'percent_wake_etco2_60_65', 'time_nrem_etco2_60_65', 'percent_nrem_etco2_60_65', 'time_rem_etco2_60_65', 'percent_rem_etco2_60_65', 'time_total_etco2_60_65', 'percent_total_etco2_60_65'
+]
+
+ETCO2_DISCARDED_FIELD_NAMES = ['time_wake_etco2_lt_20_gt_65', 'percent_wake_etco2_lt_20_gt_65', 'time_nrem_etco2_lt_20_gt_65', 'percent_nrem_etco2_lt_20_gt_65', 'time_rem_etco2_lt_20_gt_65', 'percent_rem_etco2_lt_20_gt_65', 'time_total_etco2_lt_20_gt_65', 'percent_total_etco2_lt_20_gt_65']
+
+CO2_RANGE_LABELS = ["20-30", "30-45", "45-50", "50-55", "55-60", "60-65"]
+
+def co2_grid_values(report, headings):
+    '''
+    Reads an ETCO2 or TcCO2 values table from its TableGrid
+    Args:
+        report (ReportText): The decoded text of the pdf
+        headings (list(str)): the spellings of the table's heading
+    Returns:
+        list(str): the range rows then the discarded (<20 or >65) row if
+            there is one
+    '''
+    for heading in headings:
+        grid = report.table_grid(heading)
+        values = grid_values(grid, CO2_RANGE_LABELS, 8)
+        if values is not None:
+            discarded = grid.row("<20", prefix=True)
+            return values + (discarded if discarded is not None else [])
+    raise ValueError(f'{headings[0]} is not laid out as expected')
+
+def extract_etco2_vals(table_list, row, report=None, headings=None):
+    field_names = ETCO2_FIELD_NAMES
+    
+    if report is None:
+        return row
+    if headings is None:
+        headings = ["TABLE OF ETCO2 VALUES", "TABLE OF EtCO2 VALUES"]
+    values = co2_grid_values(report, headings)
     
     if len(values) == 56:
-        discarded_data_names = ['time_wake_etco2_lt_20_gt_65', 'percent_wake_etco2_lt_20_gt_65', 'time_nrem_etco2_lt_20_gt_65', 'percent_nrem_etco2_lt_20_gt_65', 'time_rem_etco2_lt_20_gt_65', 'percent_rem_etco2_lt_20_gt_65', 'time_total_etco2_lt_20_gt_65', 'percent_total_etco2_lt_20_gt_65']
-        field_names = field_names + discarded_data_names
+        field_names = field_names + ETCO2_DISCARDED_FIELD_NAMES
         
-    enter_values(field_names, values, out_dict, idx)
-    return out_dict
-    
-def extract_tcco2_vals(table_list, out_dict, idx):
-    table = table_list[9]
-    field_names = [
-        'time_wake_tcco2_20_30', 'percent_wake_tcco2_20_30', 'time_nrem_tcco2_20_30', 'percent_nrem_tcco2_20_30', 'time_rem_tcco2_20_30', 'percent_rem_tcco2_20_30', 'time_total_tcco2_20_30', 'percent_total_tcco2_20_30',
-        'time_wake_tcco2_30_45', 'percent_wake_tcco2_30_45', 'time_nrem_tcco2_30_45', 'percent_nrem_tcco2_30_45', 'time_rem_tcco2_30_45', 'percent_rem_tcco2_30_45', 'time_total_tcco2_30_45', 'percent_total_tcco2_30_45',
-        'time_wake_tcco2_45_50', 'percent_wake_tcco2_45_50', 'time_nrem_tcco2_45_50', 'percent_nrem_tcco2_45_50', 'time_rem_tcco2_45_50', 'percent_rem_tcco2_45_50', 'time_total_tcco2_45_50', 'percent_total_tcco2_45_50',
-        'time_wake_tcco2_50_55', 'percent_wake_tcco2_50_55', 'time_nrem_tcco2_50_55', 'percent_nrem_tcco2_50_55', 'time_rem_tcco2_50_55', 'percent_rem_tcco2_50_55', 'time_total_tcco2_50_55', 'percent_total_tcco2_50_55',
-        'time_wake_tcco2_55_60', 'percent_wake_tcco2_55_60', 'time_nrem_tcco2_55_60', 'percent_nrem_tcco2_55_60', 'time_rem_tcco2_55_60', 'percent_rem_tcco2_55_60', 'time_total_tcco2_55_60', 'percent_total_tcco2_55_60',
-        'time_wake_tcco2_60_65', 'percent_wake_tcco2_60_65', 'time_nrem_tcco2_60_65', 'percent_nrem_tcco2_60_65', 'time_rem_tcco2_60_65', 'percent_rem_tcco2_60_65', 'time_total_tcco2_60_65', 'percent_total_tcco2_60_65'
-        ]
-    
-    values = table[27:]
-    indices_to_remove = {8, 17, 26, 35, 44, 53, 54, 55}
-    values = [item for index, item in enumerate(values) if index not in indices_to_remove]
-    values = values[:56]
-    
-    if values == []:
-        print('   No TcCO2 Values table found \n')
-        return out_dict
+    enter_values(field_names, values, row)
+    return row
+    
+TCCO2_FIELD_NAMES = [
+    'time_wake_tcco2_20_30', 'percent_wake_tcco2_20_30', 'time_nrem_tcco2_20_30', 'percent_nrem_tcco2_20_30', 'time_rem_tcco2_20_30', 'percent_rem_tcco2_20_30', 'time_total_tcco2_20_30', 'percent_total_tcco2_20_30',
+    'time_wake_tcco2_30_45', 'percent_wake_tcco2_30_45', 'time_nrem_tcco2_30_45', 'percent_nrem_tcco2_30_45', 'time_rem_tcco2_30_45', 'percent_rem_tcco2_30_45', 'time_total_tcco2_30_45', 'percent_total_tcco2_30_45',
+    'time_wake_tcco2_45_50', 'percent_wake_tcco2_45_50', 'time_nrem_tcco2_45_50', 'percent_nrem_tcco2_45_50', 'time_rem_tcco2_45_50', 'percent_rem_tcco2_45_50', 'time_total_tcco2_45_50', 'percent_total_tcco2_45_50',
+    'time_wake_tcco2_50_55', 'percent_wake_tcco2_50_55', 'time_nrem_tcco2_50_55', 'percent_nrem_tcco2_50_55', 'time_rem_tcco2_50_55', 'percent_rem_tcco2_50_55', 'time_total_tcco2_50_55', 'percent_total_tcco2_50_55',
+    'time_wake_tcco2_55_60', 'percent_wake_tcco2_55_60', 'time_nrem_tcco2_55_60', 'percent_nrem_tcco2_55_60', 'time_rem_tcco2_55_60', 'percent_rem_tcco2_55_60', 'time_total_tcco2_55_60', 'percent_total_tcco2_55_60',
+    'time_wake_tcco2_60_65', 'percent_wake_tcco2_60_65', 'time_nrem_tcco2_60_65', 'percent_nrem_tcco2_60_65', 'time_rem_tcco2_60_65', 'percent_rem_tcco2_60_65', 'time_total_tcco2_60_65', 'percent_total_tcco2_60_65'
+]
+
+TCCO2_DISCARDED_FIELD_NAMES = ['time_wake_tcco2_lt_20_gt_65', 'percent_wake_tcco2_lt_20_gt_65', 'time_nrem_tcco2_lt_20_gt_65', 'percent_nrem_tcco2_lt_20_gt_65', 'time_rem_tcco2_lt_20_gt_65', 'percent_rem_tcco2_lt_20_gt_65', 'time_total_tcco2_lt_20_gt_65', 'percent_total_tcco2_lt_20_gt_65']
+
+def extract_tcco2_vals(table_list, row, report=None):
+    field_names = TCCO2_FIELD_NAMES
+    
+    if report is None:
+        return row
+    values = co2_grid_values(report, ["TABLE OF TcCO2 VALUES"])
     
     if len(values) == 56:
-        discarded_data_names = ['time_wake_tcco2_lt_20_gt_65', 'percent_wake_tcco2_lt_20_gt_65', 'time_nrem_tcco2_lt_20_gt_65', 'percent_nrem_tcco2_lt_20_gt_65', 'time_rem_tcco2_lt_20_gt_65', 'percent_rem_tcco2_lt_20_gt_65', 'time_total_tcco2_lt_20_gt_65', 'percent_total_tcco2_lt_20_gt_65']
-        field_names = field_names + discarded_data_names
+        field_names = field_names + TCCO2_DISCARDED_FIELD_NAMES
     
-    enter_values(field_names, values, out_dict, idx)
-    return out_dict
+    enter_values(field_names, values, row)
+    return row
 
-def extract_resp_events_stage(table_list, out_dict, idx):
-    field_headers = [   
+RESP_EVENTS_TYPE_HEADERS = [   
     # respiratory events
     'total_obst',
     'obs_apnea',
@@ -685,113 +1213,30 @@ def extract_resp_events_stage(table_list, out_dict, idx):
     'cen_apnea',
     'cen_hypopnea',
     'total_mixed'
-    ]
+]
 
-    field_names = [v + '_num' for v in field_headers] + [v + '_idx' for v in field_headers]
-    field_names = [v + '_total' for v in field_names] + [v + '_rem' for v in field_names] + [v + '_nrem' for v in field_names]
+RESP_EVENTS_STAGE_SPEC = TableSpec(10, RESP_EVENTS_TYPE_HEADERS,
+    ['num_total', 'idx_total', 'num_rem', 'idx_rem', 'num_nrem', 'idx_nrem'], exact=True)
 
-    field_names = list(np.array(field_names).reshape(6,8).T.flatten())
+RESP_EVENTS_BODY_POSITION_SPEC = TableSpec(11, RESP_EVENTS_TYPE_HEADERS,
+    ['num_total', 'idx_total', 'num_sup', 'idx_sup', 'num_nsup', 'idx_nsup'], exact=True)
 
-    table = table_list[10]
-    values = [v.strip() for v in table if re.match("-", v) or re.match('\d+.?\d*', v.strip())]
-    
-    enter_values(field_names, values, out_dict, idx)
-    return out_dict
-    
-def extract_resp_events_body_position(table_list, out_dict, idx):
-    field_headers = [   
-    # respiratory events
-    'total_obst',
-    'obs_apnea',
-    'obs_hypopnea',
-    'total_rera',
-    'total_cent',
-    'cen_apnea',
-    'cen_hypopnea',
-    'total_mixed'
-    ]
+RESP_EVENTS_STAGE_POS_SPEC = TableSpec(12, RESP_EVENTS_TYPE_HEADERS,
+    ['num_sup_rem', 'idx_sup_rem', 'num_nsup_rem', 'idx_nsup_rem',
+     'num_sup_nrem', 'idx_sup_nrem', 'num_nsup_nrem', 'idx_nsup_nrem'], fill='-')
 
-    field_names = [v + '_num' for v in field_headers] + [v + '_idx' for v in field_headers]
-    field_names = [v + '_total' for v in field_names] + [v + '_sup' for v in field_names] + [v + '_nsup' for v in field_names]
+# apnea/hypopnea summary, by event type then stage and position
+SUMMARY_ROW_SUFFIXES = ['', '_rem', '_nrem', '_supine', '_non_supine',
+                        '_rem_supine', '_rem_non_supine', '_nrem_supine', '_nrem_non_supine']
 
-    field_names = list(np.array(field_names).reshape(6,8).T.flatten())
-    
-    table = table_list[11]
-    values = [v.strip() for v in table if re.match("-", v) or re.match('\d+.?\d*', v.strip())]
-    
-    enter_values(field_names, values, out_dict, idx)
-    return out_dict
-    
-def extract_resp_events_stage_pos(table_list, out_dict, idx):
-    field_headers = [   
-    # respiratory events
-    'total_obst',
-    'obs_apnea',
-    'obs_hypopnea',
-    'total_rera',
-    'total_cent',
-    'cen_apnea',
-    'cen_hypopnea',
-    'total_mixed'
-    ]
-
-    field_names = [v + '_num' for v in field_headers] + [v + '_idx' for v in field_headers]
-    field_names = [v + '_sup' for v in field_names] + [v + '_nsup' for v in field_names]
-    field_names = [v + '_rem' for v in field_names] + [v + '_nrem' for v in field_names]
-
-    field_names = list(np.array(field_names).reshape(8,8).T.flatten())
-    
-    table = table_list[12]
-    values = table[20:]
-    values = [v.strip() for v in table if re.match("-", v) or re.match('\d+.?\d*', v.strip())]
-    while len(values) < 64:
-        values = values + ['-']
-    values = values[:64]
-    enter_values(field_names, values, out_dict, idx)
-    
-    return out_dict
-    
-def extract_summary_table(table_list, out_dict, idx):
-    field_names = [
-    'number_total_respiratory_events', 'index_total_respiratory_events', 'minimum_length_total_respiratory_events', 'maximum_length_total_respiratory_events',
-    'number_obstructive_respiratory_events', 'index_obstructive_respiratory_events', 'minimum_length_obstructive_respiratory_events', 'maximum_length_obstructive_respiratory_events',
-    'number_obstructive_rem_respiratory_events', 'index_obstructive_rem_respiratory_events', 'minimum_length_obstructive_rem_respiratory_events', 'maximum_length_obstructive_rem_respiratory_events',
-    'number_obstructive_nrem_respiratory_events', 'index_obstructive_nrem_respiratory_events', 'minimum_length_obstructive_nrem_respiratory_events', 'maximum_length_obstructive_nrem_respiratory_events',
-    'number_obstructive_supine_respiratory_events', 'index_obstructive_supine_respiratory_events', 'minimum_length_obstructive_supine_respiratory_events', 'maximum_length_obstructive_supine_respiratory_events',
-    'number_obstructive_non_supine_respiratory_events', 'index_obstructive_non_supine_respiratory_events', 'minimum_length_obstructive_non_supine_respiratory_events', 'maximum_length_obstructive_non_supine_respiratory_events',
-    'number_obstructive_rem_supine_respiratory_events', 'index_obstructive_rem_supine_respiratory_events', 'minimum_length_obstructive_rem_supine_respiratory_events', 'maximum_length_obstructive_rem_supine_respiratory_events',
-    'number_obstructive_rem_non_supine_respiratory_events', 'index_obstructive_rem_non_supine_respiratory_events', 'minimum_length_obstructive_rem_non_supine_respiratory_events', 'maximum_length_obstructive_rem_non_supine_respiratory_events',
-    'number_obstructive_nrem_supine_respiratory_events', 'index_obstructive_nrem_supine_respiratory_events', 'minimum_length_obstructive_nrem_supine_respiratory_events', 'maximum_length_obstructive_nrem_supine_respiratory_events',
-    'number_obstructive_nrem_non_supine_respiratory_events', 'index_obstructive_nrem_non_supine_respiratory_events', 'minimum_length_obstructive_nrem_non_supine_respiratory_events', 'maximum_length_obstructive_nrem_non_supine_respiratory_events',
-
-    'number_rera_respiratory_events', 'index_rera_respiratory_events', 'minimum_length_rera_respiratory_events', 'maximum_length_rera_respiratory_events',
-    'number_rera_rem_respiratory_events', 'index_rera_rem_respiratory_events', 'minimum_length_rera_rem_respiratory_events', 'maximum_length_rera_rem_respiratory_events',
-    'number_rera_nrem_respiratory_events', 'index_rera_nrem_respiratory_events', 'minimum_length_rera_nrem_respiratory_events', 'maximum_length_rera_nrem_respiratory_events',
-    'number_rera_supine_respiratory_events', 'index_rera_supine_respiratory_events', 'minimum_length_rera_supine_respiratory_events', 'maximum_length_rera_supine_respiratory_events',
-    'number_rera_non_supine_respiratory_events', 'index_rera_non_supine_respiratory_events', 'minimum_length_rera_non_supine_respiratory_events', 'maximum_length_rera_non_supine_respiratory_events',
-    'number_rera_rem_supine_respiratory_events', 'index_rera_rem_supine_respiratory_events', 'minimum_length_rera_rem_supine_respiratory_events', 'maximum_length_rera_rem_supine_respiratory_events',
-    'number_rera_rem_non_supine_respiratory_events', 'index_rera_rem_non_supine_respiratory_events', 'minimum_length_rera_rem_non_supine_respiratory_events', 'maximum_length_rera_rem_non_supine_respiratory_events',
-    'number_rera_nrem_supine_respiratory_events', 'index_rera_nrem_supine_respiratory_events', 'minimum_length_rera_nrem_supine_respiratory_events', 'maximum_length_rera_nrem_supine_respiratory_events',
-    'number_rera_nrem_non_supine_respiratory_events', 'index_rera_nrem_non_supine_respiratory_events', 'minimum_length_rera_nrem_non_supine_respiratory_events', 'maximum_length_rera_nrem_non_supine_respiratory_events',
-
-    'number_central_respiratory_events', 'index_central_respiratory_events', 'minimum_length_central_respiratory_events', 'maximum_length_central_respiratory_events',
-    'number_central_rem_respiratory_events', 'index_central_rem_respiratory_events', 'minimum_length_central_rem_respiratory_events', 'maximum_length_central_rem_respiratory_events',
-    'number_central_nrem_respiratory_events', 'index_central_nrem_respiratory_events', 'minimum_length_central_nrem_respiratory_events', 'maximum_length_central_nrem_respiratory_events',
-    'number_central_supine_respiratory_events', 'index_central_supine_respiratory_events', 'minimum_length_central_supine_respiratory_events', 'maximum_length_central_supine_respiratory_events',
-    'number_central_non_supine_respiratory_events', 'index_central_non_supine_respiratory_events', 'minimum_length_central_non_supine_respiratory_events', 'maximum_length_central_non_supine_respiratory_events',
-
-    'number_mixed_respiratory_events', 'index_mixed_respiratory_events', 'minimum_length_mixed_respiratory_events', 'maximum_length_mixed_respiratory_events',
-    'number_mixed_rem_respiratory_events', 'index_mixed_rem_respiratory_events', 'minimum_length_mixed_rem_respiratory_events', 'maximum_length_mixed_rem_respiratory_events',
-    'number_mixed_nrem_respiratory_events', 'index_mixed_nrem_respiratory_events', 'minimum_length_mixed_nrem_respiratory_events', 'maximum_length_mixed_nrem_respiratory_events',
-    'number_mixed_supine_respiratory_events', 'index_mixed_supine_respiratory_events', 'minimum_length_mixed_supine_respiratory_events', 'maximum_length_mixed_supine_respiratory_events',
-    'number_mixed_non_supine_respiratory_events', 'index_mixed_non_supine_respiratory_events', 'minimum_length_mixed_non_supine_respiratory_events', 'maximum_length_mixed_non_supine_respiratory_events',
-    ]
-    
-    table = table_list[13]
-    values = [v.strip() for v in table if v.strip() == '-' or re.match('\d+.?\d*', v.strip())]
-    values = values[:116]
-    enter_values(field_names, values, out_dict, idx)
-    return out_dict
+SUMMARY_TABLE_SPEC = TableSpec(13,
+    ['total']
+    + ['obstructive' + v for v in SUMMARY_ROW_SUFFIXES]
+    + ['rera' + v for v in SUMMARY_ROW_SUFFIXES]
+    + ['central' + v for v in SUMMARY_ROW_SUFFIXES[:5]]
+    + ['mixed' + v for v in SUMMARY_ROW_SUFFIXES[:5]],
+    ['number', 'index', 'minimum_length', 'maximum_length'],
+    field='{column}_{row}_respiratory_events')
 
 def min_o2_help(input_data, n, labels):
     labels = [re.sub(r'\W+', '', l) for l in labels]
@@ -804,7 +1249,7 @@ def min_o2_help(input_data, n, labels):
                 
     return out
 
-def extract_periodic_breathing_min_o2(table_list, out_dict, idx):
+def periodic_breathing_min_o2_field_names():
     field_headers = [   
     # periodic breathing
     'periodic_breathing_entire_study',
@@ -814,7 +1259,7 @@ def extract_periodic_breathing_min_o2(table_list, out_dict, idx):
 
     field_names = [v + '_total_time_min' for v in field_headers] + [v + '_total_time_perc' for v in field_headers]
 
-    field_names = list(np.array(field_names).reshape(2,3).T.flatten())
+    field_names = transpose_names(field_names, 2)
     
     min_o2_names = [
     'min_o2_sat_entire_study',
@@ -822,7 +1267,12 @@ def extract_periodic_breathing_min_o2(table_list, out_dict, idx):
     'min_o2_sat_nrem'
     ]
     
-    field_names = field_names + min_o2_names
+    return field_names + min_o2_names
+
+PERIODIC_BREATHING_MIN_O2_FIELD_NAMES = periodic_breathing_min_o2_field_names()
+
+def extract_periodic_breathing_min_o2(table_list, row):
+    field_names = PERIODIC_BREATHING_MIN_O2_FIELD_NAMES
     
     table = table_list[14]
     
@@ -837,11 +1287,8 @@ def extract_periodic_breathing_min_o2(table_list, out_dict, idx):
     
     values = min_o2_help(table, 2, periodic_breathing_labels)
     values = values[:6] + values[6:11:2]
-    enter_values(field_names, values, out_dict, idx)
-    
-    if "CPAP/BiPAP" in str(table):
-        print('Warning: CPAP/BiPAP tables not supported yet.')
-    return out_dict
+    enter_values(field_names, values, row)
+    return row
 
 # def extract_min_o2(table_list, out_dict, idx):
 #     field_names = [
@@ -856,28 +1303,301 @@ def extract_periodic_breathing_min_o2(table_list, out_dict, idx):
 #     enter_values(field_names, values, out_dict, idx)
 #     return out_dict
 
-# TODO: One of the pdfs (LANDRY.pdf) has additional tables, may need to implement
-#       CPAP/BiPAP/O2 SUMMARY TABLE
-#       CPAP/BiPAP/O2 TABLE (REM)
-#       CPAP/BiPAP/O2 TABLE (Non-REM)
-#       CPAP/BiPAP/O2 TABLE (SUPINE)
-#       CPAP/BiPAP/O2 TABLE (Non-SUPINE)
-#       CPAP/BiPAP/O2 TABLE (REM SUPINE)
-#       CPAP/BiPAP/O2 TABLE (REM Non-SUPINE)
-#       CPAP/BiPAP/O2 TABLE (Non-REM SUPINE)
-#       CPAP/BiPAP/O2 TABLE (Non-REM Non-SUPINE)
+# Titration studies (e.g. LANDRY.pdf) end with nine tables of the same
+# layout, one row per pressure level tried
+CPAP_TABLE_HEADINGS = [
+    "CPAP/BiPAP/O2 SUMMARY TABLE",
+    "CPAP/BiPAP/O2 TABLE (REM)",
+    "CPAP/BiPAP/O2 TABLE (Non-REM)",
+    "CPAP/BiPAP/O2 TABLE (SUPINE)",
+    "CPAP/BiPAP/O2 TABLE (Non-SUPINE)",
+    "CPAP/BiPAP/O2 TABLE (REM SUPINE)",
+    "CPAP/BiPAP/O2 TABLE (REM Non-SUPINE)",
+    "CPAP/BiPAP/O2 TABLE (Non-REM SUPINE)",
+    "CPAP/BiPAP/O2 TABLE (Non-REM Non-SUPINE)",
+]
+
+CPAP_TABLE_NAMES = ['summary', 'rem', 'nrem', 'supine', 'non_supine',
+                    'rem_supine', 'rem_non_supine', 'nrem_supine', 'nrem_non_supine']
+
+# the value columns of each pressure row, after the pressure itself
+CPAP_VALUE_HEADERS = ['tib', 'tst', 'obs_apnea', 'cen_apnea', 'hypopnea', 'rera', 'ahi', 'rdi', 'min_spo2']
+
+# pressure rows kept per table, a titration rarely tries more levels
+CPAP_MAX_PRESSURES = 10
+
+def cpap_field_names():
+    field_headers = ['pressure'] + CPAP_VALUE_HEADERS
+    return ['cpap_' + table + '_' + str(level) + '_' + v
+            for table in CPAP_TABLE_NAMES
+            for level in range(1, CPAP_MAX_PRESSURES + 1)
+            for v in field_headers]
+
+CPAP_FIELD_NAMES = cpap_field_names()
+
+def cpap_rows(grid):
+    '''
+    Reads the pressure rows of one CPAP/BiPAP/O2 table, the same for all nine
+    Args:
+        grid (TableGrid): the table, or None
+    Returns:
+        list(list(str)): the pressure then the values of each row, or None if
+            the table isn't laid out as expected
+    '''
+    if grid is None or grid.ncols != len(CPAP_VALUE_HEADERS):
+        return None
+    return [[label] + cells for label, cells in zip(grid.labels, grid.cells)]
+
+def extract_cpap_tables(table_list, row, report=None):
+    '''
+    Reads all nine CPAP/BiPAP/O2 tables. Their headings are found by one
+    SectionIndex of their own, so reports without them aren't decoded any
+    further looking for them. The nth pressure row of a table goes in the
+    cpap_<table>_<n>_ columns.
+    '''
+    if report is None:
+        # the pressure rows can only be read from the page layout
+        return row
+    index = report.heading_index(CPAP_TABLE_HEADINGS)
+    blank_row = [nan] * (len(CPAP_VALUE_HEADERS) + 1)
+    values = []
+    for heading in CPAP_TABLE_HEADINGS:
+        rows = cpap_rows(report.table_grid(heading, index, label_from_header=True))
+        if rows is None:
+            logger.info('No %s found', heading)
+            rows = []
+        if len(rows) > CPAP_MAX_PRESSURES:
+            logger.warning('%s has %d pressures, only the first %d are kept',
+                           heading, len(rows), CPAP_MAX_PRESSURES)
+            rows = rows[:CPAP_MAX_PRESSURES]
+        for cells in rows + [blank_row] * (CPAP_MAX_PRESSURES - len(rows)):
+            values += cells
+    
+    enter_values(CPAP_FIELD_NAMES, values, row)
+    return row
+
+# Every table extractor, in the order get_compound_fields runs them: the name
+# printed when it fails, the function or TableSpec, and every field it can
+# fill (all table variants included). extract_sleep_params is the only one that reads
+# the report text instead of the table list.
+EXTRACTORS = [
+    ('sleep_params', extract_sleep_params, get_sleep_params_headers_field_names()[1]),
+    ('stage dist', extract_stage_dist, STAGE_DIST_SPEC.field_names + STAGE_DIST_TRANSITIONAL_SPEC.field_names),
+    ('arousals', AROUSALS_SPEC, AROUSALS_SPEC.field_names),
+    ('leg mvmts', LEG_MVMTS_SPEC, LEG_MVMTS_SPEC.field_names),
+    ('resp analysis', RESP_ANALYSIS_SPEC, RESP_ANALYSIS_SPEC.field_names),
+    ('baseline', extract_baseline_ranges, BASELINE_TCCO2_FIELD_NAMES + BASELINE_FIELD_NAMES),
+    ('spo2', extract_spo2_ranges_sleep, SPO2_RANGES_SLEEP_FIELD_NAMES),
+    ('resp events', RESP_EVENTS_SPEC, RESP_EVENTS_SPEC.field_names),
+    ('desat', DESAT_SPEC, DESAT_SPEC.field_names),
+    ('etco2', extract_etco2_vals, ETCO2_FIELD_NAMES + ETCO2_DISCARDED_FIELD_NAMES),
+    ('tcco2', extract_tcco2_vals, TCCO2_FIELD_NAMES + TCCO2_DISCARDED_FIELD_NAMES),
+    ('resp events stage', RESP_EVENTS_STAGE_SPEC, RESP_EVENTS_STAGE_SPEC.field_names),
+    ('body pos', RESP_EVENTS_BODY_POSITION_SPEC, RESP_EVENTS_BODY_POSITION_SPEC.field_names),
+    ('stage body pos', RESP_EVENTS_STAGE_POS_SPEC, RESP_EVENTS_STAGE_POS_SPEC.field_names),
+    ('summary', SUMMARY_TABLE_SPEC, SUMMARY_TABLE_SPEC.field_names),
+    ('periodic breathing', extract_periodic_breathing_min_o2, PERIODIC_BREATHING_MIN_O2_FIELD_NAMES),
+    ('cpap', extract_cpap_tables, CPAP_FIELD_NAMES),
+]
+
+# extractors that read their table from the word coordinates of the page.
+# The others still read the newline-split table text: the TableSpec tables
+# and the baseline ranges take the values in order by token kind, and
+# extract_periodic_breathing_min_o2 is the one left that depends on fixed
+# offsets, the n lines after each row label and every other value after the
+# sixth
+GRID_EXTRACTORS = {extract_spo2_ranges_sleep, extract_etco2_vals, extract_tcco2_vals, extract_cpap_tables}
+
+def get_output_columns():
+    '''
+    Returns every column the extraction can fill, in output order. Includes
+    the fields of every table variant, so the schema is settled before the
+    first pdf is processed and rows can be written out as they finish.
+    Params:
+        None
+    Returns:
+        list(str): the column names
+    '''
+    _, var_names = get_individual_headers_var_names()
+    field_name_lists = [['fname'], var_names] + [field_names for _, _, field_names in EXTRACTORS]
+    columns = []
+    seen = set()
+    for field_names in field_name_lists:
+        for name in field_names:
+            # table variants share some fields, keep the first position
+            if name not in seen:
+                seen.add(name)
+                columns.append(name)
+    return columns
+
+# the output schema, worked out once at import. Every Row has a slot per column
+OUTPUT_COLUMNS = get_output_columns()
+COLUMN_INDEX = {name: i for i, name in enumerate(OUTPUT_COLUMNS)}
+for spec in [STAGE_DIST_SPEC, STAGE_DIST_TRANSITIONAL_SPEC] + [e for _, e, _ in EXTRACTORS if isinstance(e, TableSpec)]:
+    spec.compile(COLUMN_INDEX)
+
+# text fields that repeat across studies, stored as categoricals in the
+# columnar output
+CATEGORICAL_FIELD_NAMES = ["sex", "ordering_name", "verified_name", "scored_by", "study_type"]
+
+# kept as text in the SQLite and columnar output, the ids can have leading zeros
+TEXT_FIELD_NAMES = ["fname"] + get_individual_headers_var_names()[1]
+# stored as yyyy-mm-dd in the SQLite output
+DATE_FIELD_NAMES = ["study_date", "birth_date"]
+
+#===============================REPORT VARIANTS================================================
+
+class ReportVariant:
+    '''
+    Which template a report was made from: the things the extractors would
+    otherwise each check for themselves. Worked out once per report by
+    fingerprint_report.
+
+    Args:
+        transitional (bool): pediatric staging, with a Transitional stage
+            instead of N1-N3
+        etco2_heading (str): the spelling of the ETCO2 values table's
+            heading, None if the report has no ETCO2 table
+        tcco2 (bool): whether there is a TcCO2 values table
+        baseline_tcco2 (bool): whether the baseline ranges have a TcCO2 row
+        cpap (bool): whether it is a CPAP/BiPAP titration report
+    '''
+    __slots__ = ('transitional', 'etco2_heading', 'tcco2', 'baseline_tcco2', 'cpap')
+
+    def __init__(self, transitional, etco2_heading, tcco2, baseline_tcco2, cpap):
+        self.transitional = transitional
+        self.etco2_heading = etco2_heading
+        self.tcco2 = tcco2
+        self.baseline_tcco2 = baseline_tcco2
+        self.cpap = cpap
+
+    @property
+    def key(self):
+        return (self.transitional, self.etco2_heading, self.tcco2, self.baseline_tcco2, self.cpap)
+
+    def __repr__(self):
+        staging = 'pediatric' if self.transitional else 'adult'
+        co2 = '+'.join(name for name, present in
+                       [('ETCO2', self.etco2_heading), ('TcCO2', self.tcco2)] if present) or 'no CO2'
+        return f'ReportVariant({staging} staging, {co2}, {"CPAP" if self.cpap else "diagnostic"})'
+
+
+def has_cpap_tables(report):
+    '''
+    Whether the report is a titration study: its CPAP/BiPAP/O2 tables come
+    straight after the periodic breathing table, on the same page or the
+    next one. Only those pages are looked at, so the appendix of a
+    diagnostic report is never decoded to rule the tables out
+    Args:
+        report (ReportText): The decoded text of the pdf
+    Returns:
+        bool: whether the tables are there
+    '''
+    located = report.index.locate("Total Time \n(min) ")
+    if located is None:
+        return False
+    page_num, offset = located
+    last_page = min(page_num + 1, report.page_count - 1)
+    while len(report.pages) <= last_page:
+        report.decode_next()
+    start = report.page_starts[page_num] + offset
+    end = report.page_starts[last_page] + len(report.pages[last_page])
+    text = report.text[start:end]
+    return any(heading in text for heading in CPAP_TABLE_HEADINGS)
+
+
+def fingerprint_report(report):
+    '''
+    Works out the report's variant from its heading index, then cuts out
+    its tables with the headings that variant uses
+    Args:
+        report (ReportText): The decoded text of the pdf
+    Returns:
+        ReportVariant: the variant
+        list(TableLines): the tables, as from get_table_list
+    '''
+    index = report.index
+    etco2_heading = None
+    for heading in ["TABLE OF ETCO2 VALUES", "TABLE OF EtCO2 VALUES"]:
+        if index.find(heading) != -1:
+            etco2_heading = heading
+            break
+    tcco2 = index.find("TABLE OF TcCO2 VALUES") != -1
+    cpap = has_cpap_tables(report)
+    
+    table_list = get_table_list(report, etco2_heading or "TABLE OF ETCO2 VALUES")
+    variant = ReportVariant(
+        transitional='Transitional' in table_list[0].texts,
+        etco2_heading=etco2_heading,
+        tcco2=tcco2,
+        baseline_tcco2=has_baseline_tcco2(table_list[4]),
+        cpap=cpap)
+    return variant, table_list
+
+
+def missing_table(table_list, row, message, level=logging.INFO):
+    '''
+    Plan step for a table the report doesn't have, logs message at level
+    '''
+    logger.log(level, message)
+    return row
+
+
+def build_parse_plan(variant):
+    '''
+    The steps get_compound_fields runs for a report variant: EXTRACTORS with
+    each variant check answered up front, and the tables the variant
+    doesn't have replaced by a note that they are missing
+    Args:
+        variant (ReportVariant): the variant
+    Returns:
+        list(tuple(str, function, dict)): the name, function and keyword
+            arguments of each step
+    '''
+    options = {
+        extract_stage_dist: {'spec': STAGE_DIST_TRANSITIONAL_SPEC if variant.transitional
+                             else STAGE_DIST_SPEC},
+        extract_baseline_ranges: {'tcco2': variant.baseline_tcco2},
+        extract_etco2_vals: {'headings': [variant.etco2_heading]},
+    }
+    plan = []
+    for name, extract, _ in EXTRACTORS:
+        if extract is extract_etco2_vals and variant.etco2_heading is None:
+            plan.append((name, missing_table, {'message': 'No ETCO2 Values table found'}))
+        elif extract is extract_tcco2_vals and not variant.tcco2:
+            plan.append((name, missing_table, {'message': 'No TcCO2 Values table found'}))
+        elif extract is extract_cpap_tables and not variant.cpap:
+            # only titration studies have them, a diagnostic report isn't
+            # missing anything
+            plan.append((name, missing_table, {'message': 'No CPAP/BiPAP/O2 tables found',
+                                               'level': logging.DEBUG}))
+        else:
+            plan.append((name, extract, options.get(extract, {})))
+    return plan
+
+# the plan of each variant seen so far, a handful at most
+PARSE_PLANS = {}
+
+def parse_plan(variant):
+    '''
+    The plan for a report variant, built the first time the variant is seen
+    '''
+    plan = PARSE_PLANS.get(variant.key)
+    if plan is None:
+        plan = PARSE_PLANS[variant.key] = build_parse_plan(variant)
+    return plan
 
 #===============================PROCESS PDF====================================================
 
-def get_individual_fields(path, out_dict, idx):
+def get_individual_fields(report, row):
     '''
     Gets all data from individual fields
 
     Args:
-        path (str): The path to the pdf
-        out_dict: a dictionary to store the output data
+        report (ReportText): The decoded text of the pdf
+        row (Row): the document's values, filled in place
     Returns:
-        dict(str, any): the modified output dictionary
+        Row: the modified row
     '''
 
     pdf_headers, var_names = get_individual_headers_var_names()
@@ -895,8 +1615,10 @@ def get_individual_fields(path, out_dict, idx):
     # get all the field values
     for i in range(len(pdf_headers) - 1):
         if not (i in exclude):
-            txt = extract_text_between_headings(path, pdf_headers[i], pdf_headers[i+1])
+            txt = extract_text_between_headings(report, pdf_headers[i], pdf_headers[i+1])
+            start = time.perf_counter()
             txt = remove_pg_header(txt)
+            report.add_time('page_headers', start)
             # deal with the optional individual fields
             if i > 0 and i < 8:
                 values = optional_field_help(txt, opt_headers[i - 1], values)
@@ -905,8 +1627,8 @@ def get_individual_fields(path, out_dict, idx):
             else:
                 values.append(txt)
     
-    enter_values(var_names, values, out_dict, idx)
-    return out_dict
+    enter_values(var_names, values, row)
+    return row
 
 
 # def get_compound_fields(path, out_dict, idx):
@@ -928,156 +1650,383 @@ def get_individual_fields(path, out_dict, idx):
 #     out_dict = extract_periodic_breathing(table_list, out_dict, idx)
 #     out_dict = extract_min_o2(table_list, out_dict, idx)
     
-def get_compound_fields(path, out_dict, idx):
+def get_compound_fields(report, row):
     '''
     Gets all data from tables
 
     Args:
-        path (str): The path to the pdf
-        out_dict(dict(str, any)): a dictionary to store the output data
-        idx (int): doc index
+        report (ReportText): The decoded text of the pdf
+        row (Row): the document's values, filled in place
     Returns:
-        dict(str, any): the modified output dictionary
+        Row: the modified row
+        bool: whether any table failed to parse
     '''
-    table_list = get_table_list(path)
+    start = time.perf_counter()
+    variant, table_list = fingerprint_report(report)
+    report.variant = variant
+    report.add_time('table_sections', start)
     error = False
     
-    try:
-        out_dict = extract_sleep_params(path, out_dict, idx)
-    except Exception as e:
-        print('error sleep_params')
-        error = True
-        print(e)
+    for name, extract, options in parse_plan(variant):
+        start = time.perf_counter()
+        try:
+            if extract is extract_sleep_params:
+                row = extract(report, row)
+            elif extract in GRID_EXTRACTORS:
+                # read from the page layout, the table text is the fallback
+                row = extract(table_list, row, report, **options)
+            else:
+                row = extract(table_list, row, **options)
+        except Exception as e:
+            logger.warning('error %s: %s', name, e)
+            error = True
+        report.add_time(name, start)
         
-    try:
-        out_dict = extract_stage_dist(table_list, out_dict, idx)
-    except Exception as e:
-        print('error stage dist')
-        error = True
-        print(e)
-    try: 
-        out_dict = extract_arousals(table_list, out_dict, idx)
-    except Exception as e:
-        print('error arousals')
-        error = True
-        print(e)
+    return row, error
+
+
+
+
+def process_pdf(path, timings=None, data=None):
+    '''
+    Gets all data from pdf at path. Only reads the pdf, so it can be run
+    in a worker process
+    Args:
+        path (str): The path to the pdf
+        data (bytes): the pdf's contents if they were already read, e.g. by
+            a PdfPrefetcher
+        timings (dict(str, float)): if given, the seconds each stage took are
+            stored in it. decode and page_headers are also counted in the
+            stages they happen in
+    Returns:
+        Row: the document's row of output data
+        bool: whether any table failed to parse
+    '''
     
-    try:
-        out_dict = extract_leg_mvmts(table_list, out_dict, idx)
-    except Exception as e:
-        print('error leg mvmts')
-        error = True
-        print(e)
-    try:
-        out_dict = extract_resp_analysis(table_list, out_dict, idx)
-    except Exception as e:
-        print('error resp analysis')
-        error = True
-        print(e)
-        
-    try: 
-        out_dict = extract_baseline_ranges(table_list, out_dict, idx)
-    except Exception as e:
-        print('error baseline')
-        error = True
-        print(e)
-        
-    try: 
-        out_dict = extract_spo2_ranges_sleep(table_list, out_dict, idx)
-    except Exception as e:
-        print('error spo2')
-        error = True
-        print(e)
-        
-    try:
-        out_dict = extract_resp_events(table_list, out_dict, idx)
-    except Exception as e:
-        print('error resp events')
-        error = True
-        print(e)
-        
-    try:
-        out_dict = extract_desat_table(table_list, out_dict, idx)
-    except Exception as e:
-        print('error desat')
-        error = True
-        print(e)
-        
-    try:
-        out_dict = extract_etco2_vals(table_list, out_dict, idx)
-    except Exception as e:
-        print('error etco2')
-        error = True
-        print(e)
-        
-    try:
-        out_dict = extract_tcco2_vals(table_list, out_dict, idx)
-    except Exception as e:
-        print('error tcco2')
-        error = True
-        print(e)
-        
-    try:
-        out_dict = extract_resp_events_stage(table_list, out_dict, idx)
-    except Exception as e:
-        print('error resp events stage')
-        error = True
-        print(e)
-        
-    try:
-        out_dict = extract_resp_events_body_position(table_list, out_dict, idx)
-    except Exception as e:
-        print('error body pos')
-        error = True
-        print(e)
-        
-    try:
-        out_dict = extract_resp_events_stage_pos(table_list, out_dict, idx)
-    except Exception as e:
-        print('error stage body pos')
-        error = True
-        print(e)
+    # decode the pdf once and share the text with every extraction step
+    start = time.perf_counter()
+    with ReportText(path, data) as report:
+        report.add_time('open', start)
+        row = Row()
+        individual_start = time.perf_counter()
+        row = get_individual_fields(report, row)
+        report.add_time('individual_fields', individual_start)
+        row, error = get_compound_fields(report, row)
+    
+    if timings is not None:
+        timings.update(report.timings)
+        timings['total'] = time.perf_counter() - start
+    return row, error
+
+
+def process_pdf_timed(path, data=None):
+    '''
+    process_pdf, also returning how long each stage took
+    Args:
+        path (str): The path to the pdf
+        data (bytes): the pdf's contents if they were already read
+    Returns:
+        Row: the document's row of output data
+        bool: whether any table failed to parse
+        dict(str, float): the seconds each stage took
+    '''
+    timings = {}
+    row, error = process_pdf(path, timings, data)
+    return row, error, timings
+
+
+def _from_cache(cached, timed):
+    '''
+    A result the cache returned, as process_pdfs yields it
+    Args:
+        cached (tuple(list, bool)): the row values and error flag
+        timed (bool): add None for the stage timings
+    Returns:
+        tuple(Row, bool): the row and error flag, then None if timed
+    '''
+    values, error = cached
+    return (Row(values), error, None) if timed else (Row(values), error)
+
+
+def process_pdfs(pdf_list, workers=1, cache=None, timed=False, executor=None,
+                 prefetch=0, prefetch_budget=256 * 2**20, chunk_size=256, isolation=None):
+    '''
+    Processes each pdf, in a pool of worker processes if workers > 1. The
+    pdfs are taken from pdf_list as they are needed and each row is let go
+    once it is yielded, so memory use doesn't grow with the batch
+    Args:
+        pdf_list (iterable(str)): The paths to the pdfs, e.g. a generator
+        workers (int): the number of processes to use
+        cache (ExtractionCache): pdfs found here are not processed again, new
+            results are stored in it. None to always process
+        timed (bool): also yield the stage timings of each pdf, None for the
+            ones found in the cache
+        executor (ProcessPoolExecutor): a running pool to use instead of
+            starting one for these pdfs, it is left running
+        prefetch (int): when processing in this process, read up to this
+            many pdfs ahead on a background thread while the current one is
+            parsed. 0 to read each pdf when it is opened
+        prefetch_budget (int): the most bytes of pdfs to read ahead
+        chunk_size (int): the most pdfs looked up in the cache or handed to
+            the pool ahead of the one being yielded, twice that with prefetch
+            so the next chunk is queued for reading in time
+        isolation (dict): run each pdf in an IsolatedRunner worker instead,
+            with these keyword arguments (timeout, memory_mb, retries). A
+            pdf that times out, runs out of memory or raises is yielded
+            with a Row of None and the reason in place of the error flag
+    Returns:
+        generator(tuple(Row, bool)): the row and error flag of each
+            pdf, in the same order as pdf_list
+    '''
+    from collections import deque
+    
+    process = process_pdf_timed if timed else process_pdf
+    chunk_size = max(1, chunk_size)
+    if isolation is not None:
+        yield from _process_isolated(pdf_list, process, cache, timed, workers, isolation, chunk_size)
+        return
+    if prefetch and executor is None and workers <= 1:
+        yield from _process_prefetched(pdf_list, process, cache, timed, prefetch,
+                                       prefetch_budget, chunk_size)
+        return
+
+    own_executor = None
+    if executor is None and workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
         
+        # the worker processes are only started once something is submitted
+        executor = own_executor = ProcessPoolExecutor(max_workers=workers,
+                                                      initializer=worker_logging())
+    # without a pool each pdf is processed as it comes up, with one the next
+    # chunk_size are submitted ahead so the workers stay busy
+    ahead = 1 if executor is None else chunk_size
+    
+    def finish(path, key, cached, future):
+        if cached is not None:
+            return _from_cache(cached, timed)
+        result = process(path) if future is None else future.result()
+        if cache is not None:
+            cache.put(key, result[0].values, result[1])
+        return result
+    
+    pending = deque()
     try:
-        out_dict = extract_summary_table(table_list, out_dict, idx)
-    except Exception as e:
-        print('error summary')
-        error = True
-        print(e)
-        
+        for path in pdf_list:
+            # the cache is only used from this process, workers just extract
+            key, cached = (None, None) if cache is None else cache.get(path)
+            future = None
+            if cached is None and executor is not None:
+                future = executor.submit(process, path)
+            pending.append((path, key, cached, future))
+            # results are yielded in input order so the output matches a serial run
+            if len(pending) >= ahead:
+                yield finish(*pending.popleft())
+        while pending:
+            yield finish(*pending.popleft())
+    finally:
+        for entry in pending:
+            if entry[3] is not None:
+                entry[3].cancel()
+        if own_executor is not None:
+            own_executor.shutdown(cancel_futures=True)
+
+
+def _process_prefetched(pdf_list, process, cache, timed, depth, budget, chunk_size):
+    '''
+    process_pdfs in this process, with the pdfs read ahead by a PdfPrefetcher.
+    Pdfs the cache knows by their size and modification time aren't read at
+    all, new or changed ones are hashed from the prefetched bytes. The pdfs
+    are taken chunk_size at a time, the next chunk is looked up and queued
+    for reading while one is processed so the read ahead doesn't run dry
+    between them
+    '''
+    import queue
+    from prefetch import PdfPrefetcher
+    
+    pdf_list = iter(pdf_list)
+    # one prefetcher for the whole batch, fed the pdfs to read chunk by chunk
+    feed = queue.Queue()
+    prefetched = iter(PdfPrefetcher(iter(feed.get, None), depth, budget))
+    
+    def next_chunk():
+        chunk = list(islice(pdf_list, chunk_size))
+        if cache is None:
+            cached = [(None, None)] * len(chunk)
+        else:
+            cached = [cache.get(path, read=False) for path in chunk]
+        for path, (key, result) in zip(chunk, cached):
+            if result is None:
+                feed.put(path)
+        return cached
+    
     try:
-        out_dict = extract_periodic_breathing_min_o2(table_list, out_dict, idx)
-    except Exception as e:
-        print('error periodic breathing')
-        error = True
-        print(e)
-        
-    # try:
-    #     out_dict = extract_min_o2(table_list, out_dict, idx)
-    # except Exception as e:
-    #     print('error min o2')
-    #     error = True
-    #     print(e)
-        
-    return out_dict, error
+        cached = next_chunk()
+        while cached:
+            upcoming = next_chunk()
+            for key, result in cached:
+                if result is None:
+                    path, data = next(prefetched)
+                    if cache is not None and key is None:
+                        key, result = cache.get(path, data)
+                if result is None:
+                    result = process(path, data=data)
+                    if cache is not None:
+                        cache.put(key, result[0].values, result[1])
+                else:
+                    result = _from_cache(result, timed)
+                yield result
+            cached = upcoming
+    finally:
+        # ends the reader's paths, or it would wait for more
+        feed.put(None)
+        prefetched.close()
+
+def _process_isolated(pdf_list, process, cache, timed, workers, isolation, chunk_size):
+    '''
+    process_pdfs with every pdf run in an IsolatedRunner worker, chunk_size
+    pdfs at a time
+    '''
+    from isolated import IsolatedRunner
+    
+    pdf_list = iter(pdf_list)
+    with IsolatedRunner(process, workers, initializer=worker_logging(), **isolation) as runner:
+        while True:
+            chunk = list(islice(pdf_list, chunk_size))
+            if not chunk:
+                return
+            if cache is None:
+                cached = [(None, None)] * len(chunk)
+            else:
+                cached = [cache.get(path) for path in chunk]
+            to_process = [path for path, (key, result) in zip(chunk, cached) if result is None]
+            processed = runner.run(to_process)
+            for key, result in cached:
+                if result is None:
+                    ok, result = next(processed)
+                    if not ok:
+                        result = (None, result, None) if timed else (None, result)
+                    elif cache is not None:
+                        cache.put(key, result[0].values, result[1])
+                else:
+                    result = _from_cache(result, timed)
+                yield result
+
+#===============================LIBRARY API====================================================
+def configure_logging(to_stderr=False):
+    '''
+    Prints the extractor's messages, as the command line does. Does nothing
+    if this process already does, e.g. a forked worker
+    Args:
+        to_stderr (bool): print them to stderr instead of stdout
+    '''
+    if any(handler.name == 'extract_stats' for handler in logger.handlers):
+        return
+    handler = logging.StreamHandler(sys.stderr if to_stderr else sys.stdout)
+    handler.name = 'extract_stats'
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
 
 
+def worker_logging():
+    '''
+    The initializer for worker processes, so they print the extractor's
+    messages where this process does. None if configure_logging wasn't
+    called, the workers then leave logging as it is
+    '''
+    from functools import partial
+    
+    for handler in logger.handlers:
+        if handler.name == 'extract_stats':
+            return partial(configure_logging, handler.stream is sys.stderr)
+    return None
 
 
-def process_pdf(path, out_dict, idx):
+def report_record(path, row, error):
     '''
-    Gets all data from pdf at path and inputs it in out_dict
+    The record of one extracted pdf
     Args:
-        path (str): The path to the pdf
-        out_dict: a dictionary to store the output data
+        path (str): the pdf's path, None if it was read from bytes
+        row (Row): its row of output data, None if it couldn't be processed
+        error (bool or str): whether any table failed to parse, or why the
+            pdf couldn't be processed
     Returns:
-        dict(str, any): the modified output dictionary
+        dict(str, any): the path, error and row, with the row as a dict of
+            column to value and missing values as None so it can be saved
+            as JSON
     '''
+    if row is not None:
+        # nan isn't valid JSON, missing values are written as null
+        row = {k: None if isinstance(v, float) and math.isnan(v) else v for k, v in row.to_dict().items()}
+    return {'path': path, 'error': error, 'row': row}
+
+
+def extract_report(source, name=None):
+    '''
+    Extracts one pdf in this process, for use from other programs:
+
+        from extract_stats import extract_report
+        record = extract_report('reports/study.pdf')
+        record['row']['study_number']
+
+    Args:
+        source (str or bytes): the path to the pdf, or its contents
+        name (str): the fname column, the file name of the path by default
+    Returns:
+        dict(str, any): the record, see report_record
+    Raises:
+        fitz.FileDataError: if source isn't a pdf PyMuPDF can open
+    '''
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        path, data = None, bytes(source)
+    else:
+        path, data = os.fspath(source), None
+    row, error = process_pdf(path, data=data)
+    if name is None and path is not None:
+        name = os.path.basename(path)
+    if name is not None:
+        row['fname'] = name
+    return report_record(path, row, error)
+
+
+def iter_reports(paths, workers=1, cache=None, prefetch=0, chunk_size=256, isolation=None):
+    '''
+    Extracts many pdfs, yielding each record as soon as it and the ones
+    before it are done. The paths are taken as they are needed, so they
+    can come from a generator and the batch can be as big as needed
+    Args:
+        paths (iterable(str)): the paths to the pdfs
+        workers (int): the number of processes to extract with
+        cache (ExtractionCache): reuse and store rows in this cache, None
+            to always extract
+        prefetch (int): with one worker, read this many pdfs ahead
+        chunk_size (int): the most pdfs queued for the workers at once
+        isolation (dict): run each pdf in a worker that is killed if it
+            hangs or uses too much memory, with these IsolatedRunner
+            arguments (timeout, memory_mb, retries)
+    Returns:
+        generator(dict(str, any)): the record of each pdf in order, see
+            report_record. A pdf an isolated worker couldn't finish has a
+            row of None and the reason as its error
+    '''
+    from collections import deque
     
-    out_dict = get_individual_fields(path, out_dict, idx)
-    out_dict, error = get_compound_fields(path, out_dict, idx)
+    # the paths handed to process_pdfs and not yielded yet, in order
+    started = deque()
     
-    return out_dict, error
+    def track(paths):
+        for path in paths:
+            path = os.fspath(path)
+            started.append(path)
+            yield path
+    
+    results = process_pdfs(track(paths), workers, cache, prefetch=prefetch,
+                           chunk_size=chunk_size, isolation=isolation)
+    for row, error in results:
+        path = started.popleft()
+        if row is not None:
+            row['fname'] = os.path.basename(path)
+        yield report_record(path, row, error)
 
 #===============================OUTPUT=========================================================
 def save_spreadsheet(out_dict):
@@ -1090,27 +2039,354 @@ def save_spreadsheet(out_dict):
         None
     '''
     
+    import pandas as pd
+    
     df = pd.DataFrame.from_dict(out_dict)
     df.to_csv('out.csv')
+
+
+def open_cache(args):
+    '''
+    The extraction cache the command line asks for
+    Args:
+        args (argparse.Namespace): the command line arguments
+    Returns:
+        ExtractionCache: the cache, None with --no-cache
+    '''
+    if args.no_cache:
+        return None
+    from extract_cache import ExtractionCache
+    
+    return ExtractionCache(EXTRACTOR_VERSION, args.cache_dir, rebuild=args.rebuild_cache)
+
+
+def pdf_sha256(path, cache=None):
+    '''
+    The sha256 of a pdf, through the cache if there is one so a pdf it has
+    seen unchanged isn't read again
+    '''
+    if cache is not None:
+        return cache.key(path)[0]
+    from extract_cache import file_sha256
+    
+    return file_sha256(path)
+
+
+class BatchOutput:
+    '''
+    Where a batch or watch run writes its rows: a csv with a RunManifest
+    recording each pdf in it, or a SQLite database, which records them
+    itself and upserts one row per study. done holds (row, size, mtime_ns,
+    sha256) of each pdf already in the output, from when it was read
+    Args:
+        path (str): the output file, a database if it ends in .sqlite or .db
+        compress (bool): gzip the csv
+        resume (bool): continue the output of an earlier run instead of
+            starting over
+    '''
+    def __init__(self, path, compress=False, resume=False):
+        from output_writers import SQLITE_EXTENSIONS, SqliteRowWriter
+        
+        self.path = path
+        self.compress = compress
+        self.manifest = None
+        if path.endswith(SQLITE_EXTENSIONS):
+            # the database is its own checkpoint, rows are committed a batch at a time
+            self.writer = SqliteRowWriter(path, OUTPUT_COLUMNS, TEXT_FIELD_NAMES, DATE_FIELD_NAMES)
+            self.done = self.writer.files() if resume else {}
+        else:
+            self._open_csv(resume)
+    
+    def _open_csv(self, resume):
+        from output_writers import CsvRowWriter, RunManifest
+        
+        self.manifest = RunManifest(self.path + '.manifest', OUTPUT_COLUMNS, resume=resume)
+        if self.manifest.offset is not None and not os.path.exists(self.path):
+            raise FileNotFoundError(f'Cannot resume, {self.path} is missing')
+        self.writer = CsvRowWriter(self.path, OUTPUT_COLUMNS, compress=self.compress,
+                                   resume_offset=self.manifest.offset, nrows=self.manifest.nrows)
+        self.done = self.manifest.done
+    
+    def write(self, path, values, sha256=None):
+        '''
+        Writes a pdf's row
+        Args:
+            path (str): the pdf
+            values (list(any)): its row's values, in column order
+            sha256 (str): the pdf's sha256 if it is known
+        '''
+        try:
+            stat = os.stat(path)
+            stat = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            stat = None
+        if self.manifest is None:
+            self.writer.write_values(values, path, sha256, stat)
+            self.done[path] = (None,) + (stat or (None, None)) + (sha256,)
+        else:
+            self.writer.write_values(values)
+            self.manifest.record(path, self.writer.nrows - 1, self.writer.offset, stat, sha256)
+    
+    def drop(self, paths):
+        '''
+        Removes the rows of some pdfs, e.g. ones that changed, before their
+        new rows are written
+        Args:
+            paths (list(str)): the pdfs, ones not in the output are ignored
+        '''
+        paths = {path for path in paths if path in self.done}
+        if not paths:
+            return
+        if self.manifest is None:
+            self.writer.delete_paths(paths)
+            for path in paths:
+                del self.done[path]
+            return
+        from output_writers import remove_csv_rows
+        
+        # the csv is rewritten without them, then appended to as before
+        self.writer.close()
+        self.manifest.close()
+        remove_csv_rows(self.path, OUTPUT_COLUMNS, self.manifest.path, paths)
+        self._open_csv(resume=True)
+    
+    def flush(self):
+        '''
+        Commits the rows written so far, the csv writes each row as it comes
+        '''
+        if self.manifest is None:
+            self.writer.flush()
+    
+    def close(self):
+        self.writer.close()
+        if self.manifest is not None:
+            self.manifest.close()
 #===============================MAIN FUNTION===================================================
-def main():
+def parse_args(argv=None):
+    '''
+    Parses the command line arguments
+    '''
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Extracts stats from the sleep study pdfs in the PDFs folder')
+    parser.add_argument('pdfs', nargs='*',
+                        help='extract just these pdfs and print each row as JSON, '
+                             'instead of processing the PDFs folder')
+    parser.add_argument('--pdf-dir', default='PDFs',
+                        help='the folder of pdfs to process (default: PDFs)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes to extract pdfs with (default: 1)')
+    parser.add_argument('--output', default='out.csv',
+                        help='the csv file to write, or a SQLite database if it ends in .sqlite or '
+                             '.db (default: out.csv)')
+    parser.add_argument('--compress', action='store_true',
+                        help='gzip the output, adds .gz to the file name')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='process every pdf, without reading or writing the extraction cache')
+    parser.add_argument('--rebuild-cache', action='store_true',
+                        help='clear the extraction cache and process every pdf again')
+    parser.add_argument('--cache-dir', default='.cache',
+                        help='where the extraction cache is kept (default: .cache)')
+    parser.add_argument('--columnar', nargs='?', const='auto', choices=['auto', 'parquet', 'npy'],
+                        help='also write a typed columnar copy of the output: parquet if pyarrow '
+                             'is installed, otherwise a folder of npy files (default: auto)')
+    parser.add_argument('--prefetch', type=int, default=4,
+                        help='with one worker, read up to this many pdfs ahead while the current one '
+                             'is parsed, 0 to turn off (default: 4)')
+    parser.add_argument('--prefetch-mb', type=float, default=256,
+                        help='the most memory the pdfs read ahead may take, in MB (default: 256)')
+    parser.add_argument('--chunk-size', type=int, default=256,
+                        help='the most pdfs read from the folder, looked up in the cache or queued for '
+                             'the workers at once, so they don\'t pile up in memory however big the '
+                             'batch (default: 256)')
+    parser.add_argument('--isolate', action='store_true',
+                        help='run each pdf in a worker process that is killed if it takes longer '
+                             'than --timeout or uses more than --memory-limit, so one bad pdf '
+                             'cannot stall or crash the batch')
+    parser.add_argument('--timeout', type=float, default=120,
+                        help='with --isolate or --serve, seconds a pdf may take (default: 120)')
+    parser.add_argument('--memory-limit', type=float, metavar='MB',
+                        help='with --isolate or --serve, the most memory a worker may use, in MB '
+                             '(default: no limit)')
+    parser.add_argument('--retries', type=int, default=0,
+                        help='with --isolate, how many more times to try a pdf that timed out, '
+                             'ran out of memory or crashed (default: 0)')
+    parser.add_argument('--timings', metavar='FILE',
+                        help='write how long each stage took for every pdf to this JSON lines '
+                             'file and print p50/p95 per stage at the end')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='profile the run with cProfile and save the stats to this file')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and extract pdfs as they are added to the PDFs folder')
+    parser.add_argument('--poll-interval', type=float, default=2.0,
+                        help='with --watch, seconds between checks of the folder (default: 2)')
+    parser.add_argument('--settle', type=float, default=5.0,
+                        help='with --watch, seconds a pdf must stay unchanged before it is '
+                             'extracted, so half copied files are skipped (default: 5)')
+    parser.add_argument('--serve', action='store_true',
+                        help='run an HTTP server that extracts pdfs POSTed to /extract with a pool '
+                             'of --workers warm worker processes')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='with --serve, the address to listen on (default: 127.0.0.1, only '
+                             'this machine)')
+    parser.add_argument('--port', type=int, default=8765,
+                        help='with --serve, the port to listen on (default: 8765)')
+    parser.add_argument('--max-concurrent', type=int,
+                        help='with --serve, the most pdfs extracted at once (default: --workers)')
+    parser.add_argument('--max-queue', type=int, default=32,
+                        help='with --serve, the most requests waiting for a worker, more are '
+                             'turned away with a 503 (default: 32)')
+    parser.add_argument('--queue-timeout', type=float, default=30,
+                        help='with --serve, seconds a request may wait for a worker before it is '
+                             'turned away with a 503 (default: 30)')
+    parser.add_argument('--max-mb', type=float, default=100,
+                        help='with --serve, the biggest pdf accepted, in MB (default: 100)')
+    parser.add_argument('--skip-duplicates', action='store_true',
+                        help='skip pdfs that are a copy of an earlier one or the same study (the '
+                             'same Study No, Hospital No and Study Date), listing them in '
+                             '<output>.duplicates.csv')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the pdfs a previous run already finished and keep appending to its output')
+    args = parser.parse_args(argv)
+    if (args.resume or args.watch) and args.compress:
+        parser.error('--resume and --watch only work with uncompressed output')
+    if args.compress or args.columnar:
+        from output_writers import SQLITE_EXTENSIONS
+        
+        if args.output.endswith(SQLITE_EXTENSIONS):
+            parser.error('--compress and --columnar only work with csv output')
+    if args.skip_duplicates and (args.watch or args.serve or args.pdfs):
+        parser.error('--skip-duplicates only works for a batch run over the folder')
+    args.isolation = None
+    if args.isolate:
+        args.isolation = {'timeout': args.timeout, 'memory_mb': args.memory_limit, 'retries': args.retries}
+    return args
+
+
+def startup_time():
+    '''
+    Seconds since this module started importing
+    '''
+    return time.perf_counter() - _import_start
+
+
+def extract_files(paths):
+    '''
+    Extracts the given pdfs and prints one JSON object per pdf to stdout.
+    Only needs PyMuPDF, for running the script per file from a scheduler.
+    Args:
+        paths (list(str)): The paths to the pdfs
+    Returns:
+        bool: whether any pdf had an error
     '''
-    Main function. Processes all pdfs in PDFs folder
+    import json
+    
+    print(f'Started in {startup_time() * 1000:.0f} ms', file=sys.stderr)
+    any_error = False
+    for path in paths:
+        record = extract_report(path)
+        any_error = any_error or record['error']
+        print(json.dumps(record))
+    return any_error
+
+
+def run_batch(args):
     '''
+    Processes all pdfs in the --pdf-dir folder into the output file
+    Args:
+        args (argparse.Namespace): the command line arguments
+    '''
+    from itertools import tee
+    from stage_timing import peak_rss_mb
+    
+    print(f'Started in {startup_time() * 1000:.0f} ms \n')
     
-    # Get list of pdfs in pdfs folder
-    pdf_list, out_dict = get_pdf_list()
+    # The pdfs in the pdfs folder, read as they are needed
+    pdf_list = iter_pdf_paths(args.pdf_dir)
     problem_pdfs = []
-    # Process each pdf
-    for i, path in enumerate(pdf_list):
-        print(f'Processing pdf {i+1}/{len(pdf_list)}. \n Path: {path} \n')
-        assert path.lower().endswith('.pdf')
-        out_dict, error = process_pdf(path, out_dict, i)
+    output_path = args.output
+    if args.compress and not output_path.endswith('.gz'):
+        output_path += '.gz'
+    cache = open_cache(args)
+    
+    # before the resume check, so a resumed run skips the same pdfs
+    duplicates = None
+    if args.skip_duplicates:
+        from duplicates import DuplicateFinder
+        
+        # the first pages are read in the workers, isolated with --isolate
+        duplicates = DuplicateFinder(output_path + '.duplicates.csv', cache, args.workers,
+                                     args.isolation, args.chunk_size)
+        pdf_list = duplicates.filter(pdf_list)
+    
+    # the pdfs already in the output of the run being resumed are skipped
+    output = BatchOutput(output_path, compress=args.compress, resume=args.resume)
+    done = output.done
+    if done:
+        print(f'Resuming: {len(done)} pdfs already done \n')
+        pdf_list = (path for path in pdf_list if path not in done)
+    
+    timing_log = None
+    if args.timings:
+        from stage_timing import TimingLog
         
-        if error:
-            problem_pdfs.append(path)
-        # Save data as we go
-        save_spreadsheet(out_dict)
+        timing_log = TimingLog(args.timings)
+    
+    # Process each pdf, the paths are kept just until their row is written
+    paths, pdf_list = tee(pdf_list)
+    results = process_pdfs(pdf_list, args.workers, cache, timed=timing_log is not None,
+                           prefetch=args.prefetch, prefetch_budget=int(args.prefetch_mb * 2**20),
+                           chunk_size=args.chunk_size, isolation=args.isolation)
+    try:
+        # results first, so it runs to its end and shuts its workers down
+        for i, (result, path) in enumerate(zip(results, paths)):
+            row, error = result[:2]
+            if row is None:
+                # killed or raised in an isolated worker, nothing to write
+                print(f'Could not process pdf {i+1} ({error}). \n Path: {path} \n')
+                problem_pdfs.append(f'{path} ({error})')
+                continue
+            if timing_log is not None:
+                timing_log.record(path, result[2])
+            print(f'Processed pdf {i+1}. \n Path: {path} \n')
+            row['fname'] = os.path.basename(path)
+            
+            if error:
+                problem_pdfs.append(path)
+            # Save data as we go, each row is written once and flushed
+            output.write(path, row.values, None if cache is None else cache.key(path)[0])
+    finally:
+        # stops the workers if the loop didn't finish, they are reaped
+        # before their peak memory is read below
+        results.close()
+        output.close()
+    
+    if duplicates is not None:
+        print(duplicates.summary())
+        duplicates.close()
+    
+    if cache is not None:
+        print(cache.summary())
+        cache.close()
+    
+    if timing_log is not None:
+        print(timing_log.summary())
+        timing_log.close()
+    
+    if args.columnar:
+        from output_writers import write_columnar
+        
+        base = output_path[:-len('.gz')] if output_path.endswith('.gz') else output_path
+        columnar_path = write_columnar(output_path, os.path.splitext(base)[0],
+                                       CATEGORICAL_FIELD_NAMES, TEXT_FIELD_NAMES, args.columnar)
+        print(f'Wrote columnar output to {columnar_path}')
+    
+    peak = peak_rss_mb()
+    if peak is not None:
+        print(f'Peak memory: {peak:.0f} MB')
+    worker_peak = peak_rss_mb(children=True) if args.workers > 1 else None
+    if worker_peak is not None:
+        print(f'Peak memory of a worker: {worker_peak:.0f} MB')
     
     # Print out the pdfs that ran into errors
     if not problem_pdfs:
@@ -1119,6 +2395,185 @@ def main():
         print(f'Error processing PDFs: {problem_pdfs}')
 
 
+def scan_pdf_folder(folder="PDFs"):
+    '''
+    The pdfs in a folder with their size and modification time
+    Args:
+        folder (str): the folder to look in
+    Returns:
+        dict(str, tuple(int, int)): (size, mtime_ns) of each pdf, keyed by
+            path in the same form as get_pdf_list
+    '''
+    root = os.path.abspath(folder)
+    out = {}
+    for entry in os.scandir(root):
+        if entry.is_file() and entry.name.endswith('.pdf'):
+            stat = entry.stat()
+            out[os.path.join(root, entry.name)] = (stat.st_size, stat.st_mtime_ns)
+    return out
+
+
+def watch_folder(args):
+    '''
+    Keeps running, extracting the pdfs that are added to or changed in the
+    --pdf-dir folder and writing their rows to the output, until Ctrl-C. A pdf
+    is only picked up once its size and modification time have stayed the
+    same for args.settle seconds, so files still being copied in are left
+    alone. The output of earlier runs is continued, the pdfs already in it
+    are not redone unless they changed, even while nothing was watching. A
+    changed pdf's new row replaces its old one, one whose contents are the
+    same (e.g. it was only touched) keeps it.
+    Args:
+        args (argparse.Namespace): the command line arguments
+    '''
+    output_path = args.output
+    output = BatchOutput(output_path, resume=True)
+    cache = open_cache(args)
+    
+    # the pool is started once and kept warm between batches
+    executor = None
+    if args.workers > 1 and args.isolation is None:
+        from concurrent.futures import ProcessPoolExecutor
+        
+        executor = ProcessPoolExecutor(max_workers=args.workers, initializer=worker_logging())
+    
+    current = scan_pdf_folder(args.pdf_dir)
+    # (size, mtime_ns) of each pdf whose row is up to date. A pdf that
+    # changed since its row was written is picked up like a new one, unless
+    # its row was recorded without them
+    seen = {}
+    for path, stat in current.items():
+        entry = output.done.get(path)
+        if entry is not None and (entry[1] is None or entry[1:3] == stat):
+            seen[path] = stat
+    # (size, mtime_ns) of each new or changed pdf and when it was last seen changing
+    pending = {}
+    problem_pdfs = []
+    print(f'Watching {args.pdf_dir}, {len(seen)} pdfs already in {output_path}. Press Ctrl-C to stop \n')
+    try:
+        while True:
+            now = time.monotonic()
+            ready = []
+            for path, stat in current.items():
+                if seen.get(path) == stat:
+                    continue
+                if path not in pending or pending[path][0] != stat:
+                    pending[path] = (stat, now)
+                elif now - pending[path][1] >= args.settle:
+                    ready.append(path)
+            pending = {path: v for path, v in pending.items() if path in current and path not in ready}
+            
+            # a pdf only touched keeps its row, it isn't extracted again
+            for path in list(ready):
+                entry = output.done.get(path)
+                if entry is None or entry[3] is None:
+                    continue
+                try:
+                    unchanged = pdf_sha256(path, cache) == entry[3]
+                except OSError:
+                    unchanged = False
+                if unchanged:
+                    seen[path] = current[path]
+                    ready.remove(path)
+            
+            if ready:
+                try:
+                    results = list(process_pdfs(ready, args.workers, cache, executor=executor,
+                                                prefetch=args.prefetch,
+                                                prefetch_budget=int(args.prefetch_mb * 2**20),
+                                                isolation=args.isolation))
+                except Exception:
+                    # a pdf that can't be opened, go one at a time to find it
+                    if executor is not None:
+                        executor.shutdown(cancel_futures=True)
+                        executor = ProcessPoolExecutor(max_workers=args.workers,
+                                                       initializer=worker_logging())
+                    results = []
+                    for path in ready:
+                        try:
+                            results += list(process_pdfs([path], 1, cache))
+                        except Exception as e:
+                            print(f'Could not process {path}: {e}')
+                            results.append(None)
+                
+                rows = []
+                for path, result in zip(ready, results):
+                    seen[path] = current[path]
+                    if result is not None and result[0] is None:
+                        print(f'Could not process {path}: {result[1]}')
+                        problem_pdfs.append(f'{path} ({result[1]})')
+                        continue
+                    if result is None or result[1]:
+                        problem_pdfs.append(path)
+                    if result is not None:
+                        rows.append((path, result[0]))
+                
+                # the old rows of changed pdfs go, so each pdf has one row
+                changed = {path for path, row in rows if path in output.done}
+                output.drop(changed)
+                for path, row in rows:
+                    row['fname'] = os.path.basename(path)
+                    # the hash tells a later touch from a change
+                    try:
+                        sha256 = pdf_sha256(path, cache)
+                    except OSError:
+                        sha256 = None
+                    output.write(path, row.values, sha256)
+                    print(f'{"Updated" if path in changed else "Added"} {row["fname"]} in {output_path}')
+                # commit the batch so it can be queried straight away
+                output.flush()
+            
+            time.sleep(args.poll_interval)
+            current = scan_pdf_folder(args.pdf_dir)
+    except KeyboardInterrupt:
+        print('Stopped watching')
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        output.close()
+        if cache is not None:
+            print(cache.summary())
+            cache.close()
+    
+    if problem_pdfs:
+        print(f'Error processing PDFs: {problem_pdfs}')
+
+
+def main(argv=None):
+    '''
+    Main function. Processes all pdfs in the PDFs folder (or --pdf-dir), or
+    just the pdfs given on the command line
+    '''
+    args = parse_args(argv)
+    # the rows go to stdout as JSON for single pdfs, keep the messages apart
+    configure_logging(to_stderr=bool(args.pdfs))
+    if args.pdfs:
+        return 1 if extract_files(args.pdfs) else 0
+    if args.watch:
+        watch_folder(args)
+        return 0
+    if args.serve:
+        from server import serve
+        
+        serve(args.host, args.port, args.workers, args.max_concurrent, args.max_queue,
+              args.max_mb, args.timeout, args.queue_timeout, args.memory_limit)
+        return 0
+    if args.profile:
+        import cProfile
+        import pstats
+        
+        if args.workers > 1:
+            print('Note: --profile only sees this process, not the worker processes \n')
+        profiler = cProfile.Profile()
+        profiler.runcall(run_batch, args)
+        profiler.dump_stats(args.profile)
+        print(f'Saved profile to {args.profile}, the slowest calls:')
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+    else:
+        run_batch(args)
+    return 0
+
+
 
 if __name__=="__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,222 @@
+'''
+Runs each pdf in a separate worker process with a time limit and a memory
+cap, so a file that hangs PyMuPDF or eats all the memory is killed and
+reported instead of stalling or taking down the whole batch.
+'''
+import multiprocessing
+import time
+from collections import deque
+from multiprocessing.connection import wait
+
+
+def limit_memory(megabytes):
+    '''
+    Caps the address space of this process, allocations past it raise
+    MemoryError. Only on Linux and macOS, on Windows the runner watches the
+    workers' memory instead
+
+    Args:
+        megabytes(float): the cap
+    Returns:
+        bool: whether the cap could be set
+    '''
+    try:
+        import resource
+    except ImportError:
+        return False
+    cap = int(megabytes * 2**20)
+    resource.setrlimit(resource.RLIMIT_AS, (cap, cap))
+    return True
+
+
+def _worker(conn, function, memory_mb, initializer):
+    '''
+    Worker process loop: runs function on each item received on conn and
+    sends back ('ok', result), ('error', reason) if it raised or
+    ('memory', reason) if it went over the memory cap. Stops on None
+    '''
+    if initializer is not None:
+        initializer()
+    if memory_mb:
+        limit_memory(memory_mb)
+    while True:
+        try:
+            item = conn.recv()
+        except EOFError:
+            return
+        if item is None:
+            return
+        try:
+            conn.send(('ok', function(item)))
+        except MemoryError:
+            conn.send(('memory', f'ran out of memory (over the {memory_mb:g} MB cap)'))
+        except Exception as e:
+            conn.send(('error', f'{type(e).__name__}: {e}'))
+
+
+class WorkerProcess:
+    '''
+    One worker process and the item it is working on. Items are sent on
+    conn and each gets a (status, value) reply, see _worker
+
+    Args:
+        context(multiprocessing.context.BaseContext): starts the process
+        function(callable): run on each item, must be picklable
+        memory_mb(float): the most memory the process may use, None for no cap
+        initializer(callable): run once when the process starts, None for nothing
+    '''
+    def __init__(self, context, function, memory_mb, initializer):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker,
+                                       args=(child_conn, function, memory_mb, initializer),
+                                       daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.task = None
+        self.deadline = None
+
+    def send(self, task, timeout):
+        self.task = task
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.conn.send(task[1])
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class IsolatedRunner:
+    '''
+    A set of worker processes that run a function on one item at a time
+    each. An item that takes longer than timeout seconds, goes over the
+    memory cap or crashes its worker gets the worker killed and replaced,
+    and is tried again up to retries more times before it is given up on.
+    An item the function raises on isn't retried, it would raise again.
+
+    Args:
+        function(callable): run on each item in the workers, must be
+            picklable e.g. a module level function
+        workers(int): the number of worker processes
+        timeout(float): seconds an item may take, None for no limit
+        memory_mb(float): the most memory a worker may use, None for no cap
+        retries(int): how many more times to try an item that failed
+        initializer(callable): run once at the start of each worker, e.g.
+            to set up logging, None for nothing
+    '''
+    def __init__(self, function, workers=1, timeout=None, memory_mb=None, retries=0,
+                 initializer=None):
+        self.function = function
+        self.initializer = initializer
+        self.nworkers = max(1, workers)
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self.retries = retries
+        self.context = multiprocessing.get_context()
+        self.workers = []
+        self.watch_rss = False
+        if memory_mb:
+            try:
+                import resource  # noqa: F401
+            except ImportError:
+                # no RLIMIT_AS on Windows, poll the workers' memory instead
+                import psutil  # noqa: F401
+                self.watch_rss = True
+
+    def _start_worker(self):
+        worker = WorkerProcess(self.context, self.function, self.memory_mb, self.initializer)
+        self.workers.append(worker)
+        return worker
+
+    def _over_memory(self, worker):
+        import psutil
+
+        try:
+            rss = psutil.Process(worker.process.pid).memory_info().rss
+        except psutil.Error:
+            return False
+        return rss > self.memory_mb * 2**20
+
+    def _fail(self, worker, reason, todo, done):
+        '''
+        Kills a worker and retries or gives up on its item
+        '''
+        index, item, attempt = worker.task
+        worker.kill()
+        self.workers.remove(worker)
+        if attempt < self.retries:
+            todo.appendleft((index, item, attempt + 1))
+        else:
+            done[index] = (False, reason)
+
+    def run(self, items):
+        '''
+        Runs the function on every item
+
+        Args:
+            items(list(any)): the items, e.g. pdf paths
+        Returns:
+            generator(tuple(bool, any)): for each item in order, (True, the
+                function's result) or (False, why it failed)
+        '''
+        todo = deque((i, item, 0) for i, item in enumerate(items))
+        done = {}
+        next_index = 0
+        while next_index < len(items):
+            idle = [w for w in self.workers if w.task is None]
+            while todo and (idle or len(self.workers) < self.nworkers):
+                worker = idle.pop() if idle else self._start_worker()
+                worker.send(todo.popleft(), self.timeout)
+
+            busy = [w for w in self.workers if w.task is not None]
+            now = time.monotonic()
+            deadlines = [w.deadline for w in busy if w.deadline is not None]
+            wait_for = max(0.0, min(deadlines) - now) if deadlines else None
+            if self.watch_rss:
+                wait_for = 0.5 if wait_for is None else min(wait_for, 0.5)
+            ready = wait([w.conn for w in busy] + [w.process.sentinel for w in busy], wait_for)
+
+            for worker in busy:
+                if worker.conn in ready:
+                    try:
+                        status, value = worker.conn.recv()
+                    except (EOFError, OSError):
+                        pass
+                    else:
+                        if status == 'memory':
+                            # start over in a fresh process
+                            self._fail(worker, value, todo, done)
+                        else:
+                            done[worker.task[0]] = (status == 'ok', value)
+                            worker.task = None
+                        continue
+                if not worker.process.is_alive():
+                    self._fail(worker, f'worker crashed (exit code {worker.process.exitcode})', todo, done)
+                elif worker.deadline is not None and time.monotonic() >= worker.deadline:
+                    self._fail(worker, f'timed out after {self.timeout:g}s', todo, done)
+                elif self.watch_rss and self._over_memory(worker):
+                    self._fail(worker, f'ran out of memory (over the {self.memory_mb:g} MB cap)', todo, done)
+
+            while next_index in done:
+                yield done.pop(next_index)
+                next_index += 1
+
+    def close(self):
+        for worker in self.workers:
+            if worker.task is None:
+                try:
+                    worker.conn.send(None)
+                except OSError:
+                    pass
+                worker.process.join(1)
+            if worker.process.is_alive():
+                worker.process.kill()
+                worker.process.join()
+            worker.conn.close()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,616 @@
+'''
+Writers that save extracted rows as the pdfs finish, instead of rebuilding
+the whole output file after every document: a csv, or a SQLite database
+for querying.
+'''
+import csv
+import gzip
+import hashlib
+import io
+import json
+import math
+import os
+import re
+
+
+def format_value(value):
+    '''
+    Formats a value for a csv cell, nan becomes an empty cell like pandas
+
+    Args:
+        value(any): the value to format
+    Returns:
+        str: the cell text
+    '''
+    if isinstance(value, float) and math.isnan(value):
+        return ''
+    return value
+
+
+class CsvRowWriter:
+    '''
+    Appends rows to a csv file one at a time. The columns are fixed when the
+    writer is created, each row is written once and flushed so everything
+    finished so far is on disk if the run dies. The layout matches
+    pandas.DataFrame.to_csv: an unnamed index column, then one column per
+    field, with missing values left empty.
+
+    Args:
+        path(str): the file to write
+        columns(list(str)): every column, in output order
+        compress(bool): gzip the file
+        resume_offset(int): keep the file up to this byte offset and append
+            after it instead of starting a new file. None to start over
+        nrows(int): the number of rows already in the file when resuming
+    '''
+    def __init__(self, path, columns, compress=False, resume_offset=None, nrows=0):
+        self.path = path
+        self.columns = columns
+        self.column_set = set(columns)
+        self.nrows = nrows
+        if resume_offset is not None:
+            if compress:
+                raise ValueError('Cannot resume a compressed output file')
+            self.file = open(path, 'r+b')
+            # drop anything after the last recorded row, e.g. a half written row
+            self.file.truncate(resume_offset)
+            self.file.seek(resume_offset)
+        elif compress:
+            self.file = gzip.open(path, 'wb')
+        else:
+            self.file = open(path, 'wb')
+        # csv formats into a text buffer, the file itself is written as bytes
+        self._buffer = io.StringIO()
+        self._csv = csv.writer(self._buffer, lineterminator=os.linesep)
+        if resume_offset is None:
+            self._write([''] + columns)
+
+    def _write(self, cells):
+        self._csv.writerow(cells)
+        self.file.write(self._buffer.getvalue().encode('utf-8'))
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self.file.flush()
+
+    def write_row(self, row):
+        '''
+        Writes one document's values
+
+        Args:
+            row(dict(str, any)): the values of one document, keyed by column
+        Returns:
+            None
+        '''
+        unknown = [key for key in row if key not in self.column_set]
+        if unknown:
+            raise ValueError(f'Columns missing from the output schema: {unknown}')
+        self._write([self.nrows] + [format_value(row.get(c, math.nan)) for c in self.columns])
+        self.nrows += 1
+
+    def write_values(self, values):
+        '''
+        Writes one document's values, already in column order
+
+        Args:
+            values(list(any)): one value per column
+        Returns:
+            None
+        '''
+        if len(values) != len(self.columns):
+            raise ValueError(f'Expected {len(self.columns)} values, got {len(values)}')
+        self._write([self.nrows] + [format_value(v) for v in values])
+        self.nrows += 1
+
+    @property
+    def offset(self):
+        '''
+        The byte offset just past the last row written
+        '''
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# output files with these extensions are written by SqliteRowWriter
+SQLITE_EXTENSIONS = ('.sqlite', '.sqlite3', '.db')
+
+# m/d/yyyy, the date format of the reports
+US_DATE = re.compile(r'(\d{1,2})/(\d{1,2})/(\d{4})')
+
+
+def quote_name(name):
+    '''
+    Quotes a column or table name for SQL, the field names have ':' in them
+    '''
+    return '"' + name.replace('"', '""') + '"'
+
+
+def sqlite_value(value, date=False):
+    '''
+    Converts a value for SqliteRowWriter: nan and empty text become NULL,
+    text is stripped, and with date an m/d/yyyy date becomes yyyy-mm-dd
+
+    Args:
+        value(any): the value
+        date(bool): whether the column holds dates
+    Returns:
+        any: the value to store
+    '''
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if isinstance(value, str):
+        value = value.strip()
+        if not value:
+            return None
+        if date:
+            match = US_DATE.fullmatch(value)
+            if match:
+                month, day, year = match.groups()
+                return f'{year}-{int(month):02d}-{int(day):02d}'
+    return value
+
+
+class SqliteRowWriter:
+    '''
+    Upserts rows into a table of a SQLite database, so the output can be
+    queried by hospital number, study date or study number without reading
+    all of it. Each row is stored with the pdf's path, sha256, size and
+    modification time. A row for
+    a study already in the table replaces it: rows are matched on their
+    study number, or on the pdf's sha256 if it has none. Rows are buffered
+    and written batch_size at a time with one executemany per transaction,
+    so a run that dies loses at most the rows of the last batch.
+
+    Text is stripped and empty cells are NULL. The text columns are stored
+    as text, the rest as numbers where they are numbers. Dates in the date
+    columns are stored as yyyy-mm-dd, so they sort and compare as dates.
+
+    Args:
+        path(str): the database file, created if missing
+        columns(list(str)): every column, in output order. Columns missing
+            from an existing table are added to it
+        text_columns(list(str)): columns always kept as text, e.g. ids
+            with leading zeros
+        date_columns(list(str)): columns of m/d/yyyy dates
+        key_column(str): the column rows are matched on
+        index_columns(list(str)): columns to index
+        table(str): the table to write
+        batch_size(int): the most rows written per transaction
+    '''
+    # stored with every row, before the output columns
+    FILE_COLUMNS = ['path', 'file_sha256', 'file_size', 'file_mtime_ns']
+
+    def __init__(self, path, columns, text_columns=(), date_columns=(), key_column='study_number',
+                 index_columns=('hospital_number', 'study_date', 'study_number'),
+                 table='studies', batch_size=500):
+        import sqlite3
+
+        self.path = path
+        self.columns = columns
+        self.key_index = columns.index(key_column)
+        self.dates = [column in date_columns for column in columns]
+        self.table = table
+        self.batch_size = max(1, batch_size)
+        self.nrows = 0
+        self._pending = []
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+
+        text_columns = set(text_columns)
+        definitions = [f'{quote_name(c)} {"TEXT" if c in text_columns else "NUMERIC"}' for c in columns]
+        definitions = ['path TEXT', 'file_sha256 TEXT', 'file_size INTEGER',
+                       'file_mtime_ns INTEGER'] + definitions
+        self.db.execute(f'''CREATE TABLE IF NOT EXISTS {quote_name(table)} (
+            study_key TEXT PRIMARY KEY, {', '.join(definitions)})''')
+        existing = {info[1] for info in self.db.execute(f'PRAGMA table_info({quote_name(table)})')}
+        for column, definition in zip(self.FILE_COLUMNS + columns, definitions):
+            if column not in existing:
+                self.db.execute(f'ALTER TABLE {quote_name(table)} ADD COLUMN {definition}')
+        for column in index_columns:
+            if column in columns:
+                self.db.execute(f'CREATE INDEX IF NOT EXISTS {quote_name(f"{table}_{column}")} '
+                                f'ON {quote_name(table)} ({quote_name(column)})')
+        self.db.execute(f'CREATE INDEX IF NOT EXISTS {quote_name(f"{table}_path")} '
+                        f'ON {quote_name(table)} (path)')
+        self.db.commit()
+
+        names = ['study_key'] + self.FILE_COLUMNS + columns
+        updates = ', '.join(f'{quote_name(n)} = excluded.{quote_name(n)}' for n in names[1:])
+        self._upsert = (f'INSERT INTO {quote_name(table)} ({", ".join(map(quote_name, names))}) '
+                        f'VALUES ({", ".join("?" * len(names))}) '
+                        f'ON CONFLICT (study_key) DO UPDATE SET {updates}')
+
+    def files(self):
+        '''
+        The pdfs with a row in the table, e.g. to skip when resuming
+
+        Returns:
+            dict(str, tuple): (None, size, mtime_ns, sha256) of each pdf
+                when it was read, keyed by path like RunManifest.done
+        '''
+        self.flush()
+        found = self.db.execute(f'SELECT path, file_size, file_mtime_ns, file_sha256 '
+                                f'FROM {quote_name(self.table)} WHERE path IS NOT NULL')
+        return {path: (None, size, mtime_ns, sha256) for path, size, mtime_ns, sha256 in found}
+
+    def delete_paths(self, paths):
+        '''
+        Deletes the rows of some pdfs, e.g. ones that changed
+
+        Args:
+            paths(list(str)): the pdfs
+        Returns:
+            None
+        '''
+        self.flush()
+        with self.db:
+            self.db.executemany(f'DELETE FROM {quote_name(self.table)} WHERE path = ?',
+                                [(path,) for path in paths])
+
+    def write_values(self, values, path=None, sha256=None, stat=None):
+        '''
+        Adds one document's values to the batch, writing the batch if it is full
+
+        Args:
+            values(list(any)): one value per column, in column order
+            path(str): the pdf the row came from
+            sha256(str): the pdf's sha256, hashed from path if it is needed
+                to match the row (no study number) and not given
+            stat(tuple(int, int)): the pdf's size and mtime_ns
+        Returns:
+            None
+        '''
+        if len(values) != len(self.columns):
+            raise ValueError(f'Expected {len(self.columns)} values, got {len(values)}')
+        values = [sqlite_value(v, date) for v, date in zip(values, self.dates)]
+        study_number = values[self.key_index]
+        if sha256 is None and study_number is None and path is not None:
+            from extract_cache import file_sha256
+
+            sha256 = file_sha256(path)
+        if study_number is not None:
+            key = f'study:{study_number}'
+        elif sha256 is not None:
+            key = f'sha256:{sha256}'
+        else:
+            # nothing to match on, never replaced
+            key = f'path:{path}'
+        size, mtime_ns = stat if stat is not None else (None, None)
+        self._pending.append([key, path, sha256, size, mtime_ns] + values)
+        self.nrows += 1
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes the buffered rows in one transaction
+        '''
+        if not self._pending:
+            return
+        with self.db:
+            self.db.executemany(self._upsert, self._pending)
+        self._pending = []
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class RunManifest:
+    '''
+    Checkpoint of a batch run: a JSON lines file that records each pdf once
+    its row is in the output, with the row number, the output's byte
+    offset after it and the pdf's size, modification time and sha256 (if
+    known) when it was read. A resumed run skips the recorded pdfs and cuts
+    the output back to the last recorded offset before appending. done
+    holds (row, size, mtime_ns, sha256) of each recorded pdf, None for the
+    ones a manifest from before they were recorded doesn't have.
+
+    Args:
+        path(str): the manifest file
+        columns(list(str)): the output columns, a run can only be resumed
+            with the same schema
+        resume(bool): load an existing manifest instead of starting a new one
+    '''
+    def __init__(self, path, columns, resume=False):
+        self.path = path
+        self.schema = hashlib.sha1('\n'.join(columns).encode('utf-8')).hexdigest()
+        self.done = {}
+        self.nrows = 0
+        self.offset = None
+        if resume and os.path.exists(path) and os.path.getsize(path) > 0:
+            self._load()
+            self.file = open(path, 'ab')
+        else:
+            self.file = open(path, 'wb')
+            self._append({'schema': self.schema, 'columns': len(columns)})
+
+    def _load(self):
+        valid_end = 0
+        with open(self.path, 'rb') as f:
+            header = json.loads(f.readline())
+            if header.get('schema') != self.schema:
+                raise ValueError(f'{self.path} was written with different output columns, cannot resume')
+            valid_end = f.tell()
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # the run died while writing this line
+                    break
+                entry = json.loads(line)
+                self.done[entry['path']] = (entry['row'], entry.get('size'), entry.get('mtime_ns'),
+                                            entry.get('sha256'))
+                self.nrows = entry['row'] + 1
+                self.offset = entry['offset']
+                valid_end = f.tell()
+        with open(self.path, 'r+b') as f:
+            f.truncate(valid_end)
+
+    def _append(self, entry):
+        self.file.write(json.dumps(entry).encode('utf-8') + b'\n')
+        self.file.flush()
+
+    def record(self, path, row, offset, stat=None, sha256=None):
+        '''
+        Records a pdf whose row has been written
+
+        Args:
+            path(str): the pdf
+            row(int): its row number in the output
+            offset(int): the output's byte offset after the row
+            stat(tuple(int, int)): the pdf's size and mtime_ns, None if unknown
+            sha256(str): the pdf's sha256, None if unknown
+        Returns:
+            None
+        '''
+        size, mtime_ns = stat if stat is not None else (None, None)
+        self.done[path] = (row, size, mtime_ns, sha256)
+        self.nrows = row + 1
+        self.offset = offset
+        self._append({'path': path, 'row': row, 'offset': offset,
+                      'size': size, 'mtime_ns': mtime_ns, 'sha256': sha256})
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def remove_csv_rows(path, columns, manifest_path, paths):
+    '''
+    Rewrites an output csv and its manifest without the rows of some pdfs,
+    e.g. ones that changed and are about to get a new row. The other rows
+    keep their order and are numbered again. Rows the manifest doesn't
+    record, e.g. one half written when a run died, are dropped too
+
+    Args:
+        path(str): the csv, written by CsvRowWriter without compression
+        columns(list(str)): every column, in output order
+        manifest_path(str): its RunManifest, closed
+        paths(set(str)): the pdfs whose rows to remove
+    Returns:
+        None
+    '''
+    entries = {}
+    with open(manifest_path, 'rb') as f:
+        f.readline()
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            entry = json.loads(line)
+            entries[entry['row']] = entry
+
+    new_path = path + '.tmp'
+    new_manifest_path = manifest_path + '.tmp'
+    with open(path, encoding='utf-8', newline='') as f, \
+            CsvRowWriter(new_path, columns) as writer, \
+            RunManifest(new_manifest_path, columns) as manifest:
+        reader = csv.reader(f)
+        next(reader)
+        for i, cells in enumerate(reader):
+            entry = entries.get(i)
+            if entry is None or entry['path'] in paths:
+                continue
+            writer.write_values(cells[1:])
+            stat = None if entry.get('size') is None else (entry['size'], entry['mtime_ns'])
+            manifest.record(entry['path'], writer.nrows - 1, writer.offset, stat, entry.get('sha256'))
+    os.replace(new_path, path)
+    os.replace(new_manifest_path, manifest_path)
+
+
+# values treated as missing when deciding whether a column is numeric
+MISSING_CELLS = {'', '-'}
+
+# a number followed by its unit, e.g. '573.7 min' or '88.5%'
+NUMBER_WITH_UNIT = re.compile(r'([-+]?(?:\d+\.?\d*|\.\d+))\s*(%|[A-Za-z]+)')
+
+
+def read_csv_columns(path):
+    '''
+    Reads an output csv back into columns of cell text, without the index
+
+    Args:
+        path(str): the csv, read as gzip if it ends in .gz
+    Returns:
+        dict(str, list(str)): the cells of each column, in file order
+    '''
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)[1:]
+        cells = [[] for _ in header]
+        for line in reader:
+            for column, value in zip(cells, line[1:]):
+                column.append(value)
+    return dict(zip(header, cells))
+
+
+def to_floats(cells):
+    '''
+    Converts a column of cell text to floats. Units and percent signs are
+    dropped like values_to_float in extract_stats does ('88.5%' -> 88.5),
+    as long as every cell in the column has the same one
+
+    Args:
+        cells(list(str)): the column
+    Returns:
+        list(float): the values with missing cells as nan, or None if any
+            cell isn't a number
+    '''
+    out = []
+    units = set()
+    for cell in cells:
+        cell = cell.strip()
+        if cell in MISSING_CELLS:
+            out.append(math.nan)
+            continue
+        try:
+            out.append(float(cell))
+            units.add('')
+        except ValueError:
+            match = NUMBER_WITH_UNIT.fullmatch(cell)
+            if match is None:
+                return None
+            out.append(float(match[1]))
+            units.add(match[2])
+        if len(units) > 1:
+            # e.g. minutes in some rows and hours in others
+            return None
+    return out
+
+
+def columnar_format(fmt='auto'):
+    '''
+    Picks the columnar format, parquet if pyarrow is installed, else npy
+
+    Args:
+        fmt(str): 'parquet', 'npy' or 'auto'
+    Returns:
+        str: 'parquet' or 'npy'
+    '''
+    if fmt != 'auto':
+        return fmt
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return 'npy'
+    return 'parquet'
+
+
+def write_columnar(csv_path, path, categorical=(), text=(), fmt='auto'):
+    '''
+    Writes a typed columnar copy of an output csv. Columns where every
+    value is a number, or a number with the same unit, are stored as
+    float64 (empty and '-' cells become nan), the categorical columns are
+    dictionary encoded and everything else, the text columns always, is
+    kept as text. Text is stripped, as in the SQLite output.
+
+    Args:
+        csv_path(str): the csv written by CsvRowWriter
+        path(str): the file to write, without the extension
+        categorical(list(str)): text columns with few distinct values
+        text(list(str)): columns kept as text even if they look numeric,
+            e.g. ids with leading zeros
+        fmt(str): 'parquet', 'npy' or 'auto'. npy is a folder of one .npy
+            file per column, so columns can be memory mapped
+    Returns:
+        str: the path written, with the extension
+    '''
+    import numpy as np
+
+    fmt = columnar_format(fmt)
+    path = f'{path}.{fmt}'
+    columns = read_csv_columns(csv_path)
+    typed = {}
+    for name, cells in columns.items():
+        floats = None if name in text else to_floats(cells)
+        if floats is not None:
+            typed[name] = np.array(floats, dtype=np.float64)
+        elif name in categorical:
+            cells = np.array([cell.strip() for cell in cells], dtype=str)
+            categories, codes = np.unique(cells, return_inverse=True)
+            typed[name] = (codes.astype(np.int32), categories)
+        else:
+            typed[name] = np.array([cell.strip() for cell in cells], dtype=str)
+
+    if fmt == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        arrays = []
+        for value in typed.values():
+            if isinstance(value, tuple):
+                arrays.append(pa.DictionaryArray.from_arrays(value[0], value[1]))
+            else:
+                arrays.append(pa.array(value))
+        pq.write_table(pa.table(arrays, names=list(typed)), path)
+    elif fmt == 'npy':
+        # the column names aren't all valid file names, the files are
+        # numbered and columns.json maps the names to them. Categoricals
+        # are stored as codes plus a <n>.categories.npy file
+        os.makedirs(path, exist_ok=True)
+        names = []
+        for i, (name, value) in enumerate(typed.items()):
+            if isinstance(value, tuple):
+                np.save(os.path.join(path, f'{i}.npy'), value[0])
+                np.save(os.path.join(path, f'{i}.categories.npy'), value[1])
+            else:
+                np.save(os.path.join(path, f'{i}.npy'), value)
+            names.append([name, isinstance(value, tuple)])
+        with open(os.path.join(path, 'columns.json'), 'w') as f:
+            json.dump(names, f)
+    else:
+        raise ValueError(f'Unknown columnar format: {fmt}')
+    return path
+
+
+def load_columnar(path, columns=None):
+    '''
+    Loads the output written by write_columnar as a DataFrame. The columns
+    are memory mapped, not read into memory up front
+
+    Args:
+        path(str): the .parquet file or .npy folder
+        columns(list(str)): only load these columns, None for all of them
+    Returns:
+        pandas.DataFrame: the output, with the categorical columns as
+            pandas categoricals
+    '''
+    import pandas as pd
+
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        return pq.read_table(path, columns=columns, memory_map=True).to_pandas()
+
+    import numpy as np
+
+    with open(os.path.join(path, 'columns.json')) as f:
+        files = {name: (i, categorical) for i, (name, categorical) in enumerate(json.load(f))}
+    data = {}
+    for name in columns if columns is not None else list(files):
+        i, categorical = files[name]
+        values = np.load(os.path.join(path, f'{i}.npy'), mmap_mode='r')
+        if categorical:
+            categories = np.load(os.path.join(path, f'{i}.categories.npy'))
+            data[name] = pd.Categorical.from_codes(values, categories)
+        else:
+            data[name] = values
+    return pd.DataFrame(data, copy=False)
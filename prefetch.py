@@ -0,0 +1,87 @@
+'''
+Reads the next few pdfs into memory on a background thread while the
+current one is being parsed, so time spent waiting on a slow disk or
+network share overlaps with the extraction instead of adding to it.
+'''
+import os
+import threading
+import time
+from collections import deque
+
+
+class PdfPrefetcher:
+    '''
+    Iterates over (path, data) of each pdf in order, with the bytes read
+    ahead of time by a background thread. At most depth files, and no more
+    than budget bytes between them, are held in memory waiting to be used.
+    A file bigger than the whole budget is still read, once nothing else is
+    waiting. data is None if the file couldn't be read, opening it from the
+    path then raises the error where it would have without prefetching.
+
+    Args:
+        paths(list(str)): the pdfs, in the order they will be used
+        depth(int): the most files to read ahead
+        budget(int): the most bytes to read ahead
+    '''
+    def __init__(self, paths, depth=4, budget=256 * 2**20):
+        self.paths = paths
+        self.depth = max(1, depth)
+        self.budget = budget
+        self._ready = deque()
+        self._held = 0
+        self._finished = False
+        self._stop = False
+        self._cond = threading.Condition()
+        # seconds the consumer spent waiting on a file that wasn't read yet
+        self.wait_time = 0.0
+
+    def _has_room(self, size):
+        if not self._ready:
+            return True
+        return len(self._ready) < self.depth and self._held + size <= self.budget
+
+    def _read_ahead(self):
+        for path in self.paths:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = 0
+            with self._cond:
+                while not self._stop and not self._has_room(size):
+                    self._cond.wait()
+                if self._stop:
+                    return
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                data = None
+            with self._cond:
+                self._ready.append((path, data))
+                self._held += len(data) if data is not None else 0
+                self._cond.notify_all()
+        with self._cond:
+            self._finished = True
+            self._cond.notify_all()
+
+    def __iter__(self):
+        thread = threading.Thread(target=self._read_ahead, name='pdf-prefetch', daemon=True)
+        thread.start()
+        try:
+            while True:
+                with self._cond:
+                    start = time.perf_counter()
+                    while not self._ready and not self._finished:
+                        self._cond.wait()
+                    self.wait_time += time.perf_counter() - start
+                    if not self._ready:
+                        return
+                    path, data = self._ready.popleft()
+                    self._held -= len(data) if data is not None else 0
+                    self._cond.notify_all()
+                yield path, data
+        finally:
+            with self._cond:
+                self._stop = True
+                self._cond.notify_all()
+            thread.join()
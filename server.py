@@ -0,0 +1,406 @@
+'''
+Serves the extractor over HTTP on localhost, so other tools can extract a
+single report on demand without starting Python and importing PyMuPDF for
+each one. A pool of worker processes is started and warmed up once, a pdf
+POSTed to /extract is handed to a free worker and its record comes back as
+JSON, the same record extract_report returns:
+
+    python extract_stats.py --serve --workers 4
+    curl --data-binary @report.pdf http://127.0.0.1:8765/extract?name=report.pdf
+
+GET /metrics gives the request latencies, queue depth and request counts
+in the Prometheus text format. Only the standard library is used.
+'''
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import extract_stats
+from isolated import WorkerProcess
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def warm_up():
+    '''
+    Opens a blank pdf, run once in each worker so the first request doesn't
+    pay for starting the process and loading PyMuPDF
+
+    Returns:
+        int: the worker's process id
+    '''
+    import fitz  # PyMuPDF
+
+    with fitz.open() as document:
+        document.new_page()
+        data = document.tobytes()
+    with fitz.open(stream=data, filetype='pdf') as document:
+        document[0].get_text()
+    return os.getpid()
+
+
+def init_worker(configure_logging=None):
+    '''
+    Run when a worker starts. Ctrl-C is left to the server, which stops
+    the workers itself
+
+    Args:
+        configure_logging(callable): sets up the worker's logging, None to leave it
+    '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if configure_logging is not None:
+        configure_logging()
+
+
+def run_request(item):
+    '''
+    What a worker runs for each request
+
+    Args:
+        item(tuple(bytes, str)): the pdf and its fname, (None, None) to warm up
+    Returns:
+        dict(str, any): the pdf's record, or the worker's process id for a warm up
+    '''
+    data, name = item
+    if data is None:
+        return warm_up()
+    return extract_stats.extract_report(data, name)
+
+
+class LatencyHistogram:
+    '''
+    Counts of how long something took, in cumulative buckets
+
+    Args:
+        buckets(tuple(float)): the bucket upper bounds in seconds, ascending
+    '''
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def lines(self, name, description):
+        '''
+        The histogram in the Prometheus text format
+
+        Args:
+            name(str): the metric name
+            description(str): its help text
+        Returns:
+            list(str): the lines
+        '''
+        out = [f'# HELP {name} {description}', f'# TYPE {name} histogram']
+        for bound, count in zip(self.buckets, self.counts):
+            out.append(f'{name}_bucket{{le="{bound:g}"}} {count}')
+        out.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        out.append(f'{name}_sum {self.sum:.6f}')
+        out.append(f'{name}_count {self.count}')
+        return out
+
+
+class ExtractionService:
+    '''
+    The worker processes, the concurrency limit and the metrics shared by
+    the request threads. At most max_concurrent pdfs are extracted at once,
+    up to max_queue more requests wait for a slot and any past that, or
+    that wait longer than queue_timeout, are turned away. A worker that
+    takes longer than timeout, runs out of memory or crashes is killed and
+    replaced, so a pdf that hangs doesn't keep its slot
+
+    Args:
+        workers(int): the number of worker processes
+        max_concurrent(int): the most pdfs extracted at once, workers by default
+        max_queue(int): the most requests waiting for a slot
+        timeout(float): seconds to wait for a pdf's record, None for no limit
+        queue_timeout(float): seconds a request may wait for a slot, None
+            for no limit
+        memory_mb(float): the most memory a worker may use, None for no cap
+    '''
+    def __init__(self, workers=1, max_concurrent=None, max_queue=32, timeout=None,
+                 queue_timeout=30, memory_mb=None):
+        self.workers = max(1, workers)
+        self.max_concurrent = max_concurrent or self.workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.memory_mb = memory_mb
+        self.context = multiprocessing.get_context()
+        self.slots = threading.BoundedSemaphore(self.max_concurrent)
+        self.lock = threading.Lock()
+        # the warm workers not extracting anything
+        self.idle = queue.Queue()
+        self.running = []
+        self.waiting = 0
+        self.in_flight = 0
+        self.restarts = 0
+        self.responses = {}
+        self.request_latency = LatencyHistogram()
+        self.queue_latency = LatencyHistogram()
+
+    def _new_worker(self):
+        '''
+        Starts a worker process and sends it a warm up
+        '''
+        worker = WorkerProcess(self.context, run_request, self.memory_mb,
+                               partial(init_worker, extract_stats.worker_logging()))
+        with self.lock:
+            self.running.append(worker)
+        worker.conn.send((None, None))
+        return worker
+
+    def _ready(self, worker):
+        '''
+        Waits for a worker's warm up, then lets it take requests
+
+        Returns:
+            int: the worker's process id
+        '''
+        status, pid = worker.conn.recv()
+        if status != 'ok':
+            raise RuntimeError(f'worker could not warm up: {pid}')
+        self.idle.put(worker)
+        return pid
+
+    def start(self):
+        '''
+        Starts the worker processes and waits until each has warmed up
+
+        Returns:
+            int: the number of workers started
+        '''
+        # all started before waiting on any, so they warm up at the same time
+        started = [self._new_worker() for _ in range(self.workers)]
+        return len({self._ready(worker) for worker in started})
+
+    def _restart(self, worker):
+        '''
+        Kills a worker and warms up its replacement in the background, so
+        the request that found it stuck can answer straight away
+        '''
+        worker.kill()
+        with self.lock:
+            if worker not in self.running:
+                # the service was closed while it was working
+                return
+            self.running.remove(worker)
+            self.restarts += 1
+        threading.Thread(target=lambda: self._ready(self._new_worker()), daemon=True).start()
+
+    def count(self, code):
+        with self.lock:
+            self.responses[code] = self.responses.get(code, 0) + 1
+
+    def _run(self, worker, data, name):
+        '''
+        Has a worker extract one pdf, restarting it if it doesn't answer
+        in time, runs out of memory or crashes
+
+        Returns:
+            int: the HTTP status
+            dict(str, any): the record, or the error
+        '''
+        try:
+            worker.conn.send((data, name))
+            if not worker.conn.poll(self.timeout):
+                self._restart(worker)
+                return 504, {'error': f'not done after {self.timeout:g}s'}
+            status, value = worker.conn.recv()
+        except (EOFError, OSError):
+            self._restart(worker)
+            return 500, {'error': 'the worker crashed extracting this pdf'}
+        if status == 'memory':
+            self._restart(worker)
+            return 500, {'error': value}
+        self.idle.put(worker)
+        if status == 'error':
+            return 422, {'error': value}
+        return 200, value
+
+    def extract(self, data, name=None):
+        '''
+        Extracts one pdf in a worker, waiting for a free slot first
+
+        Args:
+            data(bytes): the pdf
+            name(str): the fname column, None to leave it empty
+        Returns:
+            int: the HTTP status
+            dict(str, any): the record, or the error
+        '''
+        start = time.perf_counter()
+        # only a request that can't have a slot straight away queues for one
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                if self.waiting >= self.max_queue:
+                    return 503, {'error': f'busy, {self.waiting} requests already waiting'}
+                self.waiting += 1
+            try:
+                acquired = self.slots.acquire(timeout=self.queue_timeout)
+            finally:
+                with self.lock:
+                    self.waiting -= 1
+            if not acquired:
+                return 503, {'error': f'no free worker after {self.queue_timeout:g}s'}
+
+        try:
+            # a worker being replaced may not be back yet
+            try:
+                worker = self.idle.get(timeout=self.queue_timeout)
+            except queue.Empty:
+                return 503, {'error': f'no free worker after {self.queue_timeout:g}s'}
+            with self.lock:
+                self.in_flight += 1
+                self.queue_latency.observe(time.perf_counter() - start)
+            try:
+                status, body = self._run(worker, data, name)
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+        finally:
+            self.slots.release()
+
+        with self.lock:
+            self.request_latency.observe(time.perf_counter() - start)
+        return status, body
+
+    def metrics(self):
+        '''
+        The metrics in the Prometheus text format
+
+        Returns:
+            str: the metrics
+        '''
+        with self.lock:
+            lines = self.request_latency.lines(
+                'extract_request_seconds', 'Time from receiving a pdf to its record, queueing included')
+            lines += self.queue_latency.lines(
+                'extract_queue_wait_seconds', 'Time a request waited for a free worker')
+            lines += [
+                '# HELP extract_queue_depth Requests waiting for a free worker',
+                '# TYPE extract_queue_depth gauge',
+                f'extract_queue_depth {self.waiting}',
+                '# HELP extract_in_flight Pdfs being extracted',
+                '# TYPE extract_in_flight gauge',
+                f'extract_in_flight {self.in_flight}',
+                '# HELP extract_workers Worker processes',
+                '# TYPE extract_workers gauge',
+                f'extract_workers {self.workers}',
+                '# HELP extract_worker_restarts_total Workers killed and replaced after a timeout, '
+                'running out of memory or crashing',
+                '# TYPE extract_worker_restarts_total counter',
+                f'extract_worker_restarts_total {self.restarts}',
+                '# HELP extract_responses_total Responses to /extract by status',
+                '# TYPE extract_responses_total counter',
+            ]
+            lines += [f'extract_responses_total{{code="{code}"}} {n}'
+                      for code, n in sorted(self.responses.items())]
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        with self.lock:
+            running, self.running = self.running, []
+        for worker in running:
+            worker.kill()
+
+
+class ExtractionHandler(BaseHTTPRequestHandler):
+    '''
+    POST /extract with the pdf as the body (?name= sets the fname column),
+    GET /metrics for the metrics
+    '''
+    server_version = 'sleep-pdf-extract'
+
+    def send_body(self, status, body, content_type):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        if status == 503:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_json(self, status, body):
+        if self.path.startswith('/extract'):
+            self.server.service.count(status)
+        self.send_body(status, json.dumps(body), 'application/json')
+
+    def do_GET(self):
+        if urlsplit(self.path).path == '/metrics':
+            self.send_body(200, self.server.service.metrics(), 'text/plain; version=0.0.4')
+        else:
+            self.send_json(404, {'error': 'POST a pdf to /extract, or GET /metrics'})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != '/extract':
+            self.send_json(404, {'error': 'POST a pdf to /extract'})
+            return
+        length = self.headers.get('Content-Length')
+        if length is None or not length.isdigit():
+            self.send_json(411, {'error': 'Content-Length is needed'})
+            return
+        if int(length) > self.server.max_bytes:
+            # the body isn't read, so the connection can't be reused
+            self.close_connection = True
+            self.send_json(413, {'error': f'bigger than {self.server.max_bytes} bytes'})
+            return
+        data = self.rfile.read(int(length))
+        if b'%PDF' not in data[:1024]:
+            self.send_json(400, {'error': 'the body is not a pdf'})
+            return
+        name = parse_qs(url.query).get('name', [None])[0]
+        status, body = self.server.service.extract(data, name)
+        self.send_json(status, body)
+
+
+def serve(host='127.0.0.1', port=8765, workers=1, max_concurrent=None, max_queue=32,
+          max_mb=100, timeout=None, queue_timeout=30, memory_mb=None):
+    '''
+    Runs the server until Ctrl-C
+
+    Args:
+        host(str): the address to listen on, localhost by default so
+            nothing outside this machine can reach it
+        port(int): the port
+        workers(int): the number of worker processes
+        max_concurrent(int): the most pdfs extracted at once, workers by default
+        max_queue(int): the most requests waiting for a worker, more get a 503
+        max_mb(float): the biggest pdf accepted, in MB
+        timeout(float): seconds a pdf may take before the request gets a 504
+            and its worker is restarted
+        queue_timeout(float): seconds a request may wait for a worker before
+            it gets a 503
+        memory_mb(float): the most memory a worker may use, None for no cap
+    '''
+    service = ExtractionService(workers, max_concurrent, max_queue, timeout, queue_timeout, memory_mb)
+    started = service.start()
+    httpd = ThreadingHTTPServer((host, port), ExtractionHandler)
+    httpd.daemon_threads = True
+    httpd.service = service
+    httpd.max_bytes = int(max_mb * 2**20)
+    print(f'Serving on http://{host}:{httpd.server_port} with {started} warm worker(s). '
+          'Press Ctrl-C to stop \n')
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print('Stopped serving')
+    finally:
+        httpd.server_close()
+        service.close()
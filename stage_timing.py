@@ -0,0 +1,107 @@
+'''
+Per-pdf timing records for a batch run, a summary of where the time
+went, and the run's peak memory use.
+'''
+import json
+import sys
+
+
+def percentile(values, q):
+    '''
+    Nearest-rank percentile
+
+    Args:
+        values(list(float)): the values, in any order
+        q(float): the percentile, 0-100
+    Returns:
+        float: the value at that percentile, nan if there are no values
+    '''
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+def peak_rss_mb(children=False):
+    '''
+    Peak resident memory so far, of this process or of its finished children
+
+    Args:
+        children(bool): report the largest worker process instead
+    Returns:
+        float: megabytes, or None if the platform can't tell
+    '''
+    try:
+        import resource
+    except ImportError:
+        # Windows, psutil only knows about this process
+        if children:
+            return None
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 2**20
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+class TimingLog:
+    '''
+    Writes one JSON line per pdf with the seconds each stage took, and keeps
+    the times so the batch can be summarised at the end.
+
+    Args:
+        path(str): the JSON lines file to write
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w')
+        self.stages = {}
+        self.cached = 0
+
+    def record(self, pdf, timings):
+        '''
+        Records the timings of one pdf
+
+        Args:
+            pdf(str): the pdf's path
+            timings(dict(str, float)): seconds per stage, None if the row
+                came from the cache
+        Returns:
+            None
+        '''
+        if timings is None:
+            self.cached += 1
+            self.file.write(json.dumps({'path': pdf, 'cached': True}) + '\n')
+            return
+        for stage, seconds in timings.items():
+            self.stages.setdefault(stage, []).append(seconds)
+        self.file.write(json.dumps({'path': pdf, 'cached': False, 'stages': timings}) + '\n')
+        self.file.flush()
+
+    def summary(self):
+        '''
+        A table of the p50 and p95 milliseconds of each stage, slowest first
+
+        Returns:
+            str: the summary
+        '''
+        measured = len(self.stages.get('total', []))
+        lines = [f'Stage timings of {measured} pdfs ({self.cached} from the cache), '
+                 f'records in {self.path}:',
+                 f'  {"stage":<20} {"p50 ms":>9} {"p95 ms":>9} {"total s":>9}']
+        rows = sorted(self.stages.items(), key=lambda item: -sum(item[1]))
+        for stage, seconds in rows:
+            lines.append(f'  {stage:<20} {1000 * percentile(seconds, 50):9.2f} '
+                         f'{1000 * percentile(seconds, 95):9.2f} {sum(seconds):9.2f}')
+        return '\n'.join(lines)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
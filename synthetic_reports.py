@@ -0,0 +1,460 @@
+'''
+Generates synthetic sleep study reports with PyMuPDF.
+
+The reports use the same headings and table layouts as the real reports so
+they run through extract_stats.py end to end, but every name, number and
+date is made up. Used by benchmark.py, no PHI ever needs to leave the PDFs
+folder to measure the extractor.
+'''
+import os
+import random
+
+import fitz  # PyMuPDF
+
+# the extractor's headings, so the reports can't drift from what it looks for
+from extract_stats import CPAP_TABLE_HEADINGS
+
+
+PAGE_WIDTH = 612
+PAGE_HEIGHT = 792
+TOP_MARGIN = 60
+BOTTOM_MARGIN = 740
+LEFT_MARGIN = 50
+LINE_HEIGHT = 12
+FONT_SIZE = 8
+
+EVENT_ROW_LABELS = [
+    "Total Obstructive",
+    "Obs. Apnea",
+    "Obs. Hypopnea",
+    "Total RERA",
+    "Total Central",
+    "Cen. Apnea",
+    "Cen. Hypopnea",
+    "Total Mixed",
+]
+
+RANGE_ROW_LABELS = ["20-30", "30-45", "45-50", "50-55", "55-60", "60-65"]
+
+SPO2_ROW_LABELS = ["96-100", "92-96", "88-92", "82-88", "75-82", "60-75", "50-60", "0-50"]
+
+
+class _Layout:
+    '''
+    Collects text lines and tables into pages. Items are written in reading
+    order so PyMuPDF returns them in the same order as the real reports.
+    '''
+    def __init__(self):
+        self.pages = [[]]
+        self.y = TOP_MARGIN
+
+    def _room(self, nlines):
+        if self.y + nlines * LINE_HEIGHT > BOTTOM_MARGIN:
+            self.new_page()
+
+    def new_page(self):
+        self.pages.append([])
+        self.y = TOP_MARGIN
+
+    def line(self, text, x=LEFT_MARGIN):
+        self._room(1)
+        self.pages[-1].append((x, self.y, text))
+        self.y += LINE_HEIGHT
+
+    def lines(self, texts):
+        for text in texts:
+            self.line(text)
+
+    def gap(self):
+        self.y += LINE_HEIGHT / 2
+
+    def table(self, heading, header_rows, rows, col_width=58, label_width=110):
+        '''
+        Adds a table. Each row is (label, [cells]); header rows are written
+        as plain rows of column titles. The whole table stays on one page.
+        '''
+        self._room(2 + len(header_rows) + len(rows))
+        if heading:
+            self.line(heading)
+        for header in header_rows:
+            self._row(header, col_width, label_width)
+        for label, cells in rows:
+            self._row([label] + list(cells), col_width, label_width)
+        self.gap()
+
+    def _row(self, cells, col_width, label_width):
+        # a label may wrap over several lines, the cells sit on its first line
+        label_lines = cells[0].split('\n')
+        for i, text in enumerate(label_lines):
+            if text:
+                self.pages[-1].append((LEFT_MARGIN, self.y + i * LINE_HEIGHT, text))
+        for c, cell in enumerate(cells[1:]):
+            if cell != '':
+                self.pages[-1].append((LEFT_MARGIN + label_width + c * col_width, self.y, cell))
+        self.y += LINE_HEIGHT * len(label_lines)
+
+
+def _num(rng, lo, hi, ndigits=1):
+    return f'{rng.uniform(lo, hi):.{ndigits}f}'
+
+
+def _int(rng, lo, hi):
+    return str(rng.randint(lo, hi))
+
+
+def _page_header(name, date, page, npages):
+    return [name, f'{date} ', ' ', f'Page {page} of {npages}']
+
+
+def _demographics(lay, rng, info):
+    lay.lines([
+        f"Name: {info['name']}",
+        f"Study Date: {info['study_date']}",
+        f"Age: {_int(rng, 1, 17)} years",
+        f"Date of Birth: {info['birth_date']}",
+        f"Sex: {rng.choice(['M', 'F'])}",
+        f"Hospital No: {info['hospital_number']}",
+        f"Weight: {_num(rng, 10, 80)} kg",
+        f"Encounter: {_int(rng, 100000, 999999)}",
+        f"Height: {_num(rng, 80, 180)} cm",
+        f"Ordering MD: {rng.choice(['Smith, Ann', 'Jones, Bo', 'Lee, Cy'])}",
+        f"Body Mass Index: {_num(rng, 12, 30)}",
+        f"Verified By: {rng.choice(['Park, Di MD', 'Ng, Ed MD'])}",
+        f"Scored By: {rng.choice(['RPSGT A', 'RPSGT B'])}",
+        f"Study No: {info['study_number']}",
+        f"Study Type: {info['study_type']}",
+        f"Start Time: 20:{_int(rng, 10, 59)}:00",
+        f"Lights Off Time: 21:{_int(rng, 10, 59)}:00",
+        f"End Time: 06:{_int(rng, 10, 59)}:00",
+        f"Lights On Time: 06:{_int(rng, 10, 59)}:00",
+        f"File Name: SYN{_int(rng, 1000, 9999)}",
+    ])
+    lay.gap()
+
+
+def _narrative(lay, rng, info):
+    lay.lines(["INTRODUCTION",
+               "The patient was referred for evaluation of snoring and witnessed pauses.",
+               "STANDARD POLYSOMNOGRAM (16 channels)",
+               f"EEG  ({_int(rng, 4, 8)} channels): frontal, central and occipital leads.",
+               "Muscle tone  (chin EMG): recorded.",
+               "Eye movements (2 channels): recorded.",
+               "Leg movements (2 channels): recorded.",
+               "Cardiac rhythm and rate (EKG): recorded.",
+               "Airflow: nasal pressure and oronasal thermistor.",
+               "Respiratory sounds: snore microphone.",
+               "Effort: chest and abdominal belts.",
+               "Oxygen saturation (SaO2): pulse oximetry.",
+               "SpO2 signal reliability: good.",
+               "End Tidal CO2: " + ('recorded.' if info['co2'] in ('etco2', 'both') else 'not recorded.'),
+               "Appearance/behavior: cooperative.",
+               "INTERPRETATION",
+               "SLEEP ARCHITECTURE",
+               "Sleep onset was prompt with normal distribution of stages.",
+               "POSITION:",
+               "Slept supine and non-supine.",
+               "BREATHING PATTERN/RESPIRATORY EVENTS",
+               "Occasional obstructive events were seen.",
+               "GAS EXCHANGE",
+               "Baseline saturation was normal.",
+               "EKG ",
+               "Normal sinus rhythm.",
+               "MOVEMENTS",
+               "No significant limb movements.",
+               "IMPRESSION:",
+               "Mild obstructive sleep apnea.",
+               "COMMENT:",
+               "Clinical correlation is recommended.",
+               ])
+    lay.gap()
+
+
+def _sleep_params(lay, rng):
+    lay.lines(["SLEEP PARAMETERS",
+               f"Time in Bed (TIB): {_num(rng, 400, 600)} min",
+               f"Sleep Period (Sleep Onset to Final Wakening): {_num(rng, 350, 550)} min",
+               f"Total Sleep Time (TST): {_num(rng, 300, 500)} min",
+               f"Waking After Sleep Onset (WASO): {_num(rng, 5, 80)} min",
+               f"Sleep Efficiency (TST/TIB): {_num(rng, 60, 99)}%",
+               f"Sleep Maintenance (TST/SPT): {_num(rng, 60, 99)}%",
+               f"Sleep Latency: {_num(rng, 1, 60)} min"])
+    lay.gap()
+
+
+def _stage_distribution(lay, rng, info):
+    header = [["Stage", "Time (min)", "% TST", "Latency (min)"]]
+    if info['staging'] == 'pediatric':
+        rows = [("Transitional", [_num(rng, 5, 60), _num(rng, 1, 20), _num(rng, 1, 40)]),
+                ("REM", [_num(rng, 30, 120), _num(rng, 10, 30), _num(rng, 50, 150)]),
+                ("NREM", [_num(rng, 200, 400), _num(rng, 50, 80)]),
+                ("Wake", [_num(rng, 5, 80)])]
+    else:
+        rows = [(label, [_num(rng, 0, 200), _num(rng, 0, 60), _num(rng, 0, 200)])
+                for label in ["N1", "N2", "Stage 3", "Stage 4", "N3", "REM"]]
+        rows += [("NREM", [_num(rng, 200, 400), _num(rng, 50, 80)]),
+                 ("Wake", [_num(rng, 5, 80)])]
+    lay.table("STAGE DISTRIBUTION ", header, rows)
+
+
+def _arousals(lay, rng):
+    header = [["", "Number", "", "", "Index"], ["", "Total", "REM", "NREM", "Total", "REM", "NREM"]]
+    rows = [(label, [_int(rng, 0, 90), _int(rng, 0, 30), _int(rng, 0, 60),
+                     _num(rng, 0, 15), _num(rng, 0, 15), _num(rng, 0, 15)])
+            for label in ["Total", "Apnea/Hypopnea", "Resp. Disturbance"]]
+    lay.table("AROUSALS", header, rows)
+
+
+def _leg_movements(lay, rng):
+    header = [["", "Number", "Index"]]
+    rows = [("PLMs", [_int(rng, 0, 90), _num(rng, 0, 15)]),
+            ("PLMs with arousal", [_int(rng, 0, 30), _num(rng, 0, 5)])]
+    lay.table("PERIODIC LEG MOVEMENTS", header, rows)
+
+
+def _respiratory_analysis(lay, rng):
+    header = [["", "Supine", "", "Non-Supine"], ["", "Time (min)", "%", "Time (min)", "%"]]
+    rows = [("TST (min)", [_num(rng, 300, 500)])]
+    for label in ["Total Sleep", "REM", "NREM"]:
+        cells = [_num(rng, 0, 300), _num(rng, 0, 100), _num(rng, 0, 300), _num(rng, 0, 100)]
+        if label == 'REM' and rng.random() < 0.2:
+            cells = ['0.0', '!Zero Divide', _num(rng, 0, 300), _num(rng, 0, 100)]
+        rows.append((label, cells))
+    lay.table("RESPIRATORY ANALYSIS", header, rows)
+
+
+def _baseline_ranges(lay, rng, info):
+    header = [["", "Room Air", "", "CPAP/O2"], ["", "REM", "NREM", "REM", "NREM"]]
+    labels = ["SpO2 (%)", "Resp. Rate "]
+    if info['co2'] in ('tcco2', 'both'):
+        labels.append("Transcutaneous CO2 ")
+    labels += ["End Tidal CO2 ", "Heart Rate "]
+    rows = []
+    for label in labels:
+        lo = rng.randint(20, 90)
+        room_air = [f'{lo}-{lo + rng.randint(1, 9)}', f'{lo}-{lo + rng.randint(1, 9)}']
+        cpap = room_air if info['cpap'] else ['-', '-']
+        rows.append((label, room_air + cpap))
+    lay.table("BASELINE RANGES", header, rows)
+
+
+def _spo2_ranges(lay, rng):
+    header = [["SpO2", "Time", "% of", "Time >=", "% of"],
+              ["Range", "(min)", "TST", "(min)", "TST"]]
+    rows = [(label, [_num(rng, 0, 300), _num(rng, 0, 100), _num(rng, 0, 500), _num(rng, 0, 100)])
+            for label in SPO2_ROW_LABELS]
+    lay.table("SpO2 RANGES IN SLEEP", header, rows)
+
+
+def _respiratory_events(lay, rng):
+    header = [["", "Obstructive", "", "Central"], ["", "REM", "NREM", "REM", "NREM"]]
+    rows = [(label, [_num(rng, 5, 40) for _ in range(4)])
+            for label in ["Min Length (s)", "Max Length (s)", "Usual Desat (%)", "Greatest Desat (%)"]]
+    lay.table("RESPIRATORY EVENTS", header, rows)
+
+
+def _desaturation(lay, rng):
+    header = [["", "Wake", "NREM", "REM", "Total"]]
+    rows = [(label, [_num(rng, 0, 99) for _ in range(4)])
+            for label in ["Avg O2 Sat (%)", "Total # Desat", "Desat Index", "Avg Low Sat (%)",
+                          "Nadir SaO2 (%)", "Time < 90% (min)"]]
+    lay.table("TABLE OF DESATURATION", header, rows)
+
+
+def _co2_table(lay, rng, heading, name):
+    header = [[name, "Wake", "", "NREM", "", "REM", "", "Total"],
+              ["Range", "Time", "", "Time", "", "Time", "", "Time"],
+              ["(mmHg)", "(min)", "%", "(min)", "%", "(min)", "%", "(min)", "%"],
+              ["", "in", "of", "in", "of", "in", "of", "in"]]
+    rows = [(label, [_num(rng, 0, 200) if i % 2 == 0 else _num(rng, 0, 100) for i in range(8)])
+            for label in RANGE_ROW_LABELS]
+    rows.append(("<20\nor\n>65", [_num(rng, 0, 5) for _ in range(8)]))
+    lay.table(heading, header, rows)
+
+
+def _events_table(lay, rng, heading, column_groups):
+    header = [[""] + [g for group in column_groups for g in (group, "")],
+              [""] + ["#", "Index"] * len(column_groups)]
+    rows = [(label, [_int(rng, 0, 40) if i % 2 == 0 else _num(rng, 0, 10)
+                     for i in range(2 * len(column_groups))])
+            for label in EVENT_ROW_LABELS]
+    lay.table(heading, header, rows, col_width=44)
+
+
+def _apnea_summary(lay, rng):
+    header = [["", "Number", "Index", "Min Length", "Max Length"]]
+    labels = ["Total"]
+    for kind, variants in [("Obstructive", 9), ("RERA", 9), ("Central", 5), ("Mixed", 5)]:
+        subs = ["", "REM", "NREM", "Supine", "Non-Supine",
+                "REM Supine", "REM Non-Supine", "NREM Supine", "NREM Non-Supine"][:variants]
+        labels += [f'{kind} {s}'.strip() for s in subs]
+    rows = [(label, [_int(rng, 0, 90), _num(rng, 0, 20), _num(rng, 5, 15), _num(rng, 15, 60)])
+            for label in labels]
+    lay.table("APNEA/HYPOPNEA SUMMARY", header, rows, label_width=150)
+
+
+def _periodic_breathing_min_o2(lay, rng, info):
+    lay._room(30)
+    lay.line("PERIODIC BREATHING")
+    lay.lines(["", "Total Time ", "(min) ", "% of Time "])
+    for label in ["ENTIRE STUDY ", "REM", "NonREM"]:
+        lay.lines([label, _num(rng, 0, 30), _num(rng, 0, 10)])
+    lay.line("MINIMUM O2 SATURATION")
+    for label in ["ENTIRE STUDY", "REM", "NonREM"]:
+        lay.lines([label, _int(rng, 70, 95)])
+    lay.line("End of tables")
+    if info['cpap']:
+        if info['cpap_new_page']:
+            lay.new_page()
+        _cpap_tables(lay, rng, info)
+
+
+def _cpap_tables(lay, rng, info):
+    header = [["Pressure", "TIB", "TST", "Obs.", "Cen.", "Hypo-", "RERA", "AHI", "RDI", "Min"],
+              ["(cmH2O)", "(min)", "(min)", "Apnea", "Apnea", "pnea", "", "", "", "SpO2"]]
+    for heading in CPAP_TABLE_HEADINGS:
+        rows = []
+        for level in info['pressures']:
+            rows.append((level, [_num(rng, 0, 120), _num(rng, 0, 110), _int(rng, 0, 20),
+                                 _int(rng, 0, 10), _int(rng, 0, 30), _int(rng, 0, 15),
+                                 _num(rng, 0, 30), _num(rng, 0, 40), _int(rng, 75, 99)]))
+        lay.table(heading, header, rows, col_width=42, label_width=70)
+
+
+def _appendix(lay, rng, npages):
+    for p in range(npages):
+        lay.new_page()
+        lay.line("HYPNOGRAM")
+        for r in range(50):
+            lay.line(' '.join(rng.choice(['W', 'N1', 'N2', 'N3', 'R']) for _ in range(40)))
+
+
+def report_info(seed=0, staging='adult', co2='etco2', etco2_heading="TABLE OF ETCO2 VALUES",
+                cpap=False, cpap_new_page=False, appendix_pages=0):
+    '''
+    Picks the identifying fields and template options for one synthetic report.
+
+    Args:
+        seed (int): random seed, the same seed always gives the same report
+        staging (str): 'adult' (N1/N2/N3 staging) or 'pediatric' (Transitional)
+        co2 (str): which CO2 tables to include, 'etco2', 'tcco2', 'both' or 'none'
+        etco2_heading (str): the casing of the ETCO2 table heading
+        cpap (bool): include the CPAP/BiPAP/O2 titration tables
+        cpap_new_page (bool): start the CPAP tables on a new page
+        appendix_pages (int): number of trailing hypnogram pages
+    Returns:
+        dict(str, any): the report options
+    '''
+    rng = random.Random(seed)
+    return {
+        'seed': seed,
+        'name': f"SYNTH, PATIENT{seed}",
+        'study_date': f"{rng.randint(1, 12)}/{rng.randint(1, 28)}/20{rng.randint(10, 24)}",
+        'birth_date': f"{rng.randint(1, 12)}/{rng.randint(1, 28)}/20{rng.randint(0, 9):02d}",
+        'hospital_number': str(1000000 + seed),
+        'study_number': f"S{seed:06d}",
+        'study_type': 'CPAP Titration' if cpap else 'Diagnostic PSG',
+        'staging': staging,
+        'co2': co2,
+        'etco2_heading': etco2_heading,
+        'cpap': cpap,
+        'cpap_new_page': cpap_new_page,
+        'pressures': ['CPAP 5', 'CPAP 6', 'CPAP 8', 'BiPAP 10/6', 'BiPAP 12/8'][:rng.randint(2, 5)],
+        'appendix_pages': appendix_pages,
+    }
+
+
+def build_report(info):
+    '''
+    Lays out a synthetic report and returns it as PDF bytes
+
+    Args:
+        info (dict(str, any)): options from report_info
+    Returns:
+        bytes: the PDF file contents
+    '''
+    rng = random.Random(info['seed'] + 1)
+    lay = _Layout()
+    _demographics(lay, rng, info)
+    _narrative(lay, rng, info)
+    _sleep_params(lay, rng)
+    _stage_distribution(lay, rng, info)
+    _arousals(lay, rng)
+    _leg_movements(lay, rng)
+    _respiratory_analysis(lay, rng)
+    _baseline_ranges(lay, rng, info)
+    _spo2_ranges(lay, rng)
+    _respiratory_events(lay, rng)
+    _desaturation(lay, rng)
+    if info['co2'] in ('etco2', 'both'):
+        _co2_table(lay, rng, info['etco2_heading'], "ETCO2")
+    if info['co2'] in ('tcco2', 'both'):
+        _co2_table(lay, rng, "TABLE OF TcCO2 VALUES", "TcCO2")
+    _events_table(lay, rng, "RESPIRATORY EVENTS BY STAGE", ["Total", "REM", "NREM"])
+    _events_table(lay, rng, "RESPIRATORY EVENTS BY BODY POSITION", ["Total", "Supine", "Non-Supine"])
+    _events_table(lay, rng, "RESPIRATORY EVENTS BY STAGE AND POSITION",
+                  ["REM Sup", "REM NSup", "NREM Sup", "NREM NSup"])
+    _apnea_summary(lay, rng)
+    _periodic_breathing_min_o2(lay, rng, info)
+    _appendix(lay, rng, info['appendix_pages'])
+
+    doc = fitz.open()
+    npages = len(lay.pages)
+    for number, items in enumerate(lay.pages, start=1):
+        page = doc.new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+        header = _page_header(info['name'].split(',')[0], info['study_date'], number, npages)
+        for i, text in enumerate(header):
+            page.insert_text((LEFT_MARGIN, 20 + i * 9), text, fontsize=FONT_SIZE)
+        for x, y, text in items:
+            page.insert_text((x, y), text, fontsize=FONT_SIZE)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+VARIANTS = [
+    dict(staging='adult', co2='etco2'),
+    dict(staging='adult', co2='tcco2'),
+    dict(staging='pediatric', co2='both'),
+    dict(staging='adult', co2='etco2', etco2_heading="TABLE OF EtCO2 VALUES"),
+    dict(staging='pediatric', co2='none'),
+    dict(staging='adult', co2='both', cpap=True),
+]
+
+
+def write_reports(folder, count, appendix_pages=0, start_seed=0):
+    '''
+    Writes count synthetic reports into folder, cycling through VARIANTS
+
+    Args:
+        folder (str): output directory, created if missing
+        count (int): number of reports to write
+        appendix_pages (int): trailing hypnogram pages per report
+        start_seed (int): seed of the first report
+    Returns:
+        list(str): paths of the written reports
+    '''
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for n in range(count):
+        seed = start_seed + n
+        info = report_info(seed, appendix_pages=appendix_pages, **VARIANTS[seed % len(VARIANTS)])
+        path = os.path.join(folder, f'synthetic_{seed:05d}.pdf')
+        with open(path, 'wb') as f:
+            f.write(build_report(info))
+        paths.append(path)
+    return paths
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Writes synthetic sleep study reports')
+    parser.add_argument('folder', nargs='?', default='synthetic_pdfs',
+                        help='where to write the reports (default: synthetic_pdfs)')
+    parser.add_argument('--count', type=int, default=len(VARIANTS),
+                        help='number of reports, cycling through the template variants')
+    parser.add_argument('--appendix-pages', type=int, default=0,
+                        help='trailing hypnogram pages per report')
+    args = parser.parse_args()
+    for path in write_reports(args.folder, args.count, args.appendix_pages):
+        print(path)
@@ -0,0 +1,175 @@
+'''
+Reads tables from the word coordinates PyMuPDF gives for a page, instead
+of from positions in the newline-split page text.
+
+Words are grouped into lines by their height on the page, each line is
+split into a row label and its cells, and cells are assigned to columns by
+where they sit horizontally, so a blank cell or a label that wraps over
+several lines doesn't shift every value after it.
+'''
+import math
+import re
+
+
+# what a table cell holds: a number, a range, a dash or an X
+VALUE_PATTERN = re.compile(r'^(?:-|X|\d+(?:\.\d+)?(?:-\d+(?:\.\d+)?)?%?)$')
+
+# words on the same line are within this many points of each other vertically
+LINE_TOLERANCE = 2.0
+
+
+def is_value(text):
+    '''
+    Whether a word is a table value rather than part of a label
+
+    Args:
+        text(str): the word
+    Returns:
+        bool
+    '''
+    return VALUE_PATTERN.match(text) is not None
+
+
+def find_phrase(words, phrase, below=0.0):
+    '''
+    Finds a phrase, e.g. a table heading, in the words of a page
+
+    Args:
+        words(list(tuple)): the words of the page, from page.get_text("words")
+        phrase(str): the text to look for
+        below(float): only look at words starting at or below this height
+    Returns:
+        tuple(float, float): the top and bottom of the first line the phrase
+            is on, or None if it isn't on the page
+    '''
+    tokens = phrase.split()
+    if not tokens:
+        return None
+    for i in range(len(words) - len(tokens) + 1):
+        first = words[i]
+        if first[1] < below or first[4] != tokens[0]:
+            continue
+        candidate = words[i:i + len(tokens)]
+        # the words must follow each other on one line of the same block
+        if all(w[4] == t and w[5:7] == first[5:7] for w, t in zip(candidate, tokens)):
+            return first[1], max(w[3] for w in candidate)
+    return None
+
+
+def group_lines(words):
+    '''
+    Groups words into lines by their vertical position
+
+    Args:
+        words(list(tuple)): (x0, y0, x1, y1, text, ...) words
+    Returns:
+        list(list(tuple)): the lines top to bottom, each sorted left to right
+    '''
+    lines = []
+    last_middle = None
+    for word in sorted(words, key=lambda w: ((w[1] + w[3]) / 2, w[0])):
+        middle = (word[1] + word[3]) / 2
+        if last_middle is None or middle - last_middle > LINE_TOLERANCE:
+            lines.append([])
+            last_middle = middle
+        lines[-1].append(word)
+    return [sorted(line, key=lambda w: w[0]) for line in lines]
+
+
+def merge_cells(words):
+    '''
+    Joins words that are closer together than a space into one cell, e.g.
+    '!Zero Divide'
+
+    Args:
+        words(list(tuple)): the words of a line after its label, left to right
+    Returns:
+        list(list): [x0, x1, text] of each cell
+    '''
+    cells = []
+    for x0, y0, x1, y1, text, *_ in words:
+        if cells and x0 - cells[-1][1] < 0.5 * (y1 - y0):
+            cells[-1][1] = x1
+            cells[-1][2] += ' ' + text
+        else:
+            cells.append([x0, x1, text])
+    return cells
+
+
+class TableGrid:
+    '''
+    The rows and columns of one table on a page
+
+    A line is a row if it has any values. Its label is the first word plus
+    any words before the first value, and lines without values that follow
+    a row continue its label (e.g. "<20", "or", ">65"). Lines before the
+    first row are the column headers and are skipped. Columns are the
+    horizontal spans that the cells of every row overlap into.
+
+    Labels that contain numbers, e.g. "CPAP 5", would be cut at the number.
+    For those tables pass label_from_header: the label column is then
+    everything left of the second word of the first (header) line.
+
+    Args:
+        words(list(tuple)): the words of the page, from page.get_text("words")
+        top(float): the table starts below this height, e.g. its heading
+        bottom(float): the table ends above this height
+        label_from_header(bool): take the label column's width from the
+            header line instead of ending labels at the first value
+    '''
+    def __init__(self, words, top, bottom, label_from_header=False):
+        inside = [w for w in words if w[1] >= top and w[3] <= bottom]
+        lines = group_lines(inside)
+        label_end = None
+        if label_from_header and lines and len(lines[0]) > 1:
+            label_end = lines[0][1][0]
+        rows = []
+        for line in lines:
+            end = 1
+            if label_end is None:
+                while end < len(line) and not is_value(line[end][4]):
+                    end += 1
+            else:
+                while end < len(line) and line[end][0] < label_end:
+                    end += 1
+            label = ' '.join(w[4] for w in line[:end])
+            cells = merge_cells(line[end:])
+            # a row has values, other lines carry on the label above
+            if cells and (label_end is None or any(is_value(text) for _, _, text in cells)):
+                rows.append([label, cells])
+            elif rows:
+                rows[-1][0] += ' ' + label
+
+        spans = []
+        for x0, x1, _ in sorted((c for _, cells in rows for c in cells), key=lambda c: c[0]):
+            if spans and x0 <= spans[-1][1]:
+                spans[-1][1] = max(spans[-1][1], x1)
+            else:
+                spans.append([x0, x1])
+        self.ncols = len(spans)
+
+        self.labels = []
+        self.cells = []
+        for label, cells in rows:
+            values = [math.nan] * self.ncols
+            for x0, x1, text in cells:
+                col = next(i for i, (s0, s1) in enumerate(spans) if s0 <= x0 <= s1)
+                values[col] = text
+            self.labels.append(label)
+            self.cells.append(values)
+
+    def row(self, label, prefix=False):
+        '''
+        The cells of the first row with the given label
+
+        Args:
+            label(str): the row label, words separated by single spaces
+            prefix(bool): match rows whose label starts with label
+        Returns:
+            list(str): one cell per column, nan where a cell is blank, or
+                None if there is no such row
+        '''
+        for row_label, values in zip(self.labels, self.cells):
+            if row_label == label or (prefix and row_label.startswith(label)):
+                return values
+        return None
@@ -0,0 +1,29 @@
+import pytest
+
+import extract_stats
+from synthetic_reports import build_report, report_info
+
+
+@pytest.mark.parametrize('new_page', [False, True])
+def test_cpap_columns_are_filled(new_page):
+    info = report_info(5, co2='both', cpap=True, cpap_new_page=new_page)
+    record = extract_stats.extract_report(build_report(info))
+    assert not record['error']
+    row = record['row']
+    for table in extract_stats.CPAP_TABLE_NAMES:
+        pressures = [row[f'cpap_{table}_{n}_pressure'] for n in range(1, extract_stats.CPAP_MAX_PRESSURES + 1)]
+        assert pressures[:len(info['pressures'])] == info['pressures']
+        assert all(p is None for p in pressures[len(info['pressures']):])
+
+
+def test_every_cpap_table_is_in_the_synthetic_reports():
+    info = report_info(5, co2='both', cpap=True)
+    with extract_stats.ReportText(None, build_report(info)) as report:
+        report.decode_all()
+        for heading in extract_stats.CPAP_TABLE_HEADINGS:
+            assert heading in report.text
+
+
+def test_diagnostic_report_has_no_cpap_values():
+    row = extract_stats.extract_report(build_report(report_info(0)))['row']
+    assert all(row[name] is None for name in extract_stats.CPAP_FIELD_NAMES)
@@ -0,0 +1,48 @@
+import fitz
+
+from duplicates import DuplicateFinder, first_page_identity
+from synthetic_reports import build_report, report_info
+
+HEADINGS = ['Name:', 'Study Date:', 'Date of Birth:', 'Hospital No:', 'Encounter:', 'Ordering MD:',
+            'Verified By:', 'Study No:', 'Start Time:']
+VALUES = ['DOE, JANE', '7/25/2024', '1/2/1980', '0012345', 'E1', 'Dr A', 'Dr B', 'PSG-77', '22:01:00']
+
+
+def first_page(lines):
+    document = fitz.open()
+    page = document.new_page()
+    for i, line in enumerate(lines):
+        page.insert_text((50, 60 + 14 * i), line, fontsize=10)
+    data = document.tobytes()
+    document.close()
+    return data
+
+
+def test_identity_with_the_values_on_the_next_line():
+    same_line = first_page([f'{heading} {value}' for heading, value in zip(HEADINGS, VALUES)])
+    next_line = first_page([line for pair in zip(HEADINGS, VALUES) for line in pair])
+    identity = first_page_identity('same_line.pdf', same_line)
+    assert identity == ('PSG-77', '0012345', '7/25/2024')
+    assert first_page_identity('next_line.pdf', next_line) == identity
+
+
+def test_isolated_finder_keeps_the_first_pdf_of_a_study(tmp_path):
+    data = build_report(report_info(0))
+    document = fitz.open(stream=data, filetype='pdf')
+    document.set_metadata({'title': 're-exported'})
+    reexport = document.tobytes()
+    document.close()
+    assert reexport != data
+    paths = []
+    for name, contents in [('a.pdf', data), ('b.pdf', data), ('c.pdf', reexport), ('d.pdf', build_report(report_info(1)))]:
+        (tmp_path / name).write_bytes(contents)
+        paths.append(str(tmp_path / name))
+
+    finder = DuplicateFinder(str(tmp_path / 'duplicates.csv'), isolation={'timeout': 30}, chunk_size=3)
+    try:
+        assert list(finder.filter(paths)) == [paths[0], paths[3]]
+    finally:
+        finder.close()
+    assert (finder.same_file, finder.same_study) == (1, 1)
+    lines = (tmp_path / 'duplicates.csv').read_text().splitlines()
+    assert lines[-2:] == [f'{paths[1]},{paths[0]},same file', f'{paths[2]},{paths[0]},same study']
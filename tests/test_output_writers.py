@@ -0,0 +1,76 @@
+import csv
+
+import pytest
+
+import extract_stats
+from output_writers import CsvRowWriter, RunManifest, load_columnar, remove_csv_rows, to_floats, write_columnar
+from synthetic_reports import build_report, report_info
+
+COLUMNS = ['fname', 'ahi']
+
+
+def write_output(tmp_path, rows):
+    path = str(tmp_path / 'out.csv')
+    with CsvRowWriter(path, COLUMNS) as writer, RunManifest(path + '.manifest', COLUMNS) as manifest:
+        for i, values in enumerate(rows):
+            writer.write_values(values)
+            manifest.record(f'/pdfs/{values[0]}', writer.nrows - 1, writer.offset, (i, i * 10), f'sha{i}')
+    return path
+
+
+def test_manifest_records_the_pdf_stat_and_hash(tmp_path):
+    path = write_output(tmp_path, [['a.pdf', 1.5], ['b.pdf', 2]])
+    manifest = RunManifest(path + '.manifest', COLUMNS, resume=True)
+    manifest.close()
+    assert manifest.done['/pdfs/b.pdf'] == (1, 1, 10, 'sha1')
+
+
+def test_remove_csv_rows_keeps_the_other_rows(tmp_path):
+    path = write_output(tmp_path, [['a.pdf', 1.5], ['b.pdf', 2], ['c.pdf', 3]])
+    remove_csv_rows(path, COLUMNS, path + '.manifest', {'/pdfs/b.pdf'})
+    with open(path, newline='') as f:
+        assert [cells[1] for cells in csv.reader(f)][1:] == ['a.pdf', 'c.pdf']
+
+    manifest = RunManifest(path + '.manifest', COLUMNS, resume=True)
+    manifest.close()
+    assert manifest.nrows == 2
+    assert manifest.done['/pdfs/c.pdf'] == (1, 2, 20, 'sha2')
+    # a resumed writer appends after the last kept row
+    with CsvRowWriter(path, COLUMNS, resume_offset=manifest.offset, nrows=manifest.nrows) as writer:
+        writer.write_values(['d.pdf', 4])
+    with open(path, newline='') as f:
+        assert [cells[:2] for cells in csv.reader(f)][1:] == [['0', 'a.pdf'], ['1', 'c.pdf'], ['2', 'd.pdf']]
+
+
+def test_to_floats_drops_units():
+    assert to_floats(['573.7 min', '', '12 min']) == [573.7, pytest.approx(float('nan'), nan_ok=True), 12.0]
+    assert to_floats(['88.5%', '-'])[0] == 88.5
+    # mixed units, dates and times stay text
+    assert to_floats(['7.5 min', '2 hours']) is None
+    assert to_floats(['7/25/2024']) is None
+    assert to_floats(['20:41:00']) is None
+
+
+@pytest.mark.parametrize('fmt', ['npy', 'parquet'])
+def test_columnar_types(tmp_path, fmt):
+    if fmt == 'parquet':
+        pytest.importorskip('pyarrow')
+    path = str(tmp_path / 'out.csv')
+    with CsvRowWriter(path, extract_stats.OUTPUT_COLUMNS) as writer:
+        for seed in range(3):
+            row = extract_stats.extract_report(build_report(report_info(seed)))['row']
+            row['hospital_number'] = f'00{seed}1234'
+            writer.write_row(row)
+    columnar_path = write_columnar(path, str(tmp_path / 'out'), extract_stats.CATEGORICAL_FIELD_NAMES,
+                                   extract_stats.TEXT_FIELD_NAMES, fmt=fmt)
+    df = load_columnar(columnar_path)
+    for name in ['time_in_bed', 'total_sleep_time', 'sleep_efficiency']:
+        assert df[name].dtype == 'float64'
+        assert df[name].notna().all()
+    assert df['study_date'].dtype != 'float64'
+    # ids keep their leading zeros
+    assert list(df['hospital_number']) == ['0001234', '0011234', '0021234']
+    assert set(df['sex'].cat.categories) <= {'F', 'M'}
+
+    subset = load_columnar(columnar_path, ['fname', 'sex'])
+    assert list(subset.columns) == ['fname', 'sex']
@@ -0,0 +1,46 @@
+import logging
+
+import pytest
+
+import extract_stats
+from synthetic_reports import build_report, report_info
+
+
+def fingerprint(info):
+    with extract_stats.ReportText(None, build_report(info)) as report:
+        variant, table_list = extract_stats.fingerprint_report(report)
+    return variant, table_list
+
+
+@pytest.mark.parametrize('new_page', [False, True])
+def test_cpap_report_is_fingerprinted_as_cpap(new_page):
+    info = report_info(5, co2='both', cpap=True, cpap_new_page=new_page)
+    variant, table_list = fingerprint(info)
+    assert variant.cpap
+    if new_page:
+        # the old check only looked at the rest of the page after the
+        # periodic breathing table
+        assert "CPAP/BiPAP" not in str(table_list[14])
+
+
+def test_diagnostic_report_only_notes_missing_cpap_tables_at_debug(caplog):
+    info = report_info(0, co2='etco2')
+    variant, _ = fingerprint(info)
+    assert not variant.cpap
+    with caplog.at_level(logging.DEBUG, logger='extract_stats'):
+        record = extract_stats.extract_report(build_report(info))
+    assert not record['error']
+    missing = [r for r in caplog.records if r.getMessage() == 'No CPAP/BiPAP/O2 tables found']
+    assert [r.levelno for r in missing] == [logging.DEBUG]
+
+
+@pytest.mark.parametrize('cpap', [False, True])
+def test_fingerprint_does_not_decode_the_appendix(cpap):
+    info = report_info(0, cpap=cpap, cpap_new_page=cpap, appendix_pages=20)
+    with extract_stats.ReportText(None, build_report(info)) as report:
+        variant, _ = extract_stats.fingerprint_report(report)
+        assert variant.cpap == cpap
+        # the periodic breathing table's page and the one after it
+        last_table_page = report.index.locate("Total Time \n(min) ")[0]
+        assert len(report.pages) <= last_table_page + 2
+        assert report.page_count - len(report.pages) >= 19
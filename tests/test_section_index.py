@@ -0,0 +1,78 @@
+import extract_stats
+from extract_stats import ReportText, SectionIndex
+from synthetic_reports import build_report, report_info
+
+STAGE = 'RESPIRATORY EVENTS BY STAGE'
+STAGE_POSITION = 'RESPIRATORY EVENTS BY STAGE AND POSITION'
+SUMMARY = 'APNEA/HYPOPNEA SUMMARY'
+# the end of a page is only scanned with the next one, a heading could run on into it
+FILLER = 'table rows\n' * 10
+
+
+class PageText:
+    '''
+    The part of ReportText a SectionIndex uses, over pages of plain text
+    '''
+    def __init__(self, pages):
+        self.all_pages = pages
+        self.page_count = len(pages)
+        self.pages = []
+        self.page_starts = []
+        self.text = ''
+
+    @property
+    def done(self):
+        return len(self.pages) == self.page_count
+
+    def decode_next(self):
+        if self.done:
+            return False
+        self.page_starts.append(len(self.text))
+        self.pages.append(self.all_pages[len(self.pages)])
+        self.text += self.pages[-1]
+        return True
+
+    def decode_all(self):
+        while self.decode_next():
+            pass
+
+
+def test_heading_split_across_pages():
+    report = PageText(['intro\nRESPIRATORY EVE', 'NTS BY STAGE\nstage rows\n', f'{SUMMARY}\nsummary\n'])
+    index = SectionIndex(report, [STAGE, SUMMARY])
+    assert index.find(STAGE) == len('intro\n')
+    assert index.locate(STAGE) == (0, len('intro\n'))
+    assert index.between(STAGE, SUMMARY) == 'stage rows'
+
+
+def test_shorter_heading_that_prefixes_a_longer_one():
+    pages = [f'{STAGE}\nby stage\n', f'{STAGE_POSITION}\nby stage and position\n{SUMMARY}\n']
+    report = PageText(pages)
+    index = SectionIndex(report, [STAGE, STAGE_POSITION, SUMMARY])
+    assert index.find(STAGE_POSITION) == len(pages[0])
+    # the longer heading is also an occurrence of the shorter one
+    assert index.positions[STAGE] == [0, len(pages[0])]
+    assert index.between(STAGE, STAGE_POSITION) == 'by stage'
+    assert index.between(STAGE_POSITION, SUMMARY) == 'by stage and position'
+
+
+def test_missing_heading():
+    report = PageText([f'{STAGE}\nby stage\n', f'{SUMMARY}\nsummary\n' + FILLER, 'appendix\n'])
+    index = SectionIndex(report, [STAGE, STAGE_POSITION, SUMMARY])
+    assert index.find(STAGE_POSITION) == -1
+    assert index.locate(STAGE_POSITION) is None
+    assert index.between(STAGE_POSITION, SUMMARY) == ''
+    # a missing end heading ends the section at the next heading found
+    assert index.between(STAGE, STAGE_POSITION) == 'by stage'
+    # the summary was found after it, so the appendix was never decoded
+    assert len(report.pages) == 2
+
+
+def test_extraction_decodes_a_bounded_number_of_pages():
+    data = build_report(report_info(0, appendix_pages=20))
+    with ReportText('appendix.pdf', data) as report:
+        row = extract_stats.Row()
+        extract_stats.get_individual_fields(report, row)
+        extract_stats.get_compound_fields(report, row)
+        assert report.page_count >= 25
+        assert len(report.pages) <= report.page_count - 15
@@ -0,0 +1,45 @@
+import threading
+import time
+
+import server
+from synthetic_reports import build_report, report_info
+
+run_request = server.run_request
+
+
+def hang_on_request(item):
+    if item[0] == b'hang':
+        time.sleep(60)
+    return run_request(item)
+
+
+def test_a_hung_pdf_does_not_keep_its_slot(monkeypatch):
+    monkeypatch.setattr(server, 'run_request', hang_on_request)
+    service = server.ExtractionService(workers=1, timeout=0.5, queue_timeout=10)
+    service.start()
+    try:
+        for _ in range(3):
+            assert service.extract(b'hang')[0] == 504
+        status, record = service.extract(build_report(report_info(0)), 'a.pdf')
+        assert status == 200
+        assert record['row']['fname'] == 'a.pdf'
+        assert service.restarts == 3
+        assert 'extract_worker_restarts_total 3' in service.metrics()
+    finally:
+        service.close()
+
+
+def test_a_waiting_request_times_out(monkeypatch):
+    monkeypatch.setattr(server, 'run_request', hang_on_request)
+    service = server.ExtractionService(workers=1, timeout=5, queue_timeout=0.2)
+    service.start()
+    try:
+        hung = threading.Thread(target=service.extract, args=(b'hang',))
+        hung.start()
+        time.sleep(0.2)
+        start = time.perf_counter()
+        assert service.extract(build_report(report_info(0)))[0] == 503
+        assert time.perf_counter() - start < 2
+    finally:
+        service.close()
+        hung.join()
@@ -0,0 +1,32 @@
+import fitz
+
+import extract_stats
+from synthetic_reports import build_report, report_info
+
+
+def test_each_page_is_extracted_once(monkeypatch):
+    calls = []
+    get_textpage = fitz.Page.get_textpage
+
+    def counting_get_textpage(page, *args, **kwargs):
+        calls.append(page.number)
+        return get_textpage(page, *args, **kwargs)
+
+    monkeypatch.setattr(fitz.Page, 'get_textpage', counting_get_textpage)
+    info = report_info(3, co2='both', cpap=True, appendix_pages=5)
+    with extract_stats.ReportText(None, build_report(info)) as report:
+        row = extract_stats.get_individual_fields(report, extract_stats.Row())
+        row, error = extract_stats.get_compound_fields(report, row)
+        assert not error
+        # the tables were read from the words of their pages
+        assert report._words
+        assert sorted(calls) == list(range(len(report.pages)))
+
+
+def test_co2_tables_come_from_the_grid():
+    info = report_info(3, co2='both')
+    row = extract_stats.extract_report(build_report(info))['row']
+    for prefix in ['etco2', 'tcco2']:
+        values = [row[name] for name in extract_stats.OUTPUT_COLUMNS
+                  if name.startswith('time_') and f'_{prefix}_' in name]
+        assert values and all(isinstance(v, str) for v in values)